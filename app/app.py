@@ -1,21 +1,112 @@
-from datetime import datetime, date, timedelta
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
+from contextvars import ContextVar, Context, copy_context
+from datetime import datetime, date, timedelta, timezone
 from pathlib import Path
-from typing import Optional, List, Dict, Any
+from typing import Annotated, Optional, List, Dict, Any, Callable, Literal, Tuple
+import asyncio
+import bisect
+import csv
+import functools
+import gzip
+import hashlib
+import heapq
+import inspect
+import json
+import logging
+import logging.handlers
+import multiprocessing
+import os
+import queue
+import re
 import secrets
-
-from fastapi import FastAPI, Depends, HTTPException, Response, Request, Cookie
-from fastapi.responses import FileResponse, JSONResponse
-from fastapi.staticfiles import StaticFiles
+import sys
+import threading
+import time
+
+from fastapi import FastAPI, Depends, HTTPException, Response, Request, Cookie, Query
+from fastapi.encoders import jsonable_encoder
+from fastapi.params import Depends as DependsInfo
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from sqlmodel import SQLModel, Field, Session, create_engine, select
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.routing import APIRoute
+from pydantic import BaseModel, TypeAdapter, ValidationError, field_validator
+from pydantic.fields import FieldInfo
+import anyio.to_thread
+import numpy as np
+from sqlalchemy import event, lambda_stmt, text
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.schema import CreateColumn
+from starlette.datastructures import Headers
+from starlette.middleware.gzip import GZipResponder
+from starlette.routing import Match
+from sqlmodel import SQLModel, Field, Session, Index, create_engine, select, insert, update, delete, func
+
+from app import backup
+from app import jobs as jobs_entry
+
+try:  # brotli необязателен: без него статика отдаётся в gzip
+    import brotli
+except ImportError:
+    brotli = None
 
 
 BASE_DIR = Path(__file__).resolve().parent
-DB_PATH = BASE_DIR / "cpvp_ultra.db"
+DB_PATH = Path(os.getenv("SQLITE_PATH") or BASE_DIR / "cpvp_ultra.db")
 
 API_VERSION = "v1"
 
+# очередь единственного писателя: размер, группа коммита, ожидание ответа (сек)
+WRITE_QUEUE_SIZE = int(os.getenv("WRITE_QUEUE_SIZE", "256"))
+WRITE_BATCH_SIZE = int(os.getenv("WRITE_BATCH_SIZE", "32"))
+WRITE_TIMEOUT = float(os.getenv("WRITE_TIMEOUT", "30"))
+# пул соединений только для чтения (GET-эндпоинты)
+READ_POOL_SIZE = int(os.getenv("READ_POOL_SIZE", "16"))
+READ_POOL_OVERFLOW = int(os.getenv("READ_POOL_OVERFLOW", "8"))
+# гистограммы задержек по маршрутам и /metrics
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") not in ("0", "false", "no")
+# профилировщик SQL (по умолчанию выключен): Server-Timing, поиск N+1, журнал медленных запросов
+SQL_PROFILE = os.getenv("SQL_PROFILE", "0") not in ("0", "false", "no")
+SQL_SLOW_MS = float(os.getenv("SQL_SLOW_MS", "100"))
+SQL_N_PLUS_ONE = int(os.getenv("SQL_N_PLUS_ONE", "5"))  # столько одинаковых запросов за запрос — подозрение на N+1
+SQL_SLOW_LOG = Path(os.getenv("SQL_SLOW_LOG") or BASE_DIR / "slow_queries.log")
+# сжатие ответов API: порог в байтах и уровень gzip
+GZIP_MIN_SIZE = int(os.getenv("GZIP_MIN_SIZE", "1024"))
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", "5"))
+
+FORECAST_WINDOW_DAYS = int(os.getenv("FORECAST_WINDOW_DAYS", "90"))
+FORECAST_MA_DAYS = int(os.getenv("FORECAST_MA_DAYS", "28"))
+FORECAST_ALPHA = float(os.getenv("FORECAST_ALPHA", "0.3"))
+FORECAST_LEAD_DAYS = float(os.getenv("FORECAST_LEAD_DAYS", "7"))  # срок поставки для точки заказа
+FORECAST_SERVICE_Z = float(os.getenv("FORECAST_SERVICE_Z", "1.65"))  # ~95% уровень обслуживания
+
+REPLENISH_TARGET_FACTOR = float(os.getenv("REPLENISH_TARGET_FACTOR", "2.0"))  # дозаказ до reorder_point × N
+
+STOCK_SNAPSHOT_INTERVAL = float(os.getenv("STOCK_SNAPSHOT_INTERVAL", "3600"))  # секунд между снимками остатков
+# хранение снимков: за последние KEEP_DAYS — все, до DAILY_DAYS — последний за сутки по площадке, старше — удаляются
+STOCK_SNAPSHOT_KEEP_DAYS = float(os.getenv("STOCK_SNAPSHOT_KEEP_DAYS", "7"))
+STOCK_SNAPSHOT_DAILY_DAYS = float(os.getenv("STOCK_SNAPSHOT_DAILY_DAYS", "365"))
+
+JOB_DIR = Path(os.getenv("JOB_DIR") or BASE_DIR / "jobs")
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_KEEP_DAYS = float(os.getenv("JOB_KEEP_DAYS", "7"))
+
+# шардирование складского учёта (0 — выключено): остатки, журнал движений и снимки площадки
+# лежат в SHARD_DIR/shard_<site_id % SHARD_COUNT>.db со своим писателем, остальное — в общей базе
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "0"))
+SHARD_DIR = Path(os.getenv("SHARD_DIR") or BASE_DIR / "shards")
+SHARD_MAX = 10  # все шарды подключаются к соединениям общей базы через ATTACH, а SQLite даёт не больше 10
+
+# онлайн-копии базы (app/backup.py): период в секундах (0 — только по запросу), каталог, сколько хранить,
+# порция страниц за шаг backup API и пауза между шагами — чтобы копия не отнимала диск у писателя
+BACKUP_INTERVAL = float(os.getenv("BACKUP_INTERVAL", "0"))
+BACKUP_DIR = Path(os.getenv("BACKUP_DIR") or BASE_DIR / "backups")
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", "7"))
+BACKUP_STEP_PAGES = int(os.getenv("BACKUP_STEP_PAGES", "256"))
+BACKUP_STEP_PAUSE_MS = float(os.getenv("BACKUP_STEP_PAUSE_MS", "20"))
+
 # ---- DB Models ----
 class User(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
@@ -40,11 +131,13 @@ class Site(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
     name: str
     region: str
+    rev: Optional[int] = Field(default=None, index=True)  # ревизия для /changes, ставит триггер
 
 
 class EquipmentType(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
     name: str
+    pm_interval_days: Optional[int] = None  # периодичность планового ТО, дней
 
 
 class Equipment(SQLModel, table=True):
@@ -55,6 +148,8 @@ class Equipment(SQLModel, table=True):
     name: str
     status: str = "active"
     commissioning_date: date
+    pm_interval_days: Optional[int] = None  # своя периодичность ТО, перекрывает тип
+    rev: Optional[int] = Field(default=None, index=True)  # ревизия для /changes, ставит триггер
 
 
 class Material(SQLModel, table=True):
@@ -63,16 +158,54 @@ class Material(SQLModel, table=True):
     unit: str
     description: Optional[str] = None
     reject_percent: Optional[float] = 0.0
+    preferred_supplier_id: Optional[int] = Field(default=None, foreign_key="supplier.id")
+    rev: Optional[int] = Field(default=None, index=True)  # ревизия для /changes, ставит триггер
 
 
 class Inventory(SQLModel, table=True):
+    # частичный индекс = множество позиций ниже точки заказа; SQLite ведёт его
+    # тем же UPDATE, что меняет остаток
+    __table_args__ = (
+        Index("ix_inventory_low", "site_id", "material_id", sqlite_where=text("qty_on_hand < reorder_point")),
+    )
     site_id: int = Field(foreign_key="site.id", primary_key=True)
     material_id: int = Field(foreign_key="material.id", primary_key=True)
     qty_on_hand: float = 0.0
     reorder_point: float = 0.0
 
 
+class StockMove(SQLModel, table=True):
+    """Журнал движений запаса, только дозапись: qty со знаком, расход отрицательный."""
+    # дельты площадки после снимка: site_id = ? AND id > last_move_id
+    __table_args__ = (Index("ix_stockmove_site", "site_id", "id"),)
+    id: Optional[int] = Field(default=None, primary_key=True)
+    site_id: int = Field(foreign_key="site.id")
+    material_id: int = Field(foreign_key="material.id")
+    kind: str  # reserve/consume/add/adjust
+    qty: float
+    created_at: datetime = Field(default_factory=datetime.utcnow, index=True)
+
+
+class StockSnapshot(SQLModel, table=True):
+    __table_args__ = (Index("ix_stocksnapshot_site", "site_id", "taken_at"),)
+    id: Optional[int] = Field(default=None, primary_key=True)
+    site_id: int = Field(foreign_key="site.id")
+    taken_at: datetime
+    last_move_id: int = 0  # последнее движение журнала, уже вошедшее в снимок
+
+
+class StockSnapshotLine(SQLModel, table=True):
+    snapshot_id: int = Field(foreign_key="stocksnapshot.id", primary_key=True)
+    material_id: int = Field(foreign_key="material.id", primary_key=True)
+    qty: float
+
+
 class WorkOrder(SQLModel, table=True):
+    # последнее плановое ТО станка — якорь для генератора ППР
+    __table_args__ = (
+        Index("ix_workorder_pm", "equipment_id", "type", "planned_date"),
+        Index("ix_workorder_created", "created_at", "id"),  # постраничный список, новые сверху
+    )
     id: Optional[int] = Field(default=None, primary_key=True)
     site_id: int = Field(foreign_key="site.id")
     type: str  # corrective/preventive
@@ -84,6 +217,7 @@ class WorkOrder(SQLModel, table=True):
     planned_date: Optional[date] = None
     assigned_team: Optional[str] = None
     created_at: datetime = Field(default_factory=datetime.utcnow)
+    rev: Optional[int] = Field(default=None, index=True)  # ревизия для /changes, ставит триггер
 
 
 class WorkOrderMaterial(SQLModel, table=True):
@@ -94,6 +228,20 @@ class WorkOrderMaterial(SQLModel, table=True):
     qty_fact: float = 0.0
 
 
+class WorkOrderStatusHistory(SQLModel, table=True):
+    """Переходы статуса заявки; from_status пуст, если прежний статус неизвестен."""
+    __table_args__ = (
+        Index("ix_wostatus_wo", "work_order_id", "changed_at"),
+        Index("ix_wostatus_to", "to_status", "work_order_id", "changed_at"),
+    )
+    id: Optional[int] = Field(default=None, primary_key=True)
+    work_order_id: int = Field(foreign_key="workorder.id")
+    from_status: Optional[str] = None
+    to_status: str
+    changed_at: datetime = Field(default_factory=datetime.utcnow)
+    user_id: Optional[int] = Field(default=None, foreign_key="user.id")
+
+
 class WorkOrderComment(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
     work_order_id: int = Field(foreign_key="workorder.id")
@@ -107,6 +255,7 @@ class ProductionPlan(SQLModel, table=True):
     site_id: int = Field(foreign_key="site.id")
     period: str  # '2025-11'
     status: str  # draft/published
+    rev: Optional[int] = Field(default=None, index=True)  # ревизия для /changes, ставит триггер
 
 
 class PlanItem(SQLModel, table=True):
@@ -116,10 +265,19 @@ class PlanItem(SQLModel, table=True):
     quantity: int
 
 
+class ProductMaterial(SQLModel, table=True):
+    """Спецификация (BOM): сколько материала уходит на единицу продукции из плана."""
+    id: Optional[int] = Field(default=None, primary_key=True)
+    product_name: str = Field(index=True)
+    material_id: int = Field(foreign_key="material.id")
+    qty_per_unit: float = 0.0
+
+
 class Supplier(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
     name: str
     contact: Optional[str] = None
+    rev: Optional[int] = Field(default=None, index=True)  # ревизия для /changes, ставит триггер
 
 
 class PurchaseOrder(SQLModel, table=True):
@@ -129,9 +287,36 @@ class PurchaseOrder(SQLModel, table=True):
     status: str = "draft"  # draft/in_progress/done/cancelled
     comment: Optional[str] = None
     created_at: datetime = Field(default_factory=datetime.utcnow)
+    rev: Optional[int] = Field(default=None, index=True)  # ревизия для /changes, ставит триггер
+
+
+class PurchaseOrderLine(SQLModel, table=True):
+    id: Optional[int] = Field(default=None, primary_key=True)
+    purchase_order_id: int = Field(foreign_key="purchaseorder.id", index=True)
+    material_id: int = Field(foreign_key="material.id", index=True)
+    qty: float = 0.0
+    qty_received: float = 0.0
+
+
+class SyncState(SQLModel, table=True):
+    """Счётчик ревизий для /changes (одна строка). epoch меняется, если счётчик начат заново."""
+    id: Optional[int] = Field(default=None, primary_key=True)
+    epoch: str
+    revision: int = 0
+
+
+class Tombstone(SQLModel, table=True):
+    """След удалённой строки синхронизируемой таблицы."""
+    id: Optional[int] = Field(default=None, primary_key=True)
+    rev: int = Field(index=True)
+    entity: str
+    row_id: int
+    deleted_at: datetime = Field(default_factory=datetime.utcnow)
 
 
 class Event(SQLModel, table=True):
+    # лента: по паре (type, severity) события идут в порядке времени — см. get_events
+    __table_args__ = (Index("ix_event_feed", "type", "severity", "created_at", "id"),)
     id: Optional[int] = Field(default=None, primary_key=True)
     type: str
     text: str
@@ -140,11 +325,635 @@ class Event(SQLModel, table=True):
     meta: Optional[str] = None
 
 
-engine = create_engine(f"sqlite:///{DB_PATH}", echo=False, connect_args={"check_same_thread": False})
+class TimedQueuePool(QueuePool):
+    """QueuePool, который считает выдачи соединений и суммарное ожидание свободного."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkouts_total = 0
+        self.wait_seconds_total = 0.0
+
+    def _do_get(self):
+        t0 = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            self.checkouts_total += 1
+            self.wait_seconds_total += time.perf_counter() - t0
+
+
+engine = create_engine(f"sqlite:///{DB_PATH}", echo=False, connect_args={"check_same_thread": False},
+                       poolclass=TimedQueuePool)
+
+# складские таблицы, которые в режиме шардирования живут в файлах шардов
+LEDGER_TABLES = ("inventory", "stockmove", "stocksnapshot", "stocksnapshotline")
+
+
+def shard_path(k: int) -> Path:
+    return SHARD_DIR / f"shard_{k}.db"
+
+
+def _attach_shards(dbapi_conn):
+    """Подключить шарды склада только на чтение и закрыть складские таблицы общей базы
+    временными представлениями UNION ALL: temp ищется раньше main, поэтому прежние запросы
+    (отчёты, MRP, автопополнение) читают склад всех шардов, ничего не зная о них.
+
+    mode=ro важен и для писателя общей базы: его BEGIN IMMEDIATE берёт блокировку записи
+    во всех подключённых базах, кроме открытых только на чтение.
+    """
+    cur = dbapi_conn.cursor()
+    for k in range(SHARD_COUNT):
+        cur.execute(f"ATTACH DATABASE ? AS s{k}", (f"file:{shard_path(k)}?mode=ro",))
+    for t in LEDGER_TABLES:
+        cur.execute(f"CREATE TEMP VIEW {t} AS " +
+                    " UNION ALL ".join(f"SELECT * FROM s{k}.{t}" for k in range(SHARD_COUNT)))
+    cur.close()
+
+
+# Отдельный движок для потока-писателя: pysqlite сам не умеет SAVEPOINT внутри
+# неявной транзакции, поэтому BEGIN выдаём явно (рецепт из документации SQLAlchemy).
+# URI-имя — чтобы ATTACH шардов понимал ?mode=ro.
+writer_engine = create_engine(f"sqlite:///file:{DB_PATH}?uri=true", echo=False,
+                              connect_args={"check_same_thread": False},
+                              poolclass=TimedQueuePool, pool_size=1, max_overflow=0)
+
+
+@event.listens_for(writer_engine, "connect")
+def _writer_connect(dbapi_conn, _record):
+    dbapi_conn.isolation_level = None
+    cur = dbapi_conn.cursor()
+    cur.execute("PRAGMA journal_mode=WAL")  # читатели не блокируют писателя
+    cur.execute("PRAGMA synchronous=NORMAL")
+    cur.close()
+    if SHARD_COUNT:
+        _attach_shards(dbapi_conn)
+
+
+@event.listens_for(writer_engine, "begin")
+def _writer_begin(conn):
+    conn.exec_driver_sql("BEGIN IMMEDIATE")
+
+
+WriteUnit = Callable[[Session], Any]
+# сессия единицы записи, которая сейчас выполняется в потоке писателя, и отложенные до COMMIT действия
+WRITER_SESSION: ContextVar[Optional[Session]] = ContextVar("writer_session", default=None)
+AFTER_COMMIT: ContextVar[Optional[List[Callable[[], Any]]]] = ContextVar("after_commit", default=None)
+# писатель, чья единица сейчас выполняется, и события единицы шарда, ждущие COMMIT
+UNIT_WRITER: ContextVar[Optional["DbWriter"]] = ContextVar("unit_writer", default=None)
+EVENT_OUTBOX: ContextVar[Optional[List[Event]]] = ContextVar("event_outbox", default=None)
+
+
+class DbWriter:
+    """Единственный писатель в SQLite.
+
+    Эндпоинты не коммитят сами, а отдают функцию-«единицу записи» в очередь.
+    Поток-писатель держит одно соединение, выбирает из очереди всё, что накопилось
+    (не больше WRITE_BATCH_SIZE), выполняет каждую единицу в своём SAVEPOINT
+    и фиксирует группу одним COMMIT. Ошибка одной единицы откатывает только её.
+
+    Заодно ведёт версии таблиц: после каждого COMMIT счётчик таблиц, в которые
+    писала группа, растёт — по ним кэши на стороне чтения понимают, что устарели.
+
+    run() изнутри единицы записи (пакет /batch вызывает обычные обработчики) не
+    ставит новую единицу в очередь, а выполняет её на месте в своём SAVEPOINT.
+    """
+
+    _versions_lock = threading.Lock()  # версии таблиц бывают общими у нескольких писателей (шарды)
+
+    def __init__(self, eng, maxsize: int, batch_size: int, versions: Optional[Dict[str, int]] = None):
+        self.engine = eng
+        self.batch_size = batch_size
+        self.queue: "queue.Queue[Optional[Tuple[WriteUnit, Future, Context]]]" = queue.Queue(maxsize=maxsize)
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self.units_total = 0
+        self.units_failed = 0
+        self.batches_total = 0
+        self.table_versions: Dict[str, int] = {} if versions is None else versions
+        self.touched: set = set()  # таблицы, затронутые текущей группой (пишет только поток писателя)
+
+    def version(self, *tables: str) -> Tuple[int, ...]:
+        return tuple(self.table_versions.get(t, 0) for t in tables)
+
+    def start(self):
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._loop, name="db-writer", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        with self._lock:
+            th, self._thread = self._thread, None
+        if th and th.is_alive():
+            self.queue.put(None)
+            th.join()
+
+    def submit(self, fn: WriteUnit) -> Future:
+        self.start()
+        fut: Future = Future()
+        try:
+            # контекст вызывающего запроса (профилировщик SQL) переезжает в поток писателя
+            self.queue.put_nowait((fn, fut, copy_context()))
+        except queue.Full:
+            raise HTTPException(status_code=503, detail="Сервер перегружен, повторите запрос позже",
+                                headers={"Retry-After": "1"})
+        return fut
+
+    def run(self, fn: WriteUnit, timeout: float = WRITE_TIMEOUT):
+        """Поставить единицу записи в очередь и дождаться её результата (или исключения)."""
+        s = WRITER_SESSION.get()
+        if s is not None:
+            if UNIT_WRITER.get() is not self:
+                raise HTTPException(status_code=409, detail="Запись идёт через другой писатель (шард склада) "
+                                                            "и не может войти в текущую транзакцию")
+            with s.begin_nested():
+                return self._run_unit(s, fn)
+        return self.wait(self.submit(fn), timeout)
+
+    @staticmethod
+    def wait(fut: Future, timeout: float = WRITE_TIMEOUT):
+        """Результат единицы. Не дождались — снимаем её из очереди, чтобы повтор клиента
+        не записал то же самое второй раз; если писатель уже взял её, ждём до конца."""
+        try:
+            return fut.result(timeout)
+        except FutureTimeout:
+            if fut.cancel():  # _commit_batch пропускает отменённые
+                raise HTTPException(status_code=503, detail="Сервер перегружен, повторите запрос позже",
+                                    headers={"Retry-After": "1"})
+            return fut.result()
+
+    def _loop(self):
+        with self.engine.connect() as conn:
+            stop = False
+            while not stop:
+                first = self.queue.get()
+                if first is None:
+                    break
+                batch = [first]
+                while len(batch) < self.batch_size:
+                    try:
+                        nxt = self.queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if nxt is None:
+                        stop = True
+                        break
+                    batch.append(nxt)
+                self._commit_batch(conn, batch)
+
+    @staticmethod
+    def _run_unit(s: Session, fn: WriteUnit):
+        res = fn(s)
+        s.flush()
+        return res
+
+    def _run_top_unit(self, s: Session, fn: WriteUnit):
+        WRITER_SESSION.set(s)
+        UNIT_WRITER.set(self)
+        AFTER_COMMIT.set([])
+        return self._run_unit(s, fn), AFTER_COMMIT.get()
+
+    @staticmethod
+    def in_unit() -> bool:
+        return WRITER_SESSION.get() is not None
+
+    @staticmethod
+    def defer(fn: Callable[..., Any], *args):
+        """Выполнить fn(*args) после COMMIT текущей единицы записи (или сразу, если её нет)."""
+        pending = AFTER_COMMIT.get()
+        if pending is None:
+            fn(*args)
+        else:
+            pending.append(lambda: fn(*args))
+
+    def _commit_batch(self, conn, batch: List[Tuple[WriteUnit, Future, Context]]):
+        done: List[Tuple[Future, Any, List[Callable[[], Any]]]] = []
+        with Session(bind=conn, expire_on_commit=False) as s:
+            for fn, fut, ctx in batch:
+                if not fut.set_running_or_notify_cancel():
+                    continue
+                sp = s.begin_nested()
+                try:
+                    res, after = ctx.run(self._run_top_unit, s, fn)
+                    sp.commit()
+                except BaseException as exc:
+                    sp.rollback()
+                    fut.set_exception(exc)
+                    self.units_failed += 1
+                else:
+                    done.append((fut, res, after))
+                self.units_total += 1
+            self.batches_total += 1
+            try:
+                s.commit()
+            except Exception as exc:
+                s.rollback()
+                self.touched.clear()
+                for fut, _, _ in done:
+                    fut.set_exception(exc)
+                return
+        with self._versions_lock:
+            for t in self.touched:
+                self.table_versions[t] = self.table_versions.get(t, 0) + 1
+        self.touched.clear()
+        for fut, res, after in done:
+            for action in after:
+                try:
+                    action()
+                except Exception:
+                    logging.getLogger("cpvp.writer").exception("Ошибка действия после COMMIT")
+            fut.set_result(res)
+
+
+DB_WRITER = DbWriter(writer_engine, WRITE_QUEUE_SIZE, WRITE_BATCH_SIZE)
+
+_WRITE_TABLE = re.compile(r'^\s*(?:INSERT(?:\s+OR\s+\w+)?\s+INTO|UPDATE(?:\s+OR\s+\w+)?|DELETE\s+FROM)\s+"?(\w+)', re.I)
+
+
+@event.listens_for(writer_engine, "before_cursor_execute")
+def _writer_statement(conn, cursor, statement, parameters, context, executemany):
+    m = _WRITE_TABLE.match(statement)
+    if m:
+        DB_WRITER.touched.add(m.group(1).lower())
+
+
+class ShardWriter(DbWriter):
+    """Писатель шарда склада. Таблицы event в шарде нет: события единицы копятся
+    и после её COMMIT уходят писателю общей базы (не дожидаясь его)."""
+
+    def _run_top_unit(self, s: Session, fn: WriteUnit):
+        events: List[Event] = []
+        EVENT_OUTBOX.set(events)
+        res, after = super()._run_top_unit(s, fn)
+        if events:
+            after.append(lambda: DB_WRITER.submit(lambda gs: gs.add_all(events)))
+        return res, after
+
+
+class LedgerShards:
+    """Складской учёт по площадкам в отдельных файлах SQLite (SHARD_COUNT > 0).
+
+    У каждого шарда свой писатель, поэтому движения запаса разных заводов коммитятся
+    параллельно и не стоят в общей очереди. Соединения общей базы подключают шарды
+    только на чтение (см. _attach_shards), а сами шарды — общую базу как g, тоже только
+    на чтение. Писать в складские таблицы можно лишь через writer(site_id); без шардов
+    всё сводится к DB_WRITER и main.
+    """
+
+    def __init__(self, count: int):
+        self.count = count
+        self.engines = [self._engine(k) for k in range(count)]
+        self.writers = [ShardWriter(e, WRITE_QUEUE_SIZE, WRITE_BATCH_SIZE, DB_WRITER.table_versions)
+                        for e in self.engines]
+        self._pool = ThreadPoolExecutor(max_workers=count, thread_name_prefix="shard-read") if count else None
+
+    def _engine(self, k: int):
+        eng = create_engine(f"sqlite:///file:{shard_path(k)}?uri=true", echo=False,
+                            connect_args={"check_same_thread": False},
+                            poolclass=TimedQueuePool, pool_size=1, max_overflow=0)
+
+        @event.listens_for(eng, "connect")
+        def _connect(dbapi_conn, _record):
+            dbapi_conn.isolation_level = None
+            cur = dbapi_conn.cursor()
+            cur.execute("PRAGMA journal_mode=WAL")
+            cur.execute("PRAGMA synchronous=NORMAL")
+            cur.execute("ATTACH DATABASE ? AS g", (f"file:{DB_PATH}?mode=ro",))
+            cur.close()
+
+        @event.listens_for(eng, "begin")
+        def _begin(conn):
+            conn.exec_driver_sql("BEGIN IMMEDIATE")
+
+        @event.listens_for(eng, "before_cursor_execute")
+        def _statement(conn, cursor, statement, parameters, context, executemany):
+            m = _WRITE_TABLE.match(statement)
+            if m:
+                self.writers[k].touched.add(m.group(1).lower())
+
+        return eng
+
+    def shard(self, site_id: int) -> int:
+        return site_id % self.count
+
+    def writer(self, site_id: int) -> DbWriter:
+        return self.writers[self.shard(site_id)] if self.count else DB_WRITER
+
+    def schema(self, site_id: int) -> str:
+        """Схема складских таблиц площадки в соединении общей базы."""
+        return f"s{self.shard(site_id)}" if self.count else "main"
+
+    def schemas(self) -> List[str]:
+        return [f"s{k}" for k in range(self.count)] or ["main"]
+
+    def run_many(self, units: List[Tuple[DbWriter, WriteUnit]]) -> List[Any]:
+        """Единицы на разных писателях — параллельно; каждая атомарна только в своём шарде."""
+        if len(units) == 1:
+            return [units[0][0].run(units[0][1])]
+        if DbWriter.in_unit():
+            raise HTTPException(status_code=409, detail="Запись затрагивает несколько шардов склада "
+                                                        "и не может войти в текущую транзакцию")
+        futs = [w.submit(fn) for w, fn in units]
+        errors = []
+        results = []
+        for f in futs:
+            try:
+                results.append(DbWriter.wait(f))
+            except Exception as exc:
+                errors.append(exc)
+        if errors:
+            raise errors[0]
+        return results
+
+    def fanout(self, fn: Callable[[Any, str], Any]) -> List[Any]:
+        """fn(conn, schema) по каждому шарду параллельно, у каждого — своё соединение чтения."""
+        def one(schema: str):
+            with read_engine.connect() as conn:
+                return fn(conn, schema)
+
+        if not self._pool:
+            return [one("main")]
+        return list(self._pool.map(one, self.schemas()))
+
+    def stop(self):
+        for w in self.writers:
+            w.stop()
+
+# Движок для чтения: файл открыт в mode=ro, плюс query_only — GET-обработчики
+# физически не могут писать и не занимают соединения писателя.
+read_engine = create_engine(
+    f"sqlite:///file:{DB_PATH}?mode=ro&uri=true",
+    echo=False,
+    connect_args={"check_same_thread": False},
+    poolclass=TimedQueuePool,
+    pool_size=READ_POOL_SIZE,
+    max_overflow=READ_POOL_OVERFLOW,
+)
+
+
+@event.listens_for(read_engine, "connect")
+def _reader_connect(dbapi_conn, _record):
+    if SHARD_COUNT:
+        _attach_shards(dbapi_conn)  # до query_only: временные представления — тоже запись
+    cur = dbapi_conn.cursor()
+    cur.execute("PRAGMA query_only=ON")
+    cur.close()
+
+
+SHARDS = LedgerShards(SHARD_COUNT)
+
+
+# ---- SQL profiler ----
+class RequestProfile:
+    __slots__ = ("queries", "seconds", "shapes")
+
+    def __init__(self):
+        self.queries = 0
+        self.seconds = 0.0
+        self.shapes: Dict[str, int] = {}
+
+    def suspects(self) -> List[Tuple[str, int]]:
+        return sorted(((sh, n) for sh, n in self.shapes.items() if n >= SQL_N_PLUS_ONE), key=lambda x: -x[1])
+
+
+SQL_REQUEST_PROFILE: ContextVar[Optional[RequestProfile]] = ContextVar("sql_request_profile", default=None)
+_IN_LIST = re.compile(r"\(\?(?:,\s*\?)+\)")
+sql_log = logging.getLogger("cpvp.sql")
+slow_sql_log = logging.getLogger("cpvp.sql.slow")
+stock_log = logging.getLogger("cpvp.stock")
+
+
+def statement_shape(statement: str) -> str:
+    """Форма запроса: параметры уже вынесены в «?», сворачиваем только IN (?, ?, ...)."""
+    return _IN_LIST.sub("(?...)", " ".join(statement.split()))
+
+
+def _sql_before(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("sql_t0", []).append(time.perf_counter())
+
+
+def _sql_after(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["sql_t0"].pop()
+    prof = SQL_REQUEST_PROFILE.get()
+    if prof is not None:
+        prof.queries += 1
+        prof.seconds += elapsed
+        shape = statement_shape(statement)
+        prof.shapes[shape] = prof.shapes.get(shape, 0) + 1
+    if elapsed * 1000 >= SQL_SLOW_MS:
+        plan = ""
+        if not executemany:
+            try:
+                cur = cursor.connection.cursor()
+                plan = "; ".join(r[-1] for r in cur.execute("EXPLAIN QUERY PLAN " + statement, parameters or ()))
+                cur.close()
+            except Exception as exc:  # план — подсказка, а не повод ронять запрос
+                plan = f"<нет плана: {exc}>"
+        slow_sql_log.warning("%.1f ms | %s | params=%r | plan: %s",
+                             elapsed * 1000, " ".join(statement.split()), parameters, plan)
+
+
+class SqlProfilerMiddleware:
+    """Счётчик запросов и времени БД на HTTP-запрос: заголовок Server-Timing и предупреждение о N+1.
+
+    Время — это выполнение курсора (execute); выборка строк в него не входит.
+    """
+
+    def __init__(self, asgi_app):
+        self.app = asgi_app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        prof = RequestProfile()
+        token = SQL_REQUEST_PROFILE.set(prof)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                timing = f'db;dur={prof.seconds * 1000:.2f};desc="{prof.queries} queries"'
+                suspects = prof.suspects()
+                if suspects:
+                    timing += f', db-n1;desc="{len(suspects)} repeated shapes"'
+                    for shape, n in suspects:
+                        sql_log.warning("Подозрение на N+1: %s %s — %d раз: %s",
+                                        scope["method"], scope["path"], n, shape)
+                message.setdefault("headers", [])
+                message["headers"] = list(message["headers"]) + [(b"server-timing", timing.encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            SQL_REQUEST_PROFILE.reset(token)
+
+
+if SQL_PROFILE:
+    for _eng in (engine, writer_engine, read_engine):
+        event.listen(_eng, "before_cursor_execute", _sql_before)
+        event.listen(_eng, "after_cursor_execute", _sql_after)
+    SQL_SLOW_LOG.parent.mkdir(parents=True, exist_ok=True)
+    _slow_handler = logging.handlers.RotatingFileHandler(SQL_SLOW_LOG, maxBytes=10 * 1024 * 1024,
+                                                         backupCount=5, encoding="utf-8")
+    _slow_handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+    slow_sql_log.addHandler(_slow_handler)
+    slow_sql_log.propagate = False
+
+
+def db_pool_stats() -> Dict[str, Dict[str, int]]:
+    """Состояние пулов: сколько соединений выдано и сколько свободно."""
+    out = {}
+    for name, eng in (("read", read_engine), ("write", writer_engine), ("default", engine)):
+        pool = eng.pool
+        out[name] = {
+            "size": pool.size(),
+            "checked_out": pool.checkedout(),
+            "checked_in": pool.checkedin(),
+            "overflow": pool.overflow(),
+            "checkouts_total": getattr(pool, "checkouts_total", 0),
+            "wait_seconds_total": getattr(pool, "wait_seconds_total", 0.0),
+        }
+    return out
+
+
+# meta событий раньше писался repr-ом словаря; для простых словарей из id и статусов
+# замена кавычек превращает его в JSON, так что старая история тоже учитывается
+_EVENT_META_JSON = "CASE WHEN json_valid(meta) THEN meta ELSE replace(meta, '''', '\"') END"
+
+
+def ensure_columns(eng=engine, tables=None):
+    """create_all не добавляет колонки в существующие таблицы — дописываем новые nullable-поля."""
+    with eng.begin() as conn:
+        for table in tables or SQLModel.metadata.sorted_tables:
+            have = {row[1] for row in conn.exec_driver_sql(f'PRAGMA table_info("{table.name}")')}
+            for col in table.columns:
+                if col.name not in have and col.nullable:
+                    ddl = CreateColumn(col).compile(dialect=eng.dialect)
+                    conn.exec_driver_sql(f'ALTER TABLE "{table.name}" ADD COLUMN {ddl}')
+
+
+def ensure_indexes(eng=engine, tables=None):
+    """create_all не трогает уже существующие таблицы — досоздаём их новые индексы."""
+    with eng.begin() as conn:
+        for table in tables or SQLModel.metadata.sorted_tables:
+            for idx in table.indexes:
+                idx.create(conn, checkfirst=True)
+
+
+def backfill_status_history():
+    """Однократно восстановить историю статусов из журнала событий (для баз, где её ещё не было)."""
+    with engine.begin() as conn:
+        if conn.exec_driver_sql("SELECT 1 FROM workorderstatushistory LIMIT 1").first():
+            return
+        conn.exec_driver_sql(f"""
+            INSERT INTO workorderstatushistory (work_order_id, from_status, to_status, changed_at)
+            SELECT wid, prev, st, created_at FROM (
+                SELECT wid, LAG(st) OVER (PARTITION BY wid ORDER BY created_at, id) AS prev, st, created_at FROM (
+                    SELECT id, created_at, CAST(json_extract(m, '$.work_order_id') AS INTEGER) AS wid,
+                           CASE type WHEN 'work_order_dispatch' THEN 'in_progress'
+                                     ELSE json_extract(m, '$.status') END AS st
+                    FROM (SELECT id, type, created_at, {_EVENT_META_JSON} AS m FROM event
+                          WHERE type IN ('work_order_status', 'work_order_dispatch'))
+                    WHERE json_valid(m))
+                WHERE st IS NOT NULL AND wid IN (SELECT id FROM workorder))
+            WHERE prev IS NULL OR prev <> st""")
+
+
+# сущность /changes -> таблица; у каждой есть колонка rev
+SYNC_ENTITIES = {"sites": "site", "equipment": "equipment", "materials": "material", "suppliers": "supplier",
+                 "workorders": "workorder", "purchase_orders": "purchaseorder", "plans": "productionplan"}
+_NEXT_REV = "UPDATE syncstate SET revision = revision + 1 WHERE id = 1"
+_CUR_REV = "(SELECT revision FROM syncstate WHERE id = 1)"
+
+
+def ensure_sync():
+    """Триггеры ревизий: любая вставка/изменение строки получает следующую ревизию, удаление — tombstone.
+
+    Триггеры, а не код обработчиков, чтобы ревизию получали и массовые INSERT ... SELECT
+    (генератор ППР, автозаказ) и внешние загрузчики вроде datagen. Строки, которые
+    существовали до появления колонки rev, нумеруются один раз: rev = база + id.
+    """
+    with engine.begin() as conn:
+        conn.exec_driver_sql("INSERT OR IGNORE INTO syncstate (id, epoch, revision) VALUES (1, ?, 0)",
+                             (secrets.token_hex(4),))
+        for entity, t in SYNC_ENTITIES.items():
+            conn.exec_driver_sql(f"""
+                CREATE TRIGGER IF NOT EXISTS sync_{t}_ins AFTER INSERT ON "{t}" BEGIN
+                    {_NEXT_REV};
+                    UPDATE "{t}" SET rev = {_CUR_REV} WHERE id = NEW.id;
+                END""")
+            conn.exec_driver_sql(f"""
+                CREATE TRIGGER IF NOT EXISTS sync_{t}_upd AFTER UPDATE ON "{t}" WHEN NEW.rev IS OLD.rev BEGIN
+                    {_NEXT_REV};
+                    UPDATE "{t}" SET rev = {_CUR_REV} WHERE id = NEW.id;
+                END""")
+            conn.exec_driver_sql(f"""
+                CREATE TRIGGER IF NOT EXISTS sync_{t}_del AFTER DELETE ON "{t}" BEGIN
+                    {_NEXT_REV};
+                    INSERT INTO tombstone (rev, entity, row_id, deleted_at)
+                    VALUES ({_CUR_REV}, '{entity}', OLD.id, strftime('%Y-%m-%d %H:%M:%f', 'now'));
+                END""")
+            top = conn.exec_driver_sql(f'SELECT MAX(id) FROM "{t}" WHERE rev IS NULL').scalar()
+            if top is not None:
+                base = conn.exec_driver_sql("SELECT revision FROM syncstate WHERE id = 1").scalar()
+                conn.exec_driver_sql(f'UPDATE "{t}" SET rev = ? + id WHERE rev IS NULL', (base,))
+                conn.exec_driver_sql("UPDATE syncstate SET revision = ? WHERE id = 1", (base + top,))
+
+
+SHARD_MARKER = SHARD_DIR / "shards.json"
+
+
+def ensure_shards():
+    """Создать файлы шардов склада и перенести в них складские строки из общей базы.
+
+    Перенос идёт при первом запуске с SHARD_COUNT (и подбирает строки, которые посев
+    мог снова положить в общую базу). Число шардов запоминается в shards.json: строки уже
+    разложены по site_id % SHARD_COUNT, перераспределение при смене числа не поддерживается.
+    """
+    if not SHARD_COUNT:
+        if SHARD_MARKER.exists():
+            raise RuntimeError(f"Склад разнесён по шардам в {SHARD_DIR}: запустите с SHARD_COUNT из shards.json")
+        return
+    if not 0 < SHARD_COUNT <= SHARD_MAX:
+        raise RuntimeError(f"SHARD_COUNT должен быть от 1 до {SHARD_MAX}")
+    if SHARD_MARKER.exists():
+        was = json.loads(SHARD_MARKER.read_text())["count"]
+        if was != SHARD_COUNT:
+            raise RuntimeError(f"Склад уже разнесён на {was} шардов, SHARD_COUNT={SHARD_COUNT} не подходит")
+    SHARD_DIR.mkdir(parents=True, exist_ok=True)
+    tables = [SQLModel.metadata.tables[t] for t in LEDGER_TABLES]
+    for eng in SHARDS.engines:
+        SQLModel.metadata.create_all(eng, tables=tables)
+        ensure_columns(eng, tables)
+        ensure_indexes(eng, tables)
+    with engine.connect() as conn:
+        for k in range(SHARD_COUNT):
+            conn.exec_driver_sql(f"ATTACH DATABASE ? AS s{k}", (str(shard_path(k)),))
+        conn.commit()
+        try:
+            with conn.begin():
+                for k in range(SHARD_COUNT):
+                    own = f"site_id % {SHARD_COUNT} = {k}"
+                    where = {"stocksnapshotline": f"snapshot_id IN (SELECT id FROM main.stocksnapshot WHERE {own})"}
+                    for t in LEDGER_TABLES:
+                        cols = ", ".join(c.name for c in SQLModel.metadata.tables[t].columns)
+                        conn.exec_driver_sql(f"INSERT OR IGNORE INTO s{k}.{t} ({cols}) "
+                                             f"SELECT {cols} FROM main.{t} WHERE {where.get(t, own)}")
+                for t in reversed(LEDGER_TABLES):
+                    conn.exec_driver_sql(f"DELETE FROM main.{t}")
+        finally:
+            for k in range(SHARD_COUNT):
+                conn.exec_driver_sql(f"DETACH DATABASE s{k}")
+            conn.commit()
+    SHARD_MARKER.write_text(json.dumps({"count": SHARD_COUNT}))
 
 
 def create_db_and_seed():
     SQLModel.metadata.create_all(engine)
+    ensure_columns()
+    ensure_indexes()
+    ensure_sync()
+    backfill_status_history()
     with Session(engine) as s:
         # seed roles
         if not s.exec(select(Role)).all():
@@ -172,8 +981,8 @@ def create_db_and_seed():
         # seed equipment types
         if not s.exec(select(EquipmentType)).all():
             s.add_all([
-                EquipmentType(name="Дробильная машина"),
-                EquipmentType(name="Конвейер")
+                EquipmentType(name="Дробильная машина", pm_interval_days=90),
+                EquipmentType(name="Конвейер", pm_interval_days=30)
             ])
         s.commit()
         # seed equipment
@@ -207,10 +1016,10 @@ def create_db_and_seed():
                 Material(name="Ремень приводной", unit="pcs", reject_percent=1.0),
             ])
         s.commit()
-        # seed inventory
+        # seed inventory (склад, уже разнесённый по шардам, посев не трогает)
         mats = s.exec(select(Material)).all()
         sites = s.exec(select(Site)).all()
-        for si in sites:
+        for si in ([] if SHARD_MARKER.exists() else sites):
             for m in mats:
                 if not s.get(Inventory, (si.id, m.id)):
                     s.add(Inventory(
@@ -255,6 +1064,16 @@ def create_db_and_seed():
                 PlanItem(plan_id=p.id, product_name="Редуктор RX", quantity=120),
                 PlanItem(plan_id=p.id, product_name="Вал 40Х", quantity=60),
             ])
+        # seed BOM
+        if not s.exec(select(ProductMaterial)).all():
+            bearing = s.exec(select(Material).where(Material.name == "Подшипник 6206")).first()
+            belt = s.exec(select(Material).where(Material.name == "Ремень приводной")).first()
+            if bearing and belt:
+                s.add_all([
+                    ProductMaterial(product_name="Редуктор RX", material_id=bearing.id, qty_per_unit=2),
+                    ProductMaterial(product_name="Редуктор RX", material_id=belt.id, qty_per_unit=1),
+                    ProductMaterial(product_name="Вал 40Х", material_id=bearing.id, qty_per_unit=1),
+                ])
         # seed suppliers & purchase orders
         if not s.exec(select(Supplier)).all():
             s.add_all([
@@ -264,12 +1083,16 @@ def create_db_and_seed():
         s.commit()
         suppliers = s.exec(select(Supplier)).all()
         if suppliers and not s.exec(select(PurchaseOrder)).all():
-            s.add(PurchaseOrder(
+            po = PurchaseOrder(
                 supplier_id=suppliers[0].id,
                 site_id=sites[0].id,
                 status="in_progress",
                 comment="Стартовый заказ под проект."
-            ))
+            )
+            s.add(po)
+            s.commit()
+            s.refresh(po)
+            s.add(PurchaseOrderLine(purchase_order_id=po.id, material_id=mats[0].id, qty=100))
         # seed events
         if not s.exec(select(Event)).all():
             s.add_all([
@@ -278,9 +1101,12 @@ def create_db_and_seed():
                 Event(type="work_order", text="Создан ТОиР #1 (Площадка А)", severity="warning"),
             ])
         s.commit()
+    ensure_shards()
 
 
-create_db_and_seed()
+# процессы пула фоновых задач работают с уже подготовленной базой
+if not os.getenv("CPVP_JOB_WORKER"):
+    create_db_and_seed()
 
 # ---- Auth (very simple cookie) ----
 SESSIONS: Dict[str, int] = {}
@@ -297,7 +1123,56 @@ def current_user_cookie(session: Optional[str] = Cookie(default=None)):
     return SESSIONS[session]
 
 
-app = FastAPI(title="ЦПВП API", version=API_VERSION)
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    DB_WRITER.start()
+    DISPATCH.rebuild()
+    JOBS.start()
+    snapshots = asyncio.create_task(stock_snapshot_loop())
+    backups = asyncio.create_task(backup_loop()) if BACKUP_INTERVAL > 0 else None
+    yield
+    snapshots.cancel()
+    if backups:
+        backups.cancel()
+    JOBS.stop()
+    SHARDS.stop()
+    DB_WRITER.stop()
+
+
+def accepted_encodings(header: str) -> Dict[str, float]:
+    """Accept-Encoding -> {кодировка: q}; кодировки с q=0 клиент явно не принимает."""
+    out: Dict[str, float] = {}
+    for item in header.split(","):
+        coding, _, params = item.partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        out[coding] = q
+    return out
+
+
+class AcceptGZipMiddleware(GZipMiddleware):
+    """GZipMiddleware, который учитывает q: «gzip;q=0» — отказ от gzip, а не согласие на него."""
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            accepted = accepted_encodings(Headers(scope=scope).get("accept-encoding", ""))
+            if accepted.get("gzip", accepted.get("*", 0.0)) > 0:
+                responder = GZipResponder(self.app, self.minimum_size, compresslevel=self.compresslevel)
+                await responder(scope, receive, send)
+                return
+        await self.app(scope, receive, send)
+
+
+app = FastAPI(title="ЦПВП API", version=API_VERSION, lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -305,27 +1180,246 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# JSON-списки (workorders, inventory) жмём на лету; статика уже сжата заранее и не трогается
+app.add_middleware(AcceptGZipMiddleware, minimum_size=GZIP_MIN_SIZE, compresslevel=GZIP_LEVEL)
+
+
+# ---- Static assets ----
+STATIC_MEDIA_TYPES = {".js": "text/javascript; charset=utf-8", ".css": "text/css; charset=utf-8",
+                      ".html": "text/html; charset=utf-8", ".svg": "image/svg+xml", ".png": "image/png",
+                      ".ico": "image/x-icon", ".json": "application/json"}
+STATIC_IMMUTABLE = "public, max-age=31536000, immutable"
+
 
-app.mount("/static", StaticFiles(directory=str(BASE_DIR / "static")), name="static")
+class StaticAsset:
+    """Файл статики в памяти: исходник плюс заранее сжатые варианты и имя с хэшем содержимого."""
+    __slots__ = ("name", "hashed_name", "media_type", "etag", "variants")
+
+    def __init__(self, name: str, raw: bytes):
+        digest = hashlib.sha256(raw).hexdigest()[:12]
+        stem, dot, ext = name.rpartition(".")
+        self.name = name
+        self.hashed_name = f"{stem}.{digest}.{ext}" if dot else f"{name}.{digest}"
+        self.media_type = STATIC_MEDIA_TYPES.get(f".{ext}", "application/octet-stream")
+        self.etag = f'"{digest}"'
+        self.variants: Dict[str, bytes] = {"identity": raw}
+        packed = gzip.compress(raw, compresslevel=9, mtime=0)
+        if len(packed) < len(raw):
+            self.variants["gzip"] = packed
+        if brotli is not None:
+            packed = brotli.compress(raw, quality=11)
+            if len(packed) < len(raw):
+                self.variants["br"] = packed
+
+    def response(self, request: Request, cache_control: str) -> Response:
+        headers = {"ETag": self.etag, "Cache-Control": cache_control, "Vary": "Accept-Encoding"}
+        if request.headers.get("if-none-match") == self.etag:
+            return Response(status_code=304, headers=headers)
+        accepted = accepted_encodings(request.headers.get("accept-encoding", ""))
+        anything = accepted.get("*", 0.0)
+        encoding = next((e for e in ("br", "gzip") if e in self.variants and accepted.get(e, anything) > 0),
+                        "identity")
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        return Response(content=self.variants[encoding], media_type=self.media_type, headers=headers)
+
+
+def load_static_assets() -> Dict[str, StaticAsset]:
+    """Статика по обоим именам: app.js (с ревалидацией) и app.<hash>.js (кэш навсегда)."""
+    assets: Dict[str, StaticAsset] = {}
+    for path in sorted((BASE_DIR / "static").iterdir()):
+        if path.is_file():
+            asset = StaticAsset(path.name, path.read_bytes())
+            assets[asset.name] = assets[asset.hashed_name] = asset
+    return assets
+
+
+def load_index(assets: Dict[str, StaticAsset]) -> StaticAsset:
+    html = (BASE_DIR / "frontend" / "index.html").read_text(encoding="utf-8")
+    for name, asset in assets.items():
+        if name == asset.name:
+            html = html.replace(f'"/static/{name}"', f'"/static/{asset.hashed_name}"')
+    return StaticAsset("index.html", html.encode("utf-8"))
+
+
+STATIC_ASSETS = load_static_assets()
+INDEX_PAGE = load_index(STATIC_ASSETS)
+
+
+@app.get("/static/{name}", include_in_schema=False)
+def static_file(name: str, request: Request):
+    asset = STATIC_ASSETS.get(name)
+    if asset is None:
+        raise HTTPException(status_code=404, detail="Not Found")
+    return asset.response(request, STATIC_IMMUTABLE if name == asset.hashed_name else "no-cache")
+
+
+# ---- Metrics ----
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    __slots__ = ("counts", "total", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.total += value
+        self.count += 1
+
+
+# (method, route, status) -> Histogram; пишется только из цикла событий, блокировка не нужна
+HTTP_LATENCY: Dict[Tuple[str, str, int], Histogram] = {}
+HTTP_IN_PROGRESS = 0
+
+
+class MetricsMiddleware:
+    """Чистый ASGI-middleware: время ответа по шаблону маршрута, методу и статусу."""
+
+    def __init__(self, asgi_app):
+        self.app = asgi_app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        global HTTP_IN_PROGRESS
+        status = 500
+        t0 = time.perf_counter()
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        HTTP_IN_PROGRESS += 1
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            HTTP_IN_PROGRESS -= 1
+            # шаблон маршрута (/static/{name}, /api/v1/workorders/{wid}), а не сам путь;
+            # всё, что не сопоставилось, — одна метка, не плодим их на каждый 404
+            route = scope.get("route")
+            label = route.path if route is not None else "<unmatched>"
+            key = (scope["method"], label, status)
+            h = HTTP_LATENCY.get(key)
+            if h is None:
+                h = HTTP_LATENCY[key] = Histogram()
+            h.observe(time.perf_counter() - t0)
+
+
+if SQL_PROFILE:
+    app.add_middleware(SqlProfilerMiddleware)
+if METRICS_ENABLED:
+    app.add_middleware(MetricsMiddleware)
+
+
+def _prom_labels(**labels) -> str:
+    return "{" + ",".join(f'{k}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+                          for k, v in labels.items()) + "}"
+
+
+def render_metrics() -> str:
+    out: List[str] = []
+
+    def metric(name: str, typ: str, help_: str, samples):
+        out.append(f"# HELP {name} {help_}")
+        out.append(f"# TYPE {name} {typ}")
+        for suffix, labels, value in samples:
+            out.append(f"{name}{suffix}{_prom_labels(**labels) if labels else ''} {value}")
+
+    hist_samples = []
+    for (method, route, status), h in sorted(HTTP_LATENCY.items()):
+        base = {"method": method, "route": route, "status": status}
+        acc = 0
+        for le, c in zip(LATENCY_BUCKETS + (float("inf"),), h.counts):
+            acc += c
+            hist_samples.append(("_bucket", {**base, "le": "+Inf" if le == float("inf") else le}, acc))
+        hist_samples.append(("_sum", base, round(h.total, 6)))
+        hist_samples.append(("_count", base, h.count))
+    metric("http_request_duration_seconds", "histogram", "Время обработки запроса", hist_samples)
+    metric("http_requests_in_progress", "gauge", "Запросы в обработке", [("", None, HTTP_IN_PROGRESS)])
+
+    limiter = anyio.to_thread.current_default_thread_limiter()
+    stats = limiter.statistics()
+    metric("threadpool_threads_total", "gauge", "Размер пула потоков для sync-обработчиков",
+           [("", None, int(limiter.total_tokens))])
+    metric("threadpool_threads_busy", "gauge", "Занятые потоки", [("", None, limiter.borrowed_tokens)])
+    metric("threadpool_tasks_waiting", "gauge", "Обработчики, ждущие свободный поток",
+           [("", None, stats.tasks_waiting)])
+
+    pools = db_pool_stats()
+    metric("db_pool_size", "gauge", "Размер пула соединений", [("", {"pool": k}, v["size"]) for k, v in pools.items()])
+    metric("db_pool_checked_out", "gauge", "Выданные соединения",
+           [("", {"pool": k}, v["checked_out"]) for k, v in pools.items()])
+    metric("db_pool_checkouts_total", "counter", "Выдачи соединений из пула",
+           [("", {"pool": k}, v["checkouts_total"]) for k, v in pools.items()])
+    metric("db_pool_wait_seconds_total", "counter", "Суммарное ожидание соединения",
+           [("", {"pool": k}, round(v["wait_seconds_total"], 6)) for k, v in pools.items()])
+
+    metric("sessions_active", "gauge", "Активные сессии входа", [("", None, len(SESSIONS))])
+    metric("db_writer_queue_depth", "gauge", "Единицы записи в очереди писателя",
+           [("", None, DB_WRITER.queue.qsize())])
+    metric("db_writer_queue_capacity", "gauge", "Ёмкость очереди писателя", [("", None, DB_WRITER.queue.maxsize)])
+    metric("db_writer_units_total", "counter", "Выполненные единицы записи", [("", None, DB_WRITER.units_total)])
+    metric("db_writer_units_failed_total", "counter", "Откаченные единицы записи",
+           [("", None, DB_WRITER.units_failed)])
+    metric("db_writer_batches_total", "counter", "Групповые коммиты", [("", None, DB_WRITER.batches_total)])
+    metric("backup_running", "gauge", "Идёт снятие копии базы", [("", None, int(BACKUPS.progress is not None))])
+    metric("backup_failures_total", "counter", "Неудачные попытки снять копию", [("", None, BACKUPS.failures)])
+    if BACKUPS.last:
+        finished = datetime.fromisoformat(BACKUPS.last["finished_at"]) - datetime(1970, 1, 1)
+        metric("backup_last_success_timestamp_seconds", "gauge", "Окончание последней удачной копии (UTC)",
+               [("", None, int(finished.total_seconds()))])
+        metric("backup_last_duration_seconds", "gauge", "Длительность последней удачной копии",
+               [("", None, BACKUPS.last["seconds"])])
+    return "\n".join(out) + "\n"
+
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
 
 
 @app.get("/")
-def index():
-    return FileResponse(str(BASE_DIR / "frontend" / "index.html"))
+def index(request: Request):
+    return INDEX_PAGE.response(request, "no-cache")
+
+
+# ---- Hot queries ----
+# Запросы горячих путей — lambda_stmt: SQLAlchemy кэширует конструкцию по месту лямбды,
+# и на вызов не строится select(...) с подсчётом ключа кэша компиляции, а значения из
+# замыкания уходят связанными параметрами. Выполнять через s.scalars(...) — s.exec
+# отдаёт для них строки, а не объекты. Замер: python -m bench.stmt_cache.
+def q_user_by_login(login: str):
+    return lambda_stmt(lambda: select(User).where(User.login == login))
+
+
+def q_user_roles(user_id: int):
+    return lambda_stmt(lambda: select(Role.name).join(UserRole, Role.id == UserRole.role_id)
+                       .where(UserRole.user_id == user_id))
 
 
 @app.post(f"/api/{API_VERSION}/auth/login")
 def login(payload: LoginPayload, response: Response):
-    with Session(engine) as s:
-        user = s.exec(select(User).where(User.login == payload.login)).first()
+    with Session(read_engine) as s:
+        user = s.scalars(q_user_by_login(payload.login)).first()
         if not user or user.password_hash != payload.password or user.blocked:
             raise HTTPException(status_code=401, detail="Неверные учетные данные")
+        # log event: запись без ожидания и не обязательна — при переполненной очереди
+        # писателя вход не отказывает, теряется только событие
+        ev = Event(type="auth_login", text=f"Вход: {user.login}", severity="success")
+        try:
+            DB_WRITER.submit(lambda ws: ws.add(ev))
+        except HTTPException:
+            logging.getLogger("cpvp.writer").warning("Очередь записи полна, событие входа %s не записано", user.login)
         token = secrets.token_hex(16)
         SESSIONS[token] = user.id
         response.set_cookie("session", token, httponly=True, samesite="lax")
-        # log event
-        s.add(Event(type="auth_login", text=f"Вход: {user.login}", severity="success"))
-        s.commit()
         return {"ok": True}
 
 
@@ -339,7 +1433,7 @@ def logout(response: Response, session: Optional[str] = Cookie(default=None)):
 
 @app.get(f"/api/{API_VERSION}/auth/me")
 def me(user_id: int = Depends(current_user_cookie)):
-    with Session(engine) as s:
+    with Session(read_engine) as s:
         u = s.get(User, user_id)
         roles = s.exec(
             select(Role).join(UserRole, Role.id == UserRole.role_id).where(UserRole.user_id == user_id)
@@ -355,23 +1449,27 @@ def me(user_id: int = Depends(current_user_cookie)):
 
 # ---- Helpers ----
 def paginate(q, page: int, page_size: int, s: Session):
-    total = len(s.exec(q).all())
+    # COUNT(*) в базе, а не len() по всем строкам: таблица в SPA листает страницы на прокрутке
+    total = s.exec(select(func.count()).select_from(q.order_by(None).subquery())).one()
     items = s.exec(q.offset((page - 1) * page_size).limit(page_size)).all()
     return total, items
 
 
 def log_event(session: Session, typ: str, text: str,
               severity: str = "info", meta: Optional[Dict[str, Any]] = None):
+    """Добавить событие в текущую единицу записи (коммитит DB_WRITER вместе с изменением)."""
     ev = Event(type=typ, text=text, severity=severity,
-               meta=str(meta) if meta else None)
-    session.add(ev)
-    session.commit()
+               meta=json.dumps(meta, ensure_ascii=False) if meta else None)
+    outbox = EVENT_OUTBOX.get()
+    if outbox is not None:  # единица шарда склада: в общую базу событие уйдёт после её COMMIT
+        outbox.append(ev)
+    else:
+        session.add(ev)
 
 
 def ensure_admin(user_id: int):
-    with Session(engine) as s:
-        q = select(Role.name).join(UserRole, Role.id == UserRole.role_id).where(UserRole.user_id == user_id)
-        names = [r[0] for r in s.exec(q).all()]
+    with Session(read_engine) as s:
+        names = s.scalars(q_user_roles(user_id)).all()
         if "admin" not in names:
             raise HTTPException(status_code=403, detail="Только администратор")
 
@@ -410,13 +1508,11 @@ class RoleUpdate(BaseModel):
 @app.get(f"/api/{API_VERSION}/users")
 def list_users(user_id: int = Depends(current_user_cookie)):
     ensure_admin(user_id)
-    with Session(engine) as s:
+    with Session(read_engine) as s:
         users = s.exec(select(User)).all()
         out: List[UserOut] = []
         for u in users:
-            rnames = [r[0] for r in s.exec(
-                select(Role.name).join(UserRole, Role.id == UserRole.role_id).where(UserRole.user_id == u.id)
-            ).all()]
+            rnames = list(s.scalars(q_user_roles(u.id)).all())
             out.append(UserOut(id=u.id, login=u.login, email=u.email, blocked=u.blocked, roles=rnames))
         return {"results": [o.dict() for o in out]}
 
@@ -424,32 +1520,31 @@ def list_users(user_id: int = Depends(current_user_cookie)):
 @app.post(f"/api/{API_VERSION}/users", status_code=201)
 def create_user(payload: UserCreate, user_id: int = Depends(current_user_cookie)):
     ensure_admin(user_id)
-    with Session(engine) as s:
-        exists = s.exec(select(User).where(User.login == payload.login)).first()
+    def unit(s: Session):
+        exists = s.scalars(q_user_by_login(payload.login)).first()
         if exists:
             raise HTTPException(status_code=400, detail="Пользователь с таким логином уже существует")
         u = User(login=payload.login, password_hash=payload.password, email=payload.email)
         s.add(u)
-        s.commit()
-        s.refresh(u)
+        s.flush()
         # привязка ролей
         for rname in payload.roles:
             r = s.exec(select(Role).where(Role.name == rname)).first()
             if not r:
                 r = Role(name=rname)
                 s.add(r)
-                s.commit()
-                s.refresh(r)
+                s.flush()
             s.add(UserRole(user_id=u.id, role_id=r.id))
-        s.commit()
         log_event(s, "user_created", f"Создан пользователь {u.login}", "success", {"user_id": u.id})
         return {"id": u.id}
 
+    return DB_WRITER.run(unit)
+
 
 @app.put(f"/api/{API_VERSION}/users/{{uid}}", status_code=204)
 def update_user(uid: int, payload: UserUpdate, user_id: int = Depends(current_user_cookie)):
     ensure_admin(user_id)
-    with Session(engine) as s:
+    def unit(s: Session):
         u = s.get(User, uid)
         if not u:
             raise HTTPException(status_code=404, detail="Пользователь не найден")
@@ -460,42 +1555,42 @@ def update_user(uid: int, payload: UserUpdate, user_id: int = Depends(current_us
         if payload.password:
             u.password_hash = payload.password
         s.add(u)
-        s.commit()
         # обновление ролей
         if payload.roles is not None:
             # удалить старые роли
-            s.exec("DELETE FROM userrole WHERE user_id = :uid", {"uid": u.id})
+            s.exec(delete(UserRole).where(UserRole.user_id == u.id))
             for rname in payload.roles:
                 r = s.exec(select(Role).where(Role.name == rname)).first()
                 if not r:
                     r = Role(name=rname)
                     s.add(r)
-                    s.commit()
-                    s.refresh(r)
+                    s.flush()
                 s.add(UserRole(user_id=u.id, role_id=r.id))
-            s.commit()
         log_event(s, "user_updated", f"Обновлён пользователь {u.login}", "info", {"user_id": u.id})
         return Response(status_code=204)
 
+    return DB_WRITER.run(unit)
+
 
 @app.delete(f"/api/{API_VERSION}/users/{{uid}}", status_code=204)
 def delete_user(uid: int, user_id: int = Depends(current_user_cookie)):
     ensure_admin(user_id)
-    with Session(engine) as s:
+    def unit(s: Session):
         u = s.get(User, uid)
         if not u:
             return Response(status_code=204)
-        s.exec("DELETE FROM userrole WHERE user_id = :uid", {"uid": uid})
+        s.exec(delete(UserRole).where(UserRole.user_id == uid))
         s.delete(u)
-        s.commit()
         log_event(s, "user_deleted", f"Удалён пользователь #{uid}", "danger", {"user_id": uid})
         return Response(status_code=204)
 
+    return DB_WRITER.run(unit)
+
 
 @app.get(f"/api/{API_VERSION}/roles")
 def list_roles(user_id: int = Depends(current_user_cookie)):
     ensure_admin(user_id)
-    with Session(engine) as s:
+    with Session(read_engine) as s:
         roles = s.exec(select(Role)).all()
         return {"results": [{"id": r.id, "name": r.name} for r in roles]}
 
@@ -503,50 +1598,53 @@ def list_roles(user_id: int = Depends(current_user_cookie)):
 @app.post(f"/api/{API_VERSION}/roles", status_code=201)
 def create_role(payload: RoleCreate, user_id: int = Depends(current_user_cookie)):
     ensure_admin(user_id)
-    with Session(engine) as s:
+    def unit(s: Session):
         exists = s.exec(select(Role).where(Role.name == payload.name)).first()
         if exists:
             raise HTTPException(status_code=400, detail="Такая роль уже существует")
         r = Role(name=payload.name)
         s.add(r)
-        s.commit()
-        s.refresh(r)
+        s.flush()
         log_event(s, "role_created", f"Создана роль {r.name}", "success", {"role_id": r.id})
         return {"id": r.id}
 
+    return DB_WRITER.run(unit)
+
 
 @app.put(f"/api/{API_VERSION}/roles/{{rid}}", status_code=204)
 def update_role(rid: int, payload: RoleUpdate, user_id: int = Depends(current_user_cookie)):
     ensure_admin(user_id)
-    with Session(engine) as s:
+    def unit(s: Session):
         r = s.get(Role, rid)
         if not r:
             raise HTTPException(status_code=404, detail="Роль не найдена")
         r.name = payload.name
         s.add(r)
-        s.commit()
         log_event(s, "role_updated", f"Обновлена роль #{rid}", "info", {"role_id": rid})
         return Response(status_code=204)
 
+    return DB_WRITER.run(unit)
+
 
 @app.delete(f"/api/{API_VERSION}/roles/{{rid}}", status_code=204)
 def delete_role(rid: int, user_id: int = Depends(current_user_cookie)):
     ensure_admin(user_id)
-    with Session(engine) as s:
+    def unit(s: Session):
         r = s.get(Role, rid)
         if not r:
             return Response(status_code=204)
-        s.exec("DELETE FROM userrole WHERE role_id = :rid", {"rid": rid})
+        s.exec(delete(UserRole).where(UserRole.role_id == rid))
         s.delete(r)
-        s.commit()
         log_event(s, "role_deleted", f"Удалена роль #{rid}", "danger", {"role_id": rid})
         return Response(status_code=204)
 
+    return DB_WRITER.run(unit)
+
 
 # ---- Simple lists ----
 @app.get(f"/api/{API_VERSION}/sites")
 def list_sites(page: int = 1, page_size: int = 50, _: int = Depends(current_user_cookie)):
-    with Session(engine) as s:
+    with Session(read_engine) as s:
         q = select(Site)
         total, items = paginate(q, page, page_size, s)
         return {
@@ -565,8 +1663,8 @@ def list_equipment(
     status: Optional[str] = None,
     _: int = Depends(current_user_cookie)
 ):
-    with Session(engine) as s:
-        q = select(Equipment)
+    with Session(read_engine) as s:
+        q = select(Equipment).order_by(Equipment.id)
         if site_id:
             q = q.where(Equipment.site_id == site_id)
         if status:
@@ -584,7 +1682,8 @@ def list_equipment(
                     "code": e.code,
                     "name": e.name,
                     "status": e.status,
-                    "commissioning_date": e.commissioning_date.isoformat()
+                    "commissioning_date": e.commissioning_date.isoformat(),
+                    "pm_interval_days": e.pm_interval_days,
                 }
                 for e in items
             ]
@@ -593,66 +1692,83 @@ def list_equipment(
 
 @app.get(f"/api/{API_VERSION}/equipment-types")
 def list_equipment_types(_: int = Depends(current_user_cookie)):
-    with Session(engine) as s:
+    with Session(read_engine) as s:
         types = s.exec(select(EquipmentType)).all()
-        return {"results": [{"id": t.id, "name": t.name} for t in types]}
+        return {"results": [{"id": t.id, "name": t.name, "pm_interval_days": t.pm_interval_days} for t in types]}
 
 
 @app.get(f"/api/{API_VERSION}/materials")
 def list_materials(page: int = 1, page_size: int = 200, _: int = Depends(current_user_cookie)):
-    with Session(engine) as s:
-        q = select(Material)
+    with Session(read_engine) as s:
+        q = select(Material).order_by(Material.id)
         total, items = paginate(q, page, page_size, s)
         return {
             "page": page,
             "page_size": page_size,
             "total": total,
             "results": [
-                {"id": m.id, "name": m.name, "unit": m.unit, "reject_percent": m.reject_percent}
+                {"id": m.id, "name": m.name, "unit": m.unit, "reject_percent": m.reject_percent,
+                 "preferred_supplier_id": m.preferred_supplier_id}
                 for m in items
             ]
         }
 
 
 @app.get(f"/api/{API_VERSION}/sites/{{site_id}}/inventory")
-def site_inventory(site_id: int, _: int = Depends(current_user_cookie)):
-    with Session(engine) as s:
+def site_inventory(
+    site_id: int,
+    page: Optional[int] = Query(default=None, ge=1),
+    page_size: int = Query(default=100, ge=1, le=1000),
+    _: int = Depends(current_user_cookie)
+):
+    """Остатки площадки. С page — одна страница и total (для виртуализированной таблицы), без — все строки."""
+    with Session(read_engine) as s:
         site = s.get(Site, site_id)
         if not site:
             raise HTTPException(status_code=404, detail="Site not found")
-        inv = s.exec(select(Inventory).where(Inventory.site_id == site_id)).all()
-        items = []
-        for i in inv:
-            m = s.get(Material, i.material_id)
-            items.append({
+        q = (select(Inventory, Material).join(Material, Material.id == Inventory.material_id)
+             .where(Inventory.site_id == site_id).order_by(Inventory.material_id))
+        out: Dict[str, Any] = {"site_id": site_id}
+        if page is None:
+            rows = s.exec(q).all()
+        else:
+            total, rows = paginate(q, page, page_size, s)
+            out.update(page=page, page_size=page_size, total=total)
+        out["items"] = [
+            {
                 "material_id": m.id,
                 "material_name": m.name,
                 "unit": m.unit,
                 "qty_on_hand": i.qty_on_hand,
                 "reorder_point": i.reorder_point
-            })
-        return {"site_id": site_id, "items": items}
+            }
+            for i, m in rows
+        ]
+        return out
 
 
 @app.get(f"/api/{API_VERSION}/inventory")
 def list_inventory(_: int = Depends(current_user_cookie)):
-    """Общий список остатков (для /inventory из ТЗ)."""
-    with Session(engine) as s:
-        inv = s.exec(select(Inventory)).all()
-        results = []
-        for i in inv:
-            m = s.get(Material, i.material_id)
-            si = s.get(Site, i.site_id)
-            results.append({
-                "site_id": i.site_id,
-                "site_name": si.name if si else "",
-                "material_id": m.id,
-                "material_name": m.name if m else "",
-                "unit": m.unit if m else "",
-                "qty_on_hand": i.qty_on_hand,
-                "reorder_point": i.reorder_point,
-            })
-        return {"results": results}
+    """Общий список остатков (для /inventory из ТЗ). С шардами склада шарды читаются параллельно,
+    уже отсортированные части сливаются — порядок тот же, что и без шардов."""
+    parts = SHARDS.fanout(lambda conn, sch: conn.exec_driver_sql(
+        f"SELECT site_id, material_id, qty_on_hand, reorder_point FROM {sch}.inventory ORDER BY site_id, material_id").all())
+    with Session(read_engine) as s:
+        mats = {m.id: m for m in s.exec(select(Material)).all()}
+        sites = {si.id: si.name for si in s.exec(select(Site)).all()}
+    results = []
+    for site_id, material_id, qty, rp in heapq.merge(*parts, key=lambda r: (r[0], r[1])):
+        m = mats.get(material_id)
+        results.append({
+            "site_id": site_id,
+            "site_name": sites.get(site_id, ""),
+            "material_id": material_id,
+            "material_name": m.name if m else "",
+            "unit": m.unit if m else "",
+            "qty_on_hand": qty,
+            "reorder_point": rp,
+        })
+    return {"results": results}
 
 
 # ---- CRUD basic ----
@@ -668,40 +1784,43 @@ class SiteUpdate(BaseModel):
 
 @app.post(f"/api/{API_VERSION}/sites", status_code=201)
 def create_site(payload: SiteCreate, user_id: int = Depends(current_user_cookie)):
-    with Session(engine) as s:
+    def unit(s: Session):
         site = Site(name=payload.name, region=payload.region)
         s.add(site)
-        s.commit()
-        s.refresh(site)
+        s.flush()
         log_event(s, "site_created", f"Добавлена площадка {site.name}", "success", {"site_id": site.id})
         return {"id": site.id}
 
+    return DB_WRITER.run(unit)
+
 
 @app.put(f"/api/{API_VERSION}/sites/{{site_id}}", status_code=204)
 def update_site(site_id: int, payload: SiteUpdate, user_id: int = Depends(current_user_cookie)):
-    with Session(engine) as s:
+    def unit(s: Session):
         site = s.get(Site, site_id)
         if not site:
             raise HTTPException(status_code=404, detail="Площадка не найдена")
         site.name = payload.name
         site.region = payload.region
         s.add(site)
-        s.commit()
         log_event(s, "site_updated", f"Обновлена площадка #{site_id}", "info", {"site_id": site_id})
         return Response(status_code=204)
 
+    return DB_WRITER.run(unit)
+
 
 @app.delete(f"/api/{API_VERSION}/sites/{{site_id}}", status_code=204)
 def delete_site(site_id: int, user_id: int = Depends(current_user_cookie)):
-    with Session(engine) as s:
+    def unit(s: Session):
         site = s.get(Site, site_id)
         if not site:
             return Response(status_code=204)
         s.delete(site)
-        s.commit()
         log_event(s, "site_deleted", f"Удалена площадка #{site_id}", "danger", {"site_id": site_id})
         return Response(status_code=204)
 
+    return DB_WRITER.run(unit)
+
 
 class EquipmentCreate(BaseModel):
     site_id: int
@@ -710,6 +1829,7 @@ class EquipmentCreate(BaseModel):
     name: str
     status: str = "active"
     commissioning_date: date
+    pm_interval_days: Optional[int] = None
 
 
 class EquipmentUpdate(EquipmentCreate):
@@ -718,46 +1838,50 @@ class EquipmentUpdate(EquipmentCreate):
 
 @app.post(f"/api/{API_VERSION}/equipment", status_code=201)
 def create_equipment(payload: EquipmentCreate, user_id: int = Depends(current_user_cookie)):
-    with Session(engine) as s:
+    def unit(s: Session):
         eq = Equipment(**payload.dict())
         s.add(eq)
-        s.commit()
-        s.refresh(eq)
+        s.flush()
         log_event(s, "equipment_created", f"Добавлено оборудование {eq.code}", "success", {"equipment_id": eq.id})
         return {"id": eq.id}
 
+    return DB_WRITER.run(unit)
+
 
 @app.put(f"/api/{API_VERSION}/equipment/{{equipment_id}}", status_code=204)
 def update_equipment(equipment_id: int, payload: EquipmentUpdate, user_id: int = Depends(current_user_cookie)):
-    with Session(engine) as s:
+    def unit(s: Session):
         eq = s.get(Equipment, equipment_id)
         if not eq:
             raise HTTPException(status_code=404, detail="Оборудование не найдено")
         for k, v in payload.dict().items():
             setattr(eq, k, v)
         s.add(eq)
-        s.commit()
         log_event(s, "equipment_updated", f"Обновлено оборудование #{equipment_id}", "info", {"equipment_id": equipment_id})
         return Response(status_code=204)
 
+    return DB_WRITER.run(unit)
+
 
 @app.delete(f"/api/{API_VERSION}/equipment/{{equipment_id}}", status_code=204)
 def delete_equipment(equipment_id: int, user_id: int = Depends(current_user_cookie)):
-    with Session(engine) as s:
+    def unit(s: Session):
         eq = s.get(Equipment, equipment_id)
         if not eq:
             return Response(status_code=204)
         s.delete(eq)
-        s.commit()
         log_event(s, "equipment_deleted", f"Удалено оборудование #{equipment_id}", "danger", {"equipment_id": equipment_id})
         return Response(status_code=204)
 
+    return DB_WRITER.run(unit)
+
 
 class MaterialCreate(BaseModel):
     name: str
     unit: str
     description: Optional[str] = None
     reject_percent: Optional[float] = 0.0
+    preferred_supplier_id: Optional[int] = None
 
 
 class MaterialUpdate(MaterialCreate):
@@ -766,56 +1890,92 @@ class MaterialUpdate(MaterialCreate):
 
 @app.post(f"/api/{API_VERSION}/materials", status_code=201)
 def create_material(payload: MaterialCreate, user_id: int = Depends(current_user_cookie)):
-    with Session(engine) as s:
+    def unit(s: Session):
         m = Material(**payload.dict())
         s.add(m)
-        s.commit()
-        s.refresh(m)
+        s.flush()
         log_event(s, "material_created", f"Добавлен материал {m.name}", "success", {"material_id": m.id})
         return {"id": m.id}
 
+    return DB_WRITER.run(unit)
+
 
 @app.put(f"/api/{API_VERSION}/materials/{{material_id}}", status_code=204)
 def update_material(material_id: int, payload: MaterialUpdate, user_id: int = Depends(current_user_cookie)):
-    with Session(engine) as s:
+    def unit(s: Session):
         m = s.get(Material, material_id)
         if not m:
             raise HTTPException(status_code=404, detail="Материал не найден")
         for k, v in payload.dict().items():
             setattr(m, k, v)
         s.add(m)
-        s.commit()
         log_event(s, "material_updated", f"Обновлён материал #{material_id}", "info", {"material_id": material_id})
         return Response(status_code=204)
 
+    return DB_WRITER.run(unit)
+
 
 @app.delete(f"/api/{API_VERSION}/materials/{{material_id}}", status_code=204)
 def delete_material(material_id: int, user_id: int = Depends(current_user_cookie)):
-    with Session(engine) as s:
+    def unit(s: Session):
         m = s.get(Material, material_id)
         if not m:
             return Response(status_code=204)
         s.delete(m)
-        s.commit()
         log_event(s, "material_deleted", f"Удалён материал #{material_id}", "danger", {"material_id": material_id})
         return Response(status_code=204)
 
+    return DB_WRITER.run(unit)
+
 
 class InventoryUpdate(BaseModel):
     qty_on_hand: float
     reorder_point: float
 
 
+def inventory_is_low(inv: Inventory) -> bool:
+    return inv.qty_on_hand < inv.reorder_point
+
+
+def change_inventory(s: Session, site_id: int, material_id: int, *, delta: float = 0.0,
+                     qty_on_hand: Optional[float] = None, reorder_point: Optional[float] = None,
+                     kind: str = "adjust") -> Inventory:
+    """Изменить остаток и, если позиция пересекла точку заказа, записать low_stock / low_stock_cleared.
+
+    Фактическое изменение остатка пишется в журнал StockMove (kind по умолчанию — adjust).
+    """
+    inv = s.get(Inventory, (site_id, material_id))
+    if not inv:
+        inv = Inventory(site_id=site_id, material_id=material_id)
+    was_low = inventory_is_low(inv)
+    before = inv.qty_on_hand
+    if qty_on_hand is not None:
+        inv.qty_on_hand = qty_on_hand
+    if reorder_point is not None:
+        inv.reorder_point = reorder_point
+    if delta < 0:
+        inv.qty_on_hand = max(0.0, inv.qty_on_hand + delta)
+    elif delta > 0:
+        inv.qty_on_hand = inv.qty_on_hand + delta
+    s.add(inv)
+    if inv.qty_on_hand != before:
+        s.add(StockMove(site_id=site_id, material_id=material_id, kind=kind, qty=inv.qty_on_hand - before))
+    is_low = inventory_is_low(inv)
+    meta = {"site_id": site_id, "material_id": material_id,
+            "qty_on_hand": inv.qty_on_hand, "reorder_point": inv.reorder_point}
+    if is_low and not was_low:
+        log_event(s, "low_stock", f"Запас мат.#{material_id} @ site #{site_id} ниже точки заказа "
+                                  f"({inv.qty_on_hand:g} < {inv.reorder_point:g})", "danger", meta)
+    elif was_low and not is_low:
+        log_event(s, "low_stock_cleared", f"Запас мат.#{material_id} @ site #{site_id} восстановлен", "success", meta)
+    return inv
+
+
 @app.put(f"/api/{API_VERSION}/sites/{{site_id}}/inventory/{{material_id}}", status_code=204)
 def update_inventory(site_id: int, material_id: int, payload: InventoryUpdate, user_id: int = Depends(current_user_cookie)):
-    with Session(engine) as s:
-        inv = s.get(Inventory, (site_id, material_id))
-        if not inv:
-            inv = Inventory(site_id=site_id, material_id=material_id)
-        inv.qty_on_hand = payload.qty_on_hand
-        inv.reorder_point = payload.reorder_point
-        s.add(inv)
-        s.commit()
+    def unit(s: Session):
+        change_inventory(s, site_id, material_id,
+                         qty_on_hand=payload.qty_on_hand, reorder_point=payload.reorder_point)
         log_event(
             s,
             "inventory_updated",
@@ -825,6 +1985,8 @@ def update_inventory(site_id: int, material_id: int, payload: InventoryUpdate, u
         )
         return Response(status_code=204)
 
+    return SHARDS.writer(site_id).run(unit)
+
 
 # ---- Inventory moves (reserve/consume/add) ----
 class InventoryMove(BaseModel):
@@ -835,42 +1997,456 @@ class InventoryMove(BaseModel):
 
 @app.post(f"/api/{API_VERSION}/inventory/reserve", status_code=204)
 def inventory_reserve(payload: InventoryMove, user_id: int = Depends(current_user_cookie)):
-    with Session(engine) as s:
-        inv = s.get(Inventory, (payload.site_id, payload.material_id))
-        if not inv:
-            inv = Inventory(site_id=payload.site_id, material_id=payload.material_id)
-        inv.qty_on_hand = max(0.0, inv.qty_on_hand - payload.qty)
-        s.add(inv)
-        s.commit()
+    def unit(s: Session):
+        change_inventory(s, payload.site_id, payload.material_id, delta=-payload.qty, kind="reserve")
         log_event(s, "inventory_reserve", f"Резерв материалов {payload.qty}", "info", payload.dict())
         return Response(status_code=204)
 
+    return SHARDS.writer(payload.site_id).run(unit)
+
 
 @app.post(f"/api/{API_VERSION}/inventory/consume", status_code=204)
 def inventory_consume(payload: InventoryMove, user_id: int = Depends(current_user_cookie)):
-    with Session(engine) as s:
-        inv = s.get(Inventory, (payload.site_id, payload.material_id))
-        if not inv:
-            inv = Inventory(site_id=payload.site_id, material_id=payload.material_id)
-        inv.qty_on_hand = max(0.0, inv.qty_on_hand - payload.qty)
-        s.add(inv)
-        s.commit()
+    def unit(s: Session):
+        change_inventory(s, payload.site_id, payload.material_id, delta=-payload.qty, kind="consume")
         log_event(s, "inventory_consume", f"Списание материалов {payload.qty}", "warning", payload.dict())
         return Response(status_code=204)
 
+    return SHARDS.writer(payload.site_id).run(unit)
+
 
 @app.post(f"/api/{API_VERSION}/inventory/add", status_code=204)
 def inventory_add(payload: InventoryMove, user_id: int = Depends(current_user_cookie)):
-    with Session(engine) as s:
-        inv = s.get(Inventory, (payload.site_id, payload.material_id))
-        if not inv:
-            inv = Inventory(site_id=payload.site_id, material_id=payload.material_id)
-        inv.qty_on_hand = inv.qty_on_hand + payload.qty
-        s.add(inv)
-        s.commit()
+    def unit(s: Session):
+        change_inventory(s, payload.site_id, payload.material_id, delta=payload.qty, kind="add")
         log_event(s, "inventory_add", f"Пополнение материалов {payload.qty}", "success", payload.dict())
         return Response(status_code=204)
 
+    return SHARDS.writer(payload.site_id).run(unit)
+
+
+@app.get(f"/api/{API_VERSION}/inventory/low")
+def list_low_inventory(
+    site_id: Optional[List[int]] = Query(default=None),
+    page: int = 1,
+    page_size: int = 200,
+    _: int = Depends(current_user_cookie)
+):
+    """Позиции ниже точки заказа — читаются по частичному индексу ix_inventory_low."""
+    low = Inventory.qty_on_hand < Inventory.reorder_point
+    with Session(read_engine) as s:
+        cq = select(func.count()).select_from(Inventory).where(low)
+        q = (
+            select(Inventory, Material.name, Material.unit, Site.name)
+            .join(Material, Material.id == Inventory.material_id)
+            .join(Site, Site.id == Inventory.site_id)
+            .where(low)
+        )
+        if site_id:
+            cq = cq.where(Inventory.site_id.in_(site_id))
+            q = q.where(Inventory.site_id.in_(site_id))
+        total = s.exec(cq).one()
+        rows = s.exec(
+            q.order_by(Inventory.site_id, Inventory.material_id).offset((page - 1) * page_size).limit(page_size)
+        ).all()
+        return {
+            "page": page,
+            "page_size": page_size,
+            "total": total,
+            "results": [
+                {
+                    "site_id": i.site_id,
+                    "site_name": site_name,
+                    "material_id": i.material_id,
+                    "material_name": mname,
+                    "unit": unit,
+                    "qty_on_hand": i.qty_on_hand,
+                    "reorder_point": i.reorder_point,
+                    "deficit": i.reorder_point - i.qty_on_hand,
+                }
+                for i, mname, unit, site_name in rows
+            ]
+        }
+
+
+# ---- Stock ledger & snapshots ----
+class StockMoveItem(BaseModel):
+    site_id: int
+    material_id: int
+    qty: float  # со знаком: расход отрицательный
+    kind: str = "adjust"
+
+
+class StockMovesPayload(BaseModel):
+    moves: List[StockMoveItem]
+
+
+def apply_stock_moves(s: Session, moves: List[StockMoveItem]) -> int:
+    """Провести пачку движений: остатки и журнал пишутся executemany, а не строкой за строкой.
+
+    Как и change_inventory, остаток не уходит ниже нуля (в журнал попадает фактическое
+    изменение) и на пересечении точки заказа пишутся low_stock / low_stock_cleared.
+    """
+    conn = s.connection()
+    pairs = sorted({(m.site_id, m.material_id) for m in moves})
+    current: Dict[Tuple[int, int], List[float]] = {}
+    for site_id in sorted({p[0] for p in pairs}):
+        mats = [p[1] for p in pairs if p[0] == site_id]
+        for part in range(0, len(mats), 500):
+            chunk = mats[part:part + 500]
+            rows = conn.exec_driver_sql(
+                "SELECT material_id, qty_on_hand, reorder_point FROM inventory "
+                f"WHERE site_id = ? AND material_id IN ({','.join('?' * len(chunk))})", (site_id, *chunk))
+            for material_id, qty, rp in rows:
+                current[(site_id, material_id)] = [qty, rp]
+    new_pairs = [p for p in pairs if p not in current]
+    was_low = {p: v[0] < v[1] for p, v in current.items()}
+    for p in new_pairs:
+        current[p] = [0.0, 0.0]
+    now = datetime.utcnow()
+    ledger = []
+    for m in moves:
+        cell = current[(m.site_id, m.material_id)]
+        after = max(0.0, cell[0] + m.qty) if m.qty < 0 else cell[0] + m.qty
+        if after != cell[0]:
+            ledger.append({"site_id": m.site_id, "material_id": m.material_id, "kind": m.kind,
+                           "qty": after - cell[0], "created_at": now})
+            cell[0] = after
+    if new_pairs:
+        s.exec(insert(Inventory), params=[
+            {"site_id": p[0], "material_id": p[1], "qty_on_hand": current[p][0], "reorder_point": 0.0}
+            for p in new_pairs
+        ])
+    if was_low:
+        conn.exec_driver_sql(
+            "UPDATE inventory SET qty_on_hand = ? WHERE site_id = ? AND material_id = ?",
+            [(current[p][0], p[0], p[1]) for p in was_low])
+    if ledger:
+        s.exec(insert(StockMove), params=ledger)
+    for p, low_before in was_low.items():
+        qty, rp = current[p]
+        meta = {"site_id": p[0], "material_id": p[1], "qty_on_hand": qty, "reorder_point": rp}
+        if qty < rp and not low_before:
+            log_event(s, "low_stock", f"Запас мат.#{p[1]} @ site #{p[0]} ниже точки заказа "
+                                      f"({qty:g} < {rp:g})", "danger", meta)
+        elif low_before and not qty < rp:
+            log_event(s, "low_stock_cleared", f"Запас мат.#{p[1]} @ site #{p[0]} восстановлен", "success", meta)
+    return len(ledger)
+
+
+def take_stock_snapshots(s: Session, force: bool = False, shard: Optional[int] = None) -> Dict[str, Any]:
+    """Снимок остатков по площадкам, где с прошлого снимка были движения (или снимка ещё нет).
+
+    Снимок помнит последний учтённый id журнала: всё, что правее, — дельты после него.
+    Писатель один, поэтому остатки и MAX(id) журнала в его транзакции согласованы.
+    С shard — только площадки этого шарда (id журнала у каждого шарда свои).
+    """
+    conn = s.connection()
+    last_move = conn.exec_driver_sql("SELECT COALESCE(MAX(id), 0) FROM stockmove").scalar()
+    due = "1 = 1" if force else """(NOT EXISTS (SELECT 1 FROM stocksnapshot sn WHERE sn.site_id = site.id)
+        OR EXISTS (SELECT 1 FROM stockmove m WHERE m.site_id = site.id AND m.id > (
+            SELECT MAX(sn.last_move_id) FROM stocksnapshot sn WHERE sn.site_id = site.id)))"""
+    if shard is not None:
+        due += f" AND site.id % {SHARDS.count} = {shard}"
+    now = datetime.utcnow().isoformat(sep=" ")
+    sites = conn.exec_driver_sql(
+        f"INSERT INTO stocksnapshot (site_id, taken_at, last_move_id) SELECT id, ?, ? FROM site WHERE {due}",
+        (now, last_move)).rowcount
+    lines = 0
+    if sites:
+        lines = conn.exec_driver_sql("""
+            INSERT INTO stocksnapshotline (snapshot_id, material_id, qty)
+            SELECT sn.id, i.material_id, i.qty_on_hand
+            FROM stocksnapshot sn JOIN inventory i ON i.site_id = sn.site_id
+            WHERE sn.taken_at = ? AND sn.last_move_id = ?""", (now, last_move)).rowcount
+    pruned = prune_stock_snapshots(conn)
+    return {"sites": sites, "lines": lines, "taken_at": now, "last_move_id": last_move, "pruned": pruned}
+
+
+def prune_stock_snapshots(conn) -> int:
+    """Проредить старые снимки (STOCK_SNAPSHOT_KEEP_DAYS / STOCK_SNAPSHOT_DAILY_DAYS).
+
+    Каждый снимок — полные остатки площадки, поэтому любой можно удалить: остатки на
+    момент внутри прореженного периода считаются от предыдущего оставшегося снимка по
+    журналу. Последний снимок площадки не удаляется никогда — от него считаются текущие дельты.
+    """
+    now = datetime.utcnow()
+    keep_cut = (now - timedelta(days=STOCK_SNAPSHOT_KEEP_DAYS)).isoformat(sep=" ")
+    daily_cut = (now - timedelta(days=STOCK_SNAPSHOT_DAILY_DAYS)).isoformat(sep=" ")
+    ids = [(r[0],) for r in conn.exec_driver_sql("""
+        SELECT id FROM stocksnapshot
+        WHERE taken_at < ?
+          AND id NOT IN (SELECT MAX(id) FROM stocksnapshot GROUP BY site_id)
+          AND (taken_at < ? OR id NOT IN (
+              SELECT MAX(id) FROM stocksnapshot WHERE taken_at < ? GROUP BY site_id, substr(taken_at, 1, 10)))""",
+        (keep_cut, daily_cut, keep_cut))]
+    if ids:
+        conn.exec_driver_sql("DELETE FROM stocksnapshotline WHERE snapshot_id = ?", ids)
+        conn.exec_driver_sql("DELETE FROM stocksnapshot WHERE id = ?", ids)
+    return len(ids)
+
+
+def snapshot_all(force: bool = False) -> Dict[str, Any]:
+    """Снимки остатков во всех шардах склада (без шардов — обычный take_stock_snapshots)."""
+    if not SHARDS.count:
+        return DB_WRITER.run(lambda s: take_stock_snapshots(s, force=force))
+    parts = SHARDS.run_many([(w, functools.partial(take_stock_snapshots, force=force, shard=k))
+                             for k, w in enumerate(SHARDS.writers)])
+    return {"sites": sum(p["sites"] for p in parts), "lines": sum(p["lines"] for p in parts),
+            "pruned": sum(p["pruned"] for p in parts), "taken_at": max(p["taken_at"] for p in parts),
+            "shards": parts}
+
+
+async def stock_snapshot_loop():
+    while True:
+        try:
+            await anyio.to_thread.run_sync(snapshot_all)
+        except Exception:
+            stock_log.exception("Не удалось снять остатки")
+        await asyncio.sleep(STOCK_SNAPSHOT_INTERVAL)
+
+
+@app.post(f"/api/{API_VERSION}/inventory/moves")
+def post_stock_moves(payload: StockMovesPayload, user_id: int = Depends(current_user_cookie)):
+    """Пакетное проведение движений запаса одной транзакцией.
+
+    С шардами склада движения делятся по шардам и проводятся параллельно: каждая часть
+    атомарна в своём шарде, а при ошибке одной остальные уже могут быть записаны.
+    """
+    def unit_for(moves: List[StockMoveItem]) -> WriteUnit:
+        def unit(s: Session):
+            written = apply_stock_moves(s, moves)
+            if written:
+                log_event(s, "inventory_moves", f"Проведено движений запаса: {written}", "info", {"moves": written})
+            return written
+        return unit
+
+    parts: Dict[int, List[StockMoveItem]] = {}
+    for m in payload.moves:
+        parts.setdefault(SHARDS.shard(m.site_id) if SHARDS.count else 0, []).append(m)
+    if not parts:
+        parts[0] = []
+    units = [(SHARDS.writer(moves[0].site_id) if moves else DB_WRITER, unit_for(moves)) for moves in parts.values()]
+    return {"written": sum(SHARDS.run_many(units))}
+
+
+@app.post(f"/api/{API_VERSION}/inventory/snapshots", status_code=201)
+def post_stock_snapshot(user_id: int = Depends(current_user_cookie)):
+    return snapshot_all(force=True)
+
+
+def utc_naive(dt: datetime) -> datetime:
+    """Время с часовым поясом — в UTC без пояса, как оно хранится в базе; наивное считается UTC."""
+    return dt.astimezone(timezone.utc).replace(tzinfo=None) if dt.tzinfo else dt
+
+
+@app.get(f"/api/{API_VERSION}/sites/{{site_id}}/inventory/at")
+def site_inventory_at(site_id: int, at: datetime, material_id: Optional[int] = None,
+                      _: int = Depends(current_user_cookie)):
+    """Остатки площадки на момент at: ближайший снимок не позже at плюс движения после него."""
+    at_s = utc_naive(at).isoformat(sep=" ")
+    sch = SHARDS.schema(site_id)  # id снимков и журнала свои в каждом шарде — читаем прямо из шарда площадки
+    with read_engine.connect() as conn:
+        snap = conn.exec_driver_sql(
+            f"SELECT id, taken_at, last_move_id FROM {sch}.stocksnapshot WHERE site_id = ? AND taken_at <= ? "
+            "ORDER BY taken_at DESC LIMIT 1", (site_id, at_s)).first()
+        if not snap:
+            raise HTTPException(status_code=404, detail="Нет снимка остатков на эту дату — история начинается позже")
+        mat_filter, mat_args = (" AND material_id = ?", (material_id,)) if material_id else ("", ())
+        qty = dict(conn.exec_driver_sql(
+            f"SELECT material_id, qty FROM {sch}.stocksnapshotline WHERE snapshot_id = ?" + mat_filter,
+            (snap[0], *mat_args)).all())
+        deltas = conn.exec_driver_sql(
+            f"SELECT material_id, SUM(qty), COUNT(*) FROM {sch}.stockmove "
+            "WHERE site_id = ? AND id > ? AND created_at <= ?" + mat_filter + " GROUP BY material_id",
+            (site_id, snap[2], at_s, *mat_args)).all()
+    applied = 0
+    for mid, delta, n in deltas:
+        qty[mid] = qty.get(mid, 0.0) + delta
+        applied += n
+    return {
+        "site_id": site_id,
+        "at": at_s,
+        "snapshot": {"id": snap[0], "taken_at": snap[1]},
+        "moves_applied": applied,
+        "items": [{"material_id": mid, "qty_on_hand": round(q, 6)} for mid, q in sorted(qty.items())],
+    }
+
+
+# ---- Consumption forecast ----
+_DAY_SQL = "CAST(julianday(substr({0}, 1, 10)) - 1721424.5 AS INTEGER)"  # date.toordinal() в SQL
+FORECAST_KINDS = ("consume", "reserve")
+
+
+class ConsumptionForecast:
+    """Дневной расход по каждой паре площадка × материал и прогноз по нему.
+
+    Ряды хранятся одной матрицей N × FORECAST_WINDOW_DAYS (последний столбец — сегодня).
+    refresh() дочитывает только движения с id больше уже учтённого и сдвигает окно
+    при смене суток, поэтому обновление стоит пропорционально числу новых движений.
+    Прогноз считается по всей матрице сразу: скользящее среднее, экспоненциальное
+    сглаживание (в замкнутой форме — свёртка с весами α(1−α)^k) и разброс; результат
+    кэшируется до следующего движения или изменения остатков.
+    """
+
+    def __init__(self, window: int, alpha: float):
+        self.window = window
+        self.alpha = alpha
+        self._lock = threading.Lock()
+        self._rows: Dict[int, int] = {}  # (site_id << 32 | material_id) -> строка матрицы
+        self._keys = np.empty(0, dtype=np.int64)
+        self._series = np.zeros((0, window))
+        self._end_day = 0
+        self._first_day: Optional[int] = None
+        self._last_ids: Dict[str, int] = {}  # по шардам склада: id журнала в каждом свои
+        self._result: Optional[Tuple[Tuple, Dict[str, np.ndarray]]] = None
+
+    def _advance(self, today: int):
+        shift = today - self._end_day
+        if shift <= 0:
+            return
+        if shift >= self.window:
+            self._series[:] = 0.0
+        else:
+            self._series[:, :-shift] = self._series[:, shift:]
+            self._series[:, -shift:] = 0.0
+        self._end_day = today
+
+    def _row_ids(self, keys: np.ndarray) -> np.ndarray:
+        new = [k for k in np.unique(keys).tolist() if k not in self._rows]
+        if new:
+            n = len(self._rows)
+            for i, k in enumerate(new):
+                self._rows[k] = n + i
+            self._keys = np.concatenate([self._keys, np.asarray(new, dtype=np.int64)])
+            grow = np.zeros((len(new), self.window))
+            self._series = np.vstack([self._series, grow]) if n else grow
+        return np.fromiter((self._rows[k] for k in keys.tolist()), dtype=np.int64, count=len(keys))
+
+    def refresh(self, conn):
+        today = datetime.utcnow().date().toordinal()
+        with self._lock:
+            self._advance(today)
+            cur = conn.connection.cursor()
+            rows = []
+            try:
+                kinds = ",".join("?" * len(FORECAST_KINDS))
+                since = date.fromordinal(today - self.window + 1).isoformat()
+                for sch in SHARDS.schemas():
+                    last = self._last_ids.get(sch, 0)
+                    top = cur.execute(f"SELECT MAX(id) FROM {sch}.stockmove").fetchone()[0] or 0
+                    if top <= last:
+                        continue
+                    if self._first_day is None:
+                        self._first_day = cur.execute(
+                            f"SELECT {_DAY_SQL.format('MIN(created_at)')} FROM stockmove").fetchone()[0]
+                    rows += cur.execute(
+                        f"SELECT site_id, material_id, {_DAY_SQL.format('created_at')}, -qty FROM {sch}.stockmove "
+                        f"WHERE id > ? AND id <= ? AND created_at >= ? AND qty < 0 AND kind IN ({kinds})",
+                        (last, top, since, *FORECAST_KINDS)).fetchall()
+                    self._last_ids[sch] = top
+            finally:
+                cur.close()
+            if not rows:
+                return
+            data = np.asarray(rows, dtype=np.float64)
+            keys = (data[:, 0].astype(np.int64) << 32) | data[:, 1].astype(np.int64)
+            days = np.clip(self.window - 1 - (today - data[:, 2].astype(np.int64)), 0, self.window - 1)
+            rows_idx = self._row_ids(keys)  # может нарастить матрицу — до обращения к ней
+            np.add.at(self._series, (rows_idx, days), data[:, 3])
+
+    def forecast(self, conn) -> Dict[str, np.ndarray]:
+        """Прогноз для каждой строки остатков, отсортированный по дням до исчерпания."""
+        self.refresh(conn)
+        inv = _columns(conn, "SELECT site_id, material_id, qty_on_hand, reorder_point FROM inventory",
+                       ("inventory",))
+        stamp = (tuple(self._last_ids.values()), self._end_day, DB_WRITER.version("inventory"), len(inv))
+        with self._lock:
+            if self._result and self._result[0] == stamp:
+                return self._result[1]
+            # пока история короче окна, дни до первого движения не считаем нулевым расходом
+            span = self.window if self._first_day is None else max(1, min(self.window, self._end_day - self._first_day + 1))
+            hist = self._series[:, -span:]
+            weights = self.alpha * (1 - self.alpha) ** np.arange(span - 1, -1, -1)
+            mean = hist.mean(axis=1)
+            stats = np.stack([
+                hist @ weights + (1 - self.alpha) ** span * mean,  # начальный уровень — среднее по окну
+                hist[:, -min(FORECAST_MA_DAYS, span):].mean(axis=1),
+                hist.std(axis=1),
+            ], axis=1)
+            order = np.argsort(self._keys)
+            sorted_keys, stats = self._keys[order], stats[order]
+        # ряды есть не у всех строк остатков: без движений расход нулевой
+        keys = (inv[:, 0].astype(np.int64) << 32) | inv[:, 1].astype(np.int64)
+        n = len(sorted_keys)
+        pos = np.minimum(np.searchsorted(sorted_keys, keys), max(n - 1, 0))
+        found = (sorted_keys[pos] == keys) if n else np.zeros(len(keys), dtype=bool)
+        per_row = np.zeros((len(keys), 3))
+        per_row[found] = stats[pos[found]]
+        level, moving_avg, sigma = per_row.T
+        on_hand = inv[:, 2]
+        with np.errstate(divide="ignore"):
+            days_left = np.where(level > 1e-9, on_hand / np.maximum(level, 1e-9), np.inf)
+        suggested = level * FORECAST_LEAD_DAYS + FORECAST_SERVICE_Z * sigma * np.sqrt(FORECAST_LEAD_DAYS)
+        order = np.argsort(days_left, kind="stable")
+        result = {
+            "site_id": inv[order, 0], "material_id": inv[order, 1], "qty_on_hand": on_hand[order],
+            "reorder_point": inv[order, 3], "daily_rate": level[order], "moving_avg": moving_avg[order],
+            "sigma": sigma[order], "days_to_stockout": days_left[order], "suggested_reorder_point": suggested[order],
+            "history_days": np.array(span),
+        }
+        with self._lock:
+            self._result = (stamp, result)
+        return result
+
+
+FORECAST = ConsumptionForecast(FORECAST_WINDOW_DAYS, FORECAST_ALPHA)
+
+
+@app.get(f"/api/{API_VERSION}/inventory/forecast")
+def inventory_forecast(
+    site_id: Optional[int] = None,
+    material_id: Optional[int] = None,
+    page: int = Query(default=1, ge=1),
+    page_size: int = Query(default=200, ge=1, le=5000),
+    _: int = Depends(current_user_cookie),
+):
+    """Дни до исчерпания запаса и рекомендуемая точка заказа; сначала самые срочные."""
+    with read_engine.connect() as conn:
+        r = FORECAST.forecast(conn)
+    mask = np.ones(len(r["site_id"]), dtype=bool)
+    if site_id is not None:
+        mask &= r["site_id"] == site_id
+    if material_id is not None:
+        mask &= r["material_id"] == material_id
+    idx = np.flatnonzero(mask)
+    page_idx = idx[(page - 1) * page_size: page * page_size]
+
+    def num(v: float) -> Optional[float]:
+        return round(float(v), 3) if np.isfinite(v) else None
+
+    return {
+        "window_days": int(r["history_days"]),
+        "alpha": FORECAST_ALPHA,
+        "lead_days": FORECAST_LEAD_DAYS,
+        "page": page,
+        "page_size": page_size,
+        "total": len(idx),
+        "results": [
+            {
+                "site_id": int(r["site_id"][i]),
+                "material_id": int(r["material_id"][i]),
+                "qty_on_hand": float(r["qty_on_hand"][i]),
+                "reorder_point": float(r["reorder_point"][i]),
+                "daily_rate": num(r["daily_rate"][i]),
+                "moving_avg": num(r["moving_avg"][i]),
+                "days_to_stockout": num(r["days_to_stockout"][i]),
+                "suggested_reorder_point": num(r["suggested_reorder_point"][i]),
+            }
+            for i in page_idx.tolist()
+        ],
+    }
+
 
 # ---- Work Orders ----
 class WorkOrderBase(BaseModel):
@@ -915,59 +2491,97 @@ class WorkOrderMaterialItem(BaseModel):
     qty_fact: float = 0.0
 
 
+def _unique_materials(items: List[WorkOrderMaterialItem]) -> List[WorkOrderMaterialItem]:
+    """Одна строка на материал: повтор material_id — ошибка 422, а не молчаливая перезапись."""
+    seen, dup = set(), set()
+    for item in items:
+        (dup if item.material_id in seen else seen).add(item.material_id)
+    if dup:
+        raise ValueError(f"material_id повторяется: {', '.join(map(str, sorted(dup)))}")
+    return items
+
+
 class WorkOrderMaterialsPayload(BaseModel):
     items: List[WorkOrderMaterialItem]
 
+    _unique = field_validator("items")(_unique_materials)
+
+
+class WorkOrderMaterialsPatch(BaseModel):
+    items: List[WorkOrderMaterialItem] = []
+    remove: List[int] = []  # material_id строк, которые нужно убрать
+
+    _unique = field_validator("items")(_unique_materials)
+
 
 class WorkOrderCommentPayload(BaseModel):
     text: str
 
 
+def set_workorder_status(s: Session, w: WorkOrder, status: str, user_id: Optional[int] = None):
+    """Сменить статус заявки и записать переход в историю той же единицей записи."""
+    if w.status == status:
+        return
+    s.add(WorkOrderStatusHistory(work_order_id=w.id, from_status=w.status, to_status=status, user_id=user_id))
+    w.status = status
+
+
+def workorder_out(w: WorkOrder) -> Dict[str, Any]:
+    return {
+        "id": w.id,
+        "site_id": w.site_id,
+        "type": w.type,
+        "status": w.status,
+        "priority": w.priority,
+        "title": w.title,
+        "description": w.description,
+        "equipment_id": w.equipment_id,
+        "planned_date": w.planned_date.isoformat() if w.planned_date else None,
+        "assigned_team": w.assigned_team,
+        "created_at": w.created_at.isoformat()
+    }
+
+
 @app.get(f"/api/{API_VERSION}/workorders")
 def list_workorders(
     site_id: Optional[int] = None,
     status: Optional[str] = None,
+    page: Optional[int] = Query(default=None, ge=1),
+    page_size: int = Query(default=100, ge=1, le=1000),
     _: int = Depends(current_user_cookie)
 ):
-    with Session(engine) as s:
+    """Заявки, новые сверху. С page — одна страница и total, без — весь список, как раньше."""
+    with Session(read_engine) as s:
         q = select(WorkOrder)
         if site_id:
             q = q.where(WorkOrder.site_id == site_id)
         if status:
             q = q.where(WorkOrder.status == status)
-        items = s.exec(q.order_by(WorkOrder.created_at.desc())).all()
-        return {"results": [
-            {
-                "id": w.id,
-                "site_id": w.site_id,
-                "type": w.type,
-                "status": w.status,
-                "priority": w.priority,
-                "title": w.title,
-                "description": w.description,
-                "equipment_id": w.equipment_id,
-                "planned_date": w.planned_date.isoformat() if w.planned_date else None,
-                "assigned_team": w.assigned_team,
-                "created_at": w.created_at.isoformat()
-            }
-            for w in items
-        ]}
+        q = q.order_by(WorkOrder.created_at.desc(), WorkOrder.id.desc())
+        if page is None:
+            return {"results": [workorder_out(w) for w in s.exec(q).all()]}
+        total, items = paginate(q, page, page_size, s)
+        return {"page": page, "page_size": page_size, "total": total,
+                "results": [workorder_out(w) for w in items]}
 
 
 @app.post(f"/api/{API_VERSION}/workorders", status_code=201)
 def create_workorder(payload: WorkOrderCreate, user_id: int = Depends(current_user_cookie)):
-    with Session(engine) as s:
+    def unit(s: Session):
         w = WorkOrder(**payload.dict())
         s.add(w)
-        s.commit()
-        s.refresh(w)
+        s.flush()
         log_event(s, "work_order", f"Создана заявка ТОиР #{w.id}", "warning", {"work_order_id": w.id})
         return {"id": w.id}
 
+    res = DB_WRITER.run(unit)
+    DISPATCH.refresh(res["id"])
+    return res
+
 
 @app.get(f"/api/{API_VERSION}/workorders/{{wid}}")
 def get_workorder(wid: int, _: int = Depends(current_user_cookie)):
-    with Session(engine) as s:
+    with Session(read_engine) as s:
         w = s.get(WorkOrder, wid)
         if not w:
             raise HTTPException(status_code=404, detail="Заявка не найдена")
@@ -1002,39 +2616,48 @@ def get_workorder(wid: int, _: int = Depends(current_user_cookie)):
 
 @app.put(f"/api/{API_VERSION}/workorders/{{wid}}", status_code=204)
 def update_workorder(wid: int, payload: WorkOrderUpdate, user_id: int = Depends(current_user_cookie)):
-    with Session(engine) as s:
+    def unit(s: Session):
         w = s.get(WorkOrder, wid)
         if not w:
             raise HTTPException(status_code=404, detail="Заявка не найдена")
-        for k, v in payload.dict(exclude_none=True).items():
+        changes = payload.dict(exclude_none=True)
+        if "status" in changes:
+            set_workorder_status(s, w, changes.pop("status"), user_id)
+        for k, v in changes.items():
             setattr(w, k, v)
         s.add(w)
-        s.commit()
         log_event(s, "work_order_updated", f"Обновлена заявка ТОиР #{wid}", "info", {"work_order_id": wid})
         return Response(status_code=204)
 
+    res = DB_WRITER.run(unit)
+    DISPATCH.refresh(wid)
+    return res
+
 
 @app.delete(f"/api/{API_VERSION}/workorders/{{wid}}", status_code=204)
 def delete_workorder(wid: int, user_id: int = Depends(current_user_cookie)):
-    with Session(engine) as s:
+    def unit(s: Session):
         w = s.get(WorkOrder, wid)
         if not w:
             return Response(status_code=204)
+        s.exec(delete(WorkOrderStatusHistory).where(WorkOrderStatusHistory.work_order_id == wid))
         s.delete(w)
-        s.commit()
         log_event(s, "work_order_deleted", f"Удалена заявка ТОиР #{wid}", "danger", {"work_order_id": wid})
         return Response(status_code=204)
 
+    res = DB_WRITER.run(unit)
+    DISPATCH.refresh(wid)
+    return res
+
 
 @app.post(f"/api/{API_VERSION}/workorders/{{wid}}/assign", status_code=204)
 def assign_workorder(wid: int, payload: WorkOrderAssign, user_id: int = Depends(current_user_cookie)):
-    with Session(engine) as s:
+    def unit(s: Session):
         w = s.get(WorkOrder, wid)
         if not w:
             raise HTTPException(status_code=404, detail="Заявка не найдена")
         w.assigned_team = payload.assigned_team
         s.add(w)
-        s.commit()
         log_event(
             s,
             "work_order_assign",
@@ -1044,16 +2667,19 @@ def assign_workorder(wid: int, payload: WorkOrderAssign, user_id: int = Depends(
         )
         return Response(status_code=204)
 
+    res = DB_WRITER.run(unit)
+    DISPATCH.refresh(wid)
+    return res
+
 
 @app.post(f"/api/{API_VERSION}/workorders/{{wid}}/status", status_code=204)
 def status_workorder(wid: int, payload: WorkOrderStatus, user_id: int = Depends(current_user_cookie)):
-    with Session(engine) as s:
+    def unit(s: Session):
         w = s.get(WorkOrder, wid)
         if not w:
             raise HTTPException(status_code=404, detail="Заявка не найдена")
-        w.status = payload.status
+        set_workorder_status(s, w, payload.status, user_id)
         s.add(w)
-        s.commit()
         sev = "success" if payload.status in ("done", "closed") else "info"
         log_event(
             s,
@@ -1064,41 +2690,362 @@ def status_workorder(wid: int, payload: WorkOrderStatus, user_id: int = Depends(
         )
         return Response(status_code=204)
 
+    res = DB_WRITER.run(unit)
+    DISPATCH.refresh(wid)
+    return res
+
+
+def sync_workorder_materials(s: Session, wid: int, items: List[WorkOrderMaterialItem],
+                             remove: Optional[List[int]] = None, replace: bool = True) -> Dict[str, int]:
+    """Привести строки материалов заявки к переданным: только нужные insert/update/delete.
+
+    replace=True — полный список (всё, чего нет в items, удаляется),
+    replace=False — частичное обновление (items добавляются/меняются, remove удаляются).
+    """
+    wanted = {item.material_id: item for item in items}  # повторы material_id отсеивает валидация payload
+    existing: Dict[int, WorkOrderMaterial] = {}
+    to_delete: List[int] = []
+    for m in s.exec(select(WorkOrderMaterial).where(WorkOrderMaterial.work_order_id == wid)).all():
+        if m.material_id in existing:
+            to_delete.append(m.id)  # исторические дубли строк
+        else:
+            existing[m.material_id] = m
+    to_insert = []
+    to_update = []
+    for mid, item in wanted.items():
+        cur = existing.get(mid)
+        if cur is None:
+            to_insert.append({
+                "work_order_id": wid,
+                "material_id": mid,
+                "qty_planned": item.qty_planned,
+                "qty_fact": item.qty_fact,
+            })
+        elif cur.qty_planned != item.qty_planned or cur.qty_fact != item.qty_fact:
+            to_update.append({"id": cur.id, "qty_planned": item.qty_planned, "qty_fact": item.qty_fact})
+    drop = set(existing) - set(wanted) if replace else set(remove or []) - set(wanted)
+    to_delete.extend(existing[mid].id for mid in drop if mid in existing)
+    if to_delete:
+        s.exec(delete(WorkOrderMaterial).where(WorkOrderMaterial.id.in_(to_delete)))
+    if to_update:
+        s.exec(update(WorkOrderMaterial), params=to_update)
+    if to_insert:
+        s.exec(insert(WorkOrderMaterial), params=to_insert)
+    return {"inserted": len(to_insert), "updated": len(to_update), "deleted": len(to_delete)}
+
 
 @app.post(f"/api/{API_VERSION}/workorders/{{wid}}/materials", status_code=204)
 def workorder_materials(wid: int, payload: WorkOrderMaterialsPayload, user_id: int = Depends(current_user_cookie)):
-    with Session(engine) as s:
+    def unit(s: Session):
         w = s.get(WorkOrder, wid)
         if not w:
             raise HTTPException(status_code=404, detail="Заявка не найдена")
-        # очистить старые
-        s.exec("DELETE FROM workordermaterial WHERE work_order_id = :wid", {"wid": wid})
-        for item in payload.items:
-            m = WorkOrderMaterial(
-                work_order_id=wid,
-                material_id=item.material_id,
-                qty_planned=item.qty_planned,
-                qty_fact=item.qty_fact
-            )
-            s.add(m)
-        s.commit()
-        log_event(s, "work_order_materials", f"Материалы по ТОиР #{wid} обновлены", "info", {"work_order_id": wid})
+        stats = sync_workorder_materials(s, wid, payload.items)
+        if any(stats.values()):
+            log_event(s, "work_order_materials", f"Материалы по ТОиР #{wid} обновлены", "info",
+                      {"work_order_id": wid, **stats})
         return Response(status_code=204)
 
+    return DB_WRITER.run(unit)
+
+
+@app.patch(f"/api/{API_VERSION}/workorders/{{wid}}/materials", status_code=204)
+def patch_workorder_materials(wid: int, payload: WorkOrderMaterialsPatch, user_id: int = Depends(current_user_cookie)):
+    def unit(s: Session):
+        w = s.get(WorkOrder, wid)
+        if not w:
+            raise HTTPException(status_code=404, detail="Заявка не найдена")
+        stats = sync_workorder_materials(s, wid, payload.items, payload.remove, replace=False)
+        if any(stats.values()):
+            log_event(s, "work_order_materials", f"Материалы по ТОиР #{wid} обновлены", "info",
+                      {"work_order_id": wid, **stats})
+        return Response(status_code=204)
+
+    return DB_WRITER.run(unit)
+
 
 @app.post(f"/api/{API_VERSION}/workorders/{{wid}}/comment", status_code=201)
 def workorder_comment(wid: int, payload: WorkOrderCommentPayload, user_id: int = Depends(current_user_cookie)):
-    with Session(engine) as s:
+    def unit(s: Session):
         w = s.get(WorkOrder, wid)
         if not w:
             raise HTTPException(status_code=404, detail="Заявка не найдена")
         c = WorkOrderComment(work_order_id=wid, author_id=user_id, text=payload.text)
         s.add(c)
-        s.commit()
-        s.refresh(c)
+        s.flush()
         log_event(s, "work_order_comment", f"Комментарий к ТОиР #{wid}", "info", {"work_order_id": wid})
         return {"id": c.id}
 
+    return DB_WRITER.run(unit)
+
+
+# ---- Dispatch (очередь заявок для бригад) ----
+DISPATCH_STATUSES = ("new", "pending")
+PRIORITY_RANK = {"high": 0, "normal": 1, "low": 2}
+NO_PLANNED_DATE = "9999-12-31"
+
+
+class DispatchQueue:
+    """Очереди открытых заявок в памяти: куча на каждую пару (площадка, бригада).
+
+    Ключ — (приоритет, planned_date, created_at, id): срочные вперёд, без плановой даты —
+    в конец своего приоритета, при равенстве — более старые. Изменённую заявку в куче не
+    ищем: кладём новую запись, а старая становится «мёртвой» и выбрасывается, когда
+    всплывёт наверх. Так и обновление, и выборка стоят O(log n). Куча, где мёртвых записей
+    стало больше живых, пересобирается целиком (редко выбираемые бригады иначе копят их
+    бесконечно). Заявки без бригады лежат под ключом None и видны любой бригаде площадки.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._heaps: Dict[int, Dict[Optional[str], list]] = {}
+        self._live: Dict[int, tuple] = {}  # id заявки -> актуальная запись
+        self._sizes: Dict[int, int] = {}
+        self._heap_live: Dict[Tuple[int, Optional[str]], int] = {}  # живые записи в каждой куче
+        self._gen = 0  # номер rebuild: refresh, прочитавший базу до него, перечитывает заново
+        self._pending: Optional[set] = None  # заявки, обновлённые, пока идёт rebuild
+
+    @staticmethod
+    def _fetch(where: str, params: Tuple = ()) -> List[tuple]:
+        with read_engine.connect() as conn:
+            cur = conn.connection.cursor()
+            try:
+                return cur.execute(
+                    "SELECT id, site_id, status, priority, planned_date, created_at, assigned_team "
+                    "FROM workorder WHERE " + where, params).fetchall()
+            finally:
+                cur.close()
+
+    @staticmethod
+    def _entry(row: tuple) -> tuple:
+        wid, site_id, _status, priority, planned, created, team = row
+        return PRIORITY_RANK.get(priority, 1), planned or NO_PLANNED_DATE, created, wid, site_id, team
+
+    def _push(self, e: tuple):
+        h = self._heaps.setdefault(e[4], {}).setdefault(e[5], [])
+        heapq.heappush(h, e)
+        self._live[e[3]] = e
+        self._sizes[e[4]] = self._sizes.get(e[4], 0) + 1
+        live = self._heap_live[e[4], e[5]] = self._heap_live.get((e[4], e[5]), 0) + 1
+        if len(h) > 2 * live + 32:
+            h[:] = [x for x in h if self._live.get(x[3]) is x]
+            heapq.heapify(h)
+
+    def _discard(self, wid: int):
+        e = self._live.pop(wid, None)
+        if e is not None:
+            self._sizes[e[4]] -= 1
+            self._heap_live[e[4], e[5]] -= 1
+
+    def rebuild(self):
+        if DB_WRITER.in_unit():  # изнутри пакетной записи база ещё не закоммичена
+            return DB_WRITER.defer(self.rebuild)
+        with self._lock:
+            self._gen += 1
+            self._pending = set()
+        statuses = ",".join("?" * len(DISPATCH_STATUSES))
+        rows = self._fetch(f"status IN ({statuses})", DISPATCH_STATUSES)
+        heaps: Dict[int, Dict[Optional[str], list]] = {}
+        live, sizes, heap_live = {}, {}, {}
+        for row in rows:
+            e = self._entry(row)
+            heaps.setdefault(e[4], {}).setdefault(e[5], []).append(e)
+            live[e[3]] = e
+            sizes[e[4]] = sizes.get(e[4], 0) + 1
+            heap_live[e[4], e[5]] = heap_live.get((e[4], e[5]), 0) + 1
+        for teams in heaps.values():
+            for h in teams.values():
+                heapq.heapify(h)
+        with self._lock:
+            self._heaps, self._live, self._sizes, self._heap_live = heaps, live, sizes, heap_live
+            pending, self._pending = self._pending, None
+        # обновления, пришедшие во время чтения, могли не попасть в снимок — перечитываем их
+        self.refresh(*pending)
+
+    def refresh(self, *wids: int):
+        """Перечитать заявки из базы после записи: вставить, переставить или убрать из очереди."""
+        if not wids:
+            return
+        if DB_WRITER.in_unit():
+            return DB_WRITER.defer(self.refresh, *wids)
+        while True:
+            gen = self._gen
+            rows = {r[0]: r for r in self._fetch(f"id IN ({','.join('?' * len(wids))})", wids)}
+            with self._lock:
+                if self._pending is not None:
+                    self._pending.update(wids)  # rebuild ещё читает — перечитает их после замены
+                elif gen != self._gen:
+                    continue  # между чтением и блокировкой прошёл rebuild: строки могли устареть
+                for wid in wids:
+                    self._discard(wid)
+                    row = rows.get(wid)
+                    if row and row[2] in DISPATCH_STATUSES:
+                        self._push(self._entry(row))
+                return
+
+    def _top(self, h: list) -> Optional[tuple]:
+        while h and self._live.get(h[0][3]) is not h[0]:
+            heapq.heappop(h)
+        return h[0] if h else None
+
+    def _candidates(self, site_id: int, team: Optional[str]) -> List[list]:
+        teams = self._heaps.get(site_id, {})
+        if team is None:
+            return list(teams.values())
+        return [h for h in (teams.get(team), teams.get(None)) if h]
+
+    def peek(self, site_id: int, team: Optional[str] = None) -> Optional[tuple]:
+        with self._lock:
+            tops = [t for t in (self._top(h) for h in self._candidates(site_id, team)) if t]
+            return min(tops) if tops else None
+
+    def pop(self, site_id: int, team: Optional[str] = None) -> Optional[tuple]:
+        with self._lock:
+            best = None
+            for h in self._candidates(site_id, team):
+                top = self._top(h)
+                if top and (best is None or top < best[0]):
+                    best = (top, h)
+            if best is None:
+                return None
+            heapq.heappop(best[1])
+            self._discard(best[0][3])
+            return best[0]
+
+    def size(self, site_id: int) -> int:
+        return self._sizes.get(site_id, 0)
+
+
+DISPATCH = DispatchQueue()
+
+
+@app.get(f"/api/{API_VERSION}/dispatch/next")
+def dispatch_next(
+    site_id: int,
+    team: Optional[str] = None,
+    mode: str = Query(default="peek", pattern="^(peek|pop)$"),
+    user_id: int = Depends(current_user_cookie),
+):
+    """Следующая заявка площадки для бригады.
+
+    peek только показывает её; pop забирает: заявка уходит в работу (in_progress)
+    и закрепляется за бригадой. Записи, разошедшиеся с базой, по пути пересинхронизируются.
+    """
+    while True:
+        e = DISPATCH.peek(site_id, team) if mode == "peek" else DISPATCH.pop(site_id, team)
+        if e is None:
+            return {"site_id": site_id, "team": team, "queue_size": DISPATCH.size(site_id), "result": None}
+        wid = e[3]
+        if mode == "peek":
+            with Session(read_engine) as s:
+                w = s.get(WorkOrder, wid)
+                res = workorder_out(w) if w and w.status in DISPATCH_STATUSES else None
+        else:
+            def unit(s: Session):
+                w = s.get(WorkOrder, wid)
+                if not w or w.status not in DISPATCH_STATUSES or (team and w.assigned_team not in (None, team)):
+                    return None
+                set_workorder_status(s, w, "in_progress", user_id)
+                if team:
+                    w.assigned_team = team
+                s.add(w)
+                log_event(s, "work_order_dispatch", f"ТОиР #{wid} выдана в работу" + (f" бригаде {team}" if team else ""),
+                          "info", {"work_order_id": wid, "team": team})
+                return workorder_out(w)
+
+            try:
+                res = DB_WRITER.run(unit)
+            except Exception:
+                DISPATCH.refresh(wid)
+                raise
+        if res is not None:
+            return {"site_id": site_id, "team": team, "queue_size": DISPATCH.size(site_id), "result": res}
+        DISPATCH.refresh(wid)
+
+
+# ---- Preventive maintenance (ППР) ----
+class EquipmentTypeUpdate(BaseModel):
+    name: Optional[str] = None
+    pm_interval_days: Optional[int] = None
+
+
+PM_MAX_HORIZON_DAYS = 366  # один запуск — один INSERT в транзакции писателя, горизонт не больше года
+
+
+class PmGeneratePayload(BaseModel):
+    horizon_days: int = Field(default=30, ge=0, le=PM_MAX_HORIZON_DAYS)
+    site_id: Optional[int] = None
+    start: Optional[date] = None  # по умолчанию — сегодня
+    priority: Literal["high", "normal", "low"] = "normal"  # ключи PRIORITY_RANK
+
+
+# Один INSERT ... SELECT на весь парк. Для каждого станка якорь — последнее плановое
+# ТО (ix_workorder_pm), а если его не было — дата ввода в эксплуатацию. Первый срок —
+# якорь + интервал, но не раньше :start (просроченное ТО ставится на сегодня один раз),
+# дальше шаг интервала до :until. Повторный запуск начинает с уже созданных заявок
+# и ничего не дублирует.
+PM_GENERATE_SQL = """
+INSERT INTO workorder (site_id, type, status, priority, title, description, equipment_id, planned_date, created_at)
+WITH RECURSIVE
+fleet(eid, site_id, name, iv, anchor) AS (
+    SELECT e.id, e.site_id, e.name, COALESCE(e.pm_interval_days, t.pm_interval_days),
+           COALESCE((SELECT MAX(w.planned_date) FROM workorder w
+                     WHERE w.equipment_id = e.id AND w.type = 'preventive'), e.commissioning_date)
+    FROM equipment e JOIN equipmenttype t ON t.id = e.equipment_type_id
+    WHERE e.status != 'inactive' AND COALESCE(e.pm_interval_days, t.pm_interval_days) > 0 {site_filter}
+),
+due(eid, site_id, name, iv, d) AS (
+    SELECT eid, site_id, name, iv, MAX(date(anchor, '+' || iv || ' days'), :start) FROM fleet
+    UNION ALL
+    SELECT eid, site_id, name, iv, date(d, '+' || iv || ' days') FROM due
+    WHERE date(d, '+' || iv || ' days') <= :until
+)
+SELECT site_id, 'preventive', 'new', :priority, 'Плановое ТО: ' || name,
+       'Сформировано по периодичности ' || iv || ' дн.', eid, d, :now
+FROM due WHERE d <= :until
+"""
+
+
+@app.put(f"/api/{API_VERSION}/equipment-types/{{tid}}", status_code=204)
+def update_equipment_type(tid: int, payload: EquipmentTypeUpdate, user_id: int = Depends(current_user_cookie)):
+    def unit(s: Session):
+        et = s.get(EquipmentType, tid)
+        if not et:
+            raise HTTPException(status_code=404, detail="Тип оборудования не найден")
+        if payload.name is not None:
+            et.name = payload.name
+        if "pm_interval_days" in payload.model_fields_set:  # явный null снимает периодичность
+            et.pm_interval_days = payload.pm_interval_days
+        s.add(et)
+        log_event(s, "equipment_type_updated", f"Обновлён тип оборудования #{tid}", "info",
+                  {"equipment_type_id": tid, "pm_interval_days": et.pm_interval_days})
+        return Response(status_code=204)
+
+    return DB_WRITER.run(unit)
+
+
+@app.post(f"/api/{API_VERSION}/maintenance/preventive/generate")
+def generate_preventive(payload: PmGeneratePayload, user_id: int = Depends(current_user_cookie)):
+    """Создать плановые заявки ТОиР на горизонт по всему парку (или площадке) одной транзакцией."""
+    start = payload.start or datetime.utcnow().date()
+    until = start + timedelta(days=payload.horizon_days)
+    sql = PM_GENERATE_SQL.format(site_filter="AND e.site_id = :site_id" if payload.site_id else "")
+    params = {"start": start.isoformat(), "until": until.isoformat(), "priority": payload.priority,
+              "now": datetime.utcnow().isoformat(sep=" "), "site_id": payload.site_id}
+
+    def unit(s: Session):
+        created = s.connection().exec_driver_sql(sql, params).rowcount
+        if created:
+            log_event(s, "pm_generated", f"Сформировано плановых заявок ТОиР: {created}", "info",
+                      {"created": created, "start": params["start"], "until": params["until"],
+                       "site_id": payload.site_id})
+        return {"created": created, "start": params["start"], "until": params["until"]}
+
+    res = DB_WRITER.run(unit)
+    if res["created"]:
+        DISPATCH.rebuild()
+    return res
+
 
 # ---- Supply (suppliers & purchase_orders) ----
 class SupplierCreate(BaseModel):
@@ -1110,10 +3057,16 @@ class SupplierUpdate(SupplierCreate):
     pass
 
 
+class PurchaseOrderLineItem(BaseModel):
+    material_id: int
+    qty: float
+
+
 class PurchaseOrderCreate(BaseModel):
     supplier_id: int
     site_id: int
     comment: Optional[str] = None
+    lines: List[PurchaseOrderLineItem] = []
 
 
 class PurchaseOrderUpdate(BaseModel):
@@ -1123,39 +3076,41 @@ class PurchaseOrderUpdate(BaseModel):
 
 @app.get(f"/api/{API_VERSION}/suppliers")
 def list_suppliers(_: int = Depends(current_user_cookie)):
-    with Session(engine) as s:
+    with Session(read_engine) as s:
         rows = s.exec(select(Supplier)).all()
         return {"results": [{"id": r.id, "name": r.name, "contact": r.contact} for r in rows]}
 
 
 @app.post(f"/api/{API_VERSION}/suppliers", status_code=201)
 def create_supplier(payload: SupplierCreate, user_id: int = Depends(current_user_cookie)):
-    with Session(engine) as s:
+    def unit(s: Session):
         sup = Supplier(**payload.dict())
         s.add(sup)
-        s.commit()
-        s.refresh(sup)
+        s.flush()
         log_event(s, "supplier_created", f"Добавлен поставщик {sup.name}", "success", {"supplier_id": sup.id})
         return {"id": sup.id}
 
+    return DB_WRITER.run(unit)
+
 
 @app.put(f"/api/{API_VERSION}/suppliers/{{sid}}", status_code=204)
 def update_supplier(sid: int, payload: SupplierUpdate, user_id: int = Depends(current_user_cookie)):
-    with Session(engine) as s:
+    def unit(s: Session):
         sup = s.get(Supplier, sid)
         if not sup:
             raise HTTPException(status_code=404, detail="Поставщик не найден")
         sup.name = payload.name
         sup.contact = payload.contact
         s.add(sup)
-        s.commit()
         log_event(s, "supplier_updated", f"Обновлён поставщик #{sid}", "info", {"supplier_id": sid})
         return Response(status_code=204)
 
+    return DB_WRITER.run(unit)
+
 
 @app.get(f"/api/{API_VERSION}/purchase_orders")
 def list_purchase_orders(_: int = Depends(current_user_cookie)):
-    with Session(engine) as s:
+    with Session(read_engine) as s:
         pos = s.exec(select(PurchaseOrder)).all()
         out = []
         for p in pos:
@@ -1176,18 +3131,23 @@ def list_purchase_orders(_: int = Depends(current_user_cookie)):
 
 @app.post(f"/api/{API_VERSION}/purchase_orders", status_code=201)
 def create_purchase_order(payload: PurchaseOrderCreate, user_id: int = Depends(current_user_cookie)):
-    with Session(engine) as s:
-        po = PurchaseOrder(**payload.dict())
+    def unit(s: Session):
+        po = PurchaseOrder(**payload.dict(exclude={"lines"}))
         s.add(po)
-        s.commit()
-        s.refresh(po)
+        s.flush()
+        if payload.lines:
+            s.exec(insert(PurchaseOrderLine), params=[
+                {"purchase_order_id": po.id, "material_id": ln.material_id, "qty": ln.qty} for ln in payload.lines
+            ])
         log_event(s, "po_created", f"Создан заказ поставщику #{po.id}", "info", {"po_id": po.id})
         return {"id": po.id}
 
+    return DB_WRITER.run(unit)
+
 
 @app.put(f"/api/{API_VERSION}/purchase_orders/{{pid}}", status_code=204)
 def update_purchase_order(pid: int, payload: PurchaseOrderUpdate, user_id: int = Depends(current_user_cookie)):
-    with Session(engine) as s:
+    def unit(s: Session):
         po = s.get(PurchaseOrder, pid)
         if not po:
             raise HTTPException(status_code=404, detail="Заказ не найден")
@@ -1196,10 +3156,87 @@ def update_purchase_order(pid: int, payload: PurchaseOrderUpdate, user_id: int =
         if payload.comment is not None:
             po.comment = payload.comment
         s.add(po)
-        s.commit()
         log_event(s, "po_updated", f"Обновлён заказ поставщику #{pid}", "info", {"po_id": pid})
         return Response(status_code=204)
 
+    return DB_WRITER.run(unit)
+
+
+class ReplenishPayload(BaseModel):
+    site_id: Optional[int] = None
+    dry_run: bool = False
+
+
+# Все позиции ниже точки заказа одним запросом (частичный индекс ix_inventory_low).
+# Поставщик — предпочтительный у материала, иначе тот, у кого материал заказывали
+# последним. Из потребности вычитается уже заказанное в открытых заказах, поэтому
+# повторный запуск ничего не дублирует.
+REPLENISH_SQL = """
+SELECT i.site_id, i.material_id, i.qty_on_hand, i.reorder_point,
+       COALESCE(m.preferred_supplier_id, (
+           SELECT o.supplier_id FROM purchaseorderline l JOIN purchaseorder o ON o.id = l.purchase_order_id
+           WHERE l.material_id = i.material_id ORDER BY l.id DESC LIMIT 1)),
+       COALESCE((
+           SELECT SUM(MAX(l.qty - l.qty_received, 0))
+           FROM purchaseorderline l JOIN purchaseorder o ON o.id = l.purchase_order_id
+           WHERE l.material_id = i.material_id AND o.site_id = i.site_id AND o.status IN ({open_statuses})), 0)
+FROM inventory i JOIN material m ON m.id = i.material_id
+WHERE i.qty_on_hand < i.reorder_point {site_filter}
+ORDER BY i.site_id, i.material_id
+"""
+
+
+@app.post(f"/api/{API_VERSION}/purchase_orders/replenish")
+def replenish_purchase_orders(payload: ReplenishPayload, user_id: int = Depends(current_user_cookie)):
+    """Создать заказы поставщикам по позициям ниже точки заказа: один заказ на площадку × поставщика.
+
+    Заказывается до уровня reorder_point × REPLENISH_TARGET_FACTOR за вычетом остатка
+    и открытых заказов; всё — одной транзакцией писателя.
+    """
+    sql = REPLENISH_SQL.format(open_statuses=",".join(f"'{x}'" for x in MRP_OPEN_PO),
+                               site_filter="AND i.site_id = :site_id" if payload.site_id else "")
+
+    def unit(s: Session):
+        conn = s.connection()
+        groups: Dict[Tuple[int, int], List[Dict[str, Any]]] = {}
+        no_supplier = covered = 0
+        for site_id, material_id, on_hand, rp, supplier_id, on_order in conn.exec_driver_sql(
+                sql, {"site_id": payload.site_id}):
+            qty = round(rp * REPLENISH_TARGET_FACTOR - on_hand - on_order, 3)
+            if qty <= 0:
+                covered += 1
+            elif supplier_id is None:
+                no_supplier += 1
+            else:
+                groups.setdefault((site_id, supplier_id), []).append({"material_id": material_id, "qty": qty})
+        orders = []
+        if groups and not payload.dry_run:
+            # писатель один, поэтому id заказов можно раздать заранее и вставить всё пачками
+            next_id = (conn.exec_driver_sql("SELECT COALESCE(MAX(id), 0) FROM purchaseorder").scalar() or 0) + 1
+            now = datetime.utcnow()
+            po_rows, line_rows = [], []
+            for po_id, ((site_id, supplier_id), lines) in enumerate(sorted(groups.items()), start=next_id):
+                po_rows.append({"id": po_id, "supplier_id": supplier_id, "site_id": site_id, "status": "draft",
+                                "comment": f"Автопополнение: позиций {len(lines)}", "created_at": now})
+                line_rows.extend({"purchase_order_id": po_id, **ln} for ln in lines)
+                orders.append({"id": po_id, "site_id": site_id, "supplier_id": supplier_id, "lines": len(lines)})
+            s.exec(insert(PurchaseOrder), params=po_rows)
+            s.exec(insert(PurchaseOrderLine), params=line_rows)
+            log_event(s, "po_replenish", f"Автопополнение: создано заказов {len(orders)}", "info",
+                      {"orders": len(orders), "lines": len(line_rows), "site_id": payload.site_id})
+        elif groups:
+            orders = [{"id": None, "site_id": k[0], "supplier_id": k[1], "lines": len(v)}
+                      for k, v in sorted(groups.items())]
+        return {
+            "dry_run": payload.dry_run,
+            "orders": orders,
+            "lines": sum(o["lines"] for o in orders),
+            "covered_by_open_orders": covered,
+            "skipped_no_supplier": no_supplier,
+        }
+
+    return DB_WRITER.run(unit)
+
 
 # ---- Plans ----
 class PlanCreate(BaseModel):
@@ -1215,7 +3252,7 @@ class PlanItemCreate(BaseModel):
 
 @app.get(f"/api/{API_VERSION}/plans")
 def list_plans(site_id: Optional[int] = None, _: int = Depends(current_user_cookie)):
-    with Session(engine) as s:
+    with Session(read_engine) as s:
         q = select(ProductionPlan)
         if site_id:
             q = q.where(ProductionPlan.site_id == site_id)
@@ -1235,18 +3272,19 @@ def list_plans(site_id: Optional[int] = None, _: int = Depends(current_user_cook
 
 @app.post(f"/api/{API_VERSION}/plans", status_code=201)
 def create_plan(payload: PlanCreate, user_id: int = Depends(current_user_cookie)):
-    with Session(engine) as s:
+    def unit(s: Session):
         p = ProductionPlan(**payload.dict())
         s.add(p)
-        s.commit()
-        s.refresh(p)
+        s.flush()
         log_event(s, "plan_created", f"Создан план {p.period} @ site {p.site_id}", "info", {"plan_id": p.id})
         return {"id": p.id}
 
+    return DB_WRITER.run(unit)
+
 
 @app.get(f"/api/{API_VERSION}/plans/{{pid}}")
 def get_plan(pid: int, _: int = Depends(current_user_cookie)):
-    with Session(engine) as s:
+    with Session(read_engine) as s:
         p = s.get(ProductionPlan, pid)
         if not p:
             raise HTTPException(status_code=404, detail="План не найден")
@@ -1264,57 +3302,386 @@ def get_plan(pid: int, _: int = Depends(current_user_cookie)):
 
 @app.post(f"/api/{API_VERSION}/plans/{{pid}}/items", status_code=201)
 def add_plan_item(pid: int, payload: PlanItemCreate, user_id: int = Depends(current_user_cookie)):
-    with Session(engine) as s:
+    def unit(s: Session):
         p = s.get(ProductionPlan, pid)
         if not p:
             raise HTTPException(status_code=404, detail="План не найден")
         item = PlanItem(plan_id=pid, product_name=payload.product_name, quantity=payload.quantity)
         s.add(item)
-        s.commit()
-        s.refresh(item)
+        s.flush()
         log_event(s, "plan_item", f"Добавлена позиция в план #{pid}", "info",
                   {"plan_id": pid, "item_id": item.id})
         return {"id": item.id}
 
+    return DB_WRITER.run(unit)
+
+
+# ---- BOM ----
+class BomItem(BaseModel):
+    material_id: int
+    qty_per_unit: float
+
+
+class BomPayload(BaseModel):
+    items: List[BomItem] = []
+
+
+@app.get(f"/api/{API_VERSION}/bom")
+def get_bom(product_name: str, _: int = Depends(current_user_cookie)):
+    with Session(read_engine) as s:
+        rows = s.exec(select(ProductMaterial).where(ProductMaterial.product_name == product_name)).all()
+        return {"product_name": product_name, "items": [
+            {"material_id": r.material_id, "qty_per_unit": r.qty_per_unit} for r in rows
+        ]}
+
+
+@app.put(f"/api/{API_VERSION}/bom", status_code=204)
+def put_bom(product_name: str, payload: BomPayload, user_id: int = Depends(current_user_cookie)):
+    def unit(s: Session):
+        s.exec(delete(ProductMaterial).where(ProductMaterial.product_name == product_name))
+        if payload.items:
+            s.exec(insert(ProductMaterial), params=[
+                {"product_name": product_name, "material_id": i.material_id, "qty_per_unit": i.qty_per_unit}
+                for i in payload.items
+            ])
+        log_event(s, "bom_updated", f"Обновлена спецификация «{product_name}»", "info",
+                  {"product_name": product_name, "items": len(payload.items)})
+        return Response(status_code=204)
+
+    return DB_WRITER.run(unit)
+
+
+# ---- MRP ----
+# Потребность считается по месяцам: период — номер месяца year*12 + month-1,
+# чтобы SQLite сразу отдавал числа, а не строки; выражение одинаково годится
+# для date/datetime в ISO-виде и для period плана 'YYYY-MM'.
+_MONTH_SQL = "CAST(substr({0}, 1, 4) AS INTEGER) * 12 + CAST(substr({0}, 6, 2) AS INTEGER) - 1"
+MRP_CLOSED_WO = ("done", "closed")
+MRP_OPEN_PO = ("draft", "in_progress")
+
+
+def month_index(period: str) -> int:
+    try:
+        y, m = period.split("-")
+        y, m = int(y), int(m)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Период ожидается в формате YYYY-MM")
+    if not 1 <= m <= 12:
+        raise HTTPException(status_code=400, detail="Период ожидается в формате YYYY-MM")
+    return y * 12 + m - 1
+
+
+def month_label(idx: int) -> str:
+    return f"{idx // 12:04d}-{idx % 12 + 1:02d}"
+
+
+MRP_CACHE_SIZE = 64
+_MRP_ARRAYS: Dict[Tuple[str, Tuple], Tuple[Tuple[int, ...], np.ndarray]] = {}
+_MRP_LOCK = threading.Lock()
+
+
+def _fetch_array(conn, sql: str, params=None, width: int = 4) -> np.ndarray:
+    """Результат запроса как массив float64 (NULL -> nan) без кэша."""
+    cur = conn.connection.cursor()
+    try:
+        rows = cur.execute(sql, params or {}).fetchall()
+    finally:
+        cur.close()
+    return np.asarray(rows, dtype=np.float64) if rows else np.empty((0, width))
+
+
+def _columns(conn, sql: str, tables: Tuple[str, ...], params: Optional[dict] = None, width: int = 4) -> np.ndarray:
+    """Результат запроса как массив float64 с кэшем до следующей записи в tables.
+
+    Строки берутся прямо из курсора DBAPI: объект Row SQLAlchemy на каждую строку
+    стоит дороже, чем весь последующий расчёт.
+    """
+    key = (sql, tuple(sorted((params or {}).items())))
+    version = DB_WRITER.version(*tables)
+    hit = _MRP_ARRAYS.get(key)
+    if hit is not None and hit[0] == version:
+        return hit[1]
+    arr = _fetch_array(conn, sql, params, width)
+    arr.flags.writeable = False
+    with _MRP_LOCK:
+        if key not in _MRP_ARRAYS and len(_MRP_ARRAYS) >= MRP_CACHE_SIZE:
+            _MRP_ARRAYS.pop(next(iter(_MRP_ARRAYS)))
+        _MRP_ARRAYS[key] = (version, arr)
+    return arr
+
+
+def _positions(keys: np.ndarray, values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Индексы values в отсортированном keys и маска найденных."""
+    if not len(keys):
+        return np.zeros(len(values), dtype=np.int64), np.zeros(len(values), dtype=bool)
+    pos = np.minimum(np.searchsorted(keys, values), len(keys) - 1)
+    return pos, keys[pos] == values
+
+
+def compute_mrp(conn, start: int, periods: int, site_ids: Optional[List[int]] = None) -> Dict[str, Any]:
+    """Чистая потребность площадка × материал × период одним проходом по массивам.
+
+    Строки массивов — только пары (площадка, материал) с валовой потребностью: плотный
+    куб S × M × P на всём справочнике материалов занимал бы сотни мегабайт.
+
+    Валовая потребность — открытые строки заявок ТОиР (qty_planned − qty_fact, по месяцу
+    planned_date, иначе created_at) плюс позиции планов производства, развёрнутые по BOM.
+    Просроченное падает в первый период, всё за горизонтом отбрасывается. Брутто делится
+    на (1 − брак%), затем из накопленной суммы вычитаются остаток и открытые заказы
+    поставщикам; дефицит периода — приращение накопленного дефицита.
+    """
+    site_filter, site_where = "", ""
+    if site_ids:
+        id_list = ",".join(str(int(x)) for x in site_ids)
+        site_filter, site_where = f" AND {{0}}.site_id IN ({id_list})", f" WHERE id IN ({id_list})"
+    wo_status = ",".join(f"'{x}'" for x in MRP_CLOSED_WO)
+    po_status = ",".join(f"'{x}'" for x in MRP_OPEN_PO)
+    wo_tables = ("workorder", "workordermaterial")
+    plan_tables = ("productionplan", "planitem", "productmaterial")
+    wo_from = f"""
+        FROM workordermaterial m JOIN workorder w ON w.id = m.work_order_id
+        WHERE w.status NOT IN ({wo_status}) AND m.qty_planned > m.qty_fact""" + site_filter.format("w")
+    plan_from = """
+        FROM planitem i
+        JOIN productionplan p ON p.id = i.plan_id
+        JOIN productmaterial b ON b.product_name = i.product_name
+        WHERE p.period >= :start""" + site_filter.format("p")
+
+    sites = _columns(conn, "SELECT id FROM site" + site_where + " ORDER BY id", ("site",), width=1)[:, 0]
+    mats = _columns(conn, "SELECT id, COALESCE(reject_percent, 0) FROM material ORDER BY id", ("material",), width=2)
+    wo = _columns(conn, f"""
+        SELECT w.site_id, m.material_id, {_MONTH_SQL.format("COALESCE(w.planned_date, w.created_at)")},
+               m.qty_planned - m.qty_fact""" + wo_from, wo_tables)
+    plan = _columns(conn, f"""
+        SELECT p.site_id, b.material_id, {_MONTH_SQL.format("p.period")}, SUM(i.quantity * b.qty_per_unit)"""
+        + plan_from + " GROUP BY 1, 2, 3", plan_tables, {"start": month_label(start)})
+    # остаток нужен только там, где есть потребность: полная выборка склада — самая дорогая часть
+    inv = _columns(conn, f"""
+        SELECT i.site_id, i.material_id, i.qty_on_hand FROM inventory i
+        WHERE (i.site_id, i.material_id) IN (
+            SELECT w.site_id, m.material_id {wo_from}
+            UNION SELECT p.site_id, b.material_id {plan_from})""",
+        ("inventory",) + wo_tables + plan_tables, {"start": month_label(start)}, width=3)
+    po = _columns(conn, f"""
+        SELECT o.site_id, l.material_id, SUM(MAX(l.qty - l.qty_received, 0))
+        FROM purchaseorderline l JOIN purchaseorder o ON o.id = l.purchase_order_id
+        WHERE o.status IN ({po_status})""" + site_filter.format("o") + " GROUP BY 1, 2",
+        ("purchaseorder", "purchaseorderline"), width=3)
+
+    mat_ids = mats[:, 0]
+    M, P = len(mat_ids), periods
+
+    def pair_keys(data: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        # data: site_id, material_id, ... -> ключ пары (индекс площадки × M + индекс материала) и маска
+        si, ok_s = _positions(sites, data[:, 0])
+        mi, ok_m = _positions(mat_ids, data[:, 1])
+        return si * M + mi, ok_s & ok_m
+
+    (wo_k, wo_ok), (plan_k, plan_ok) = pair_keys(wo), pair_keys(plan)
+    pairs = np.unique(np.concatenate([wo_k[wo_ok], plan_k[plan_ok]]))  # по возрастанию: площадка, материал
+    K = len(pairs)
+
+    def cube(data: np.ndarray, keys: np.ndarray, ok: np.ndarray) -> np.ndarray:
+        # data: site_id, material_id, month, qty
+        pi = np.clip(data[:, 2] - start, 0, None).astype(np.int64)
+        ok = ok & (pi < P)
+        row = np.searchsorted(pairs, keys[ok])
+        return np.bincount(row * P + pi[ok], weights=data[ok, 3], minlength=K * P).reshape(K, P)
+
+    def plane(data: np.ndarray) -> np.ndarray:
+        # data: site_id, material_id, qty; пары без потребности не нужны
+        keys, ok = pair_keys(data)
+        row, hit = _positions(pairs, keys)
+        ok &= hit
+        return np.bincount(row[ok], weights=data[ok, 2], minlength=K)
+
+    scrap = np.clip(mats[:, 1], 0, 99) / 100.0
+    gross = (cube(wo, wo_k, wo_ok) + cube(plan, plan_k, plan_ok)) / (1.0 - scrap[pairs % max(M, 1)])[:, None]
+    on_hand, on_order = plane(inv), plane(po)
+    shortage = np.maximum(np.cumsum(gross, axis=1) - (on_hand + on_order)[:, None], 0.0)
+    net = np.diff(shortage, axis=1, prepend=0.0)
+    return {"sites": sites[pairs // max(M, 1)], "materials": mat_ids[pairs % max(M, 1)], "gross": gross,
+            "on_hand": on_hand, "on_order": on_order, "net": net}
+
+
+MRP_MAX_PERIODS = 36
+
+
+@app.get(f"/api/{API_VERSION}/mrp")
+def mrp(
+    start: Optional[str] = None,
+    periods: int = Query(default=6, ge=1, le=MRP_MAX_PERIODS),
+    site_id: Optional[List[int]] = Query(default=None),
+    page: int = Query(default=1, ge=1),
+    page_size: int = Query(default=500, ge=1, le=5000),
+    _: int = Depends(current_user_cookie),
+):
+    first = month_index(start) if start else month_index(datetime.utcnow().strftime("%Y-%m"))
+    with read_engine.connect() as conn:
+        r = compute_mrp(conn, first, periods, site_id)
+    net = r["net"]
+    ki, pi = np.nonzero(net > 1e-9)
+    total = len(ki)
+    lo, hi = (page - 1) * page_size, page * page_size
+    ki, pi = ki[lo:hi], pi[lo:hi]
+    return {
+        "start": month_label(first),
+        "periods": [month_label(first + i) for i in range(periods)],
+        "total": total,
+        "page": page,
+        "page_size": page_size,
+        "net_by_period": [round(float(x), 3) for x in net.sum(axis=0)],
+        "results": [
+            {
+                "site_id": int(r["sites"][k]),
+                "material_id": int(r["materials"][k]),
+                "period": month_label(first + int(c)),
+                "gross": round(float(r["gross"][k, c]), 3),
+                "on_hand": float(r["on_hand"][k]),
+                "on_order": float(r["on_order"][k]),
+                "net": round(float(net[k, c]), 3),
+            }
+            for k, c in zip(ki.tolist(), pi.tolist())
+        ],
+    }
+
 
 # ---- Events & Reports ----
+EVENTS_MAX_LIMIT = 500
+
+
+def _event_kinds(conn, prefixes: List[str], severities: List[str]) -> List[Tuple[str, str]]:
+    """Пары (type, severity), которые есть в журнале, с учётом фильтров.
+
+    Пар немного, а ix_event_feed позволяет перечислить их прыжками MIN(...) по индексу,
+    не читая сами события: по одному поиску на пару.
+    """
+    kinds = []
+    typ = conn.exec_driver_sql("SELECT MIN(type) FROM event").scalar()
+    while typ is not None:
+        if not prefixes or typ.startswith(tuple(prefixes)):
+            sev = conn.exec_driver_sql("SELECT MIN(severity) FROM event WHERE type = ?", (typ,)).scalar()
+            while sev is not None:
+                if not severities or sev in severities:
+                    kinds.append((typ, sev))
+                sev = conn.exec_driver_sql(
+                    "SELECT MIN(severity) FROM event WHERE type = ? AND severity > ?", (typ, sev)).scalar()
+        typ = conn.exec_driver_sql("SELECT MIN(type) FROM event WHERE type > ?", (typ,)).scalar()
+    return kinds
+
+
 @app.get(f"/api/{API_VERSION}/events")
-def get_events(limit: int = 40, _: int = Depends(current_user_cookie)):
-    with Session(engine) as s:
-        ev = s.exec(select(Event).order_by(Event.created_at.desc()).limit(limit)).all()
-        return {"results": [
+def get_events(
+    limit: int = Query(default=40, ge=1, le=EVENTS_MAX_LIMIT),
+    types: List[str] = Query(default=[], alias="type"),
+    severity: List[str] = Query(default=[]),
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    before_id: Optional[int] = None,
+    after_id: Optional[int] = None,
+    _: int = Depends(current_user_cookie)
+):
+    """Лента событий, новые сверху.
+
+    type — префиксы типа (plan, work_order, po_, auth; можно несколько), severity — точные
+    значения, since/until — полуинтервал [since, until) по created_at.
+
+    before_id листает ленту назад от уже показанного события. after_id — опрос: только
+    события с id больше курсора, самые старые из них первыми limit штук (more=true, если
+    осталось ещё). В ответе cursor — значение after_id для следующего опроса: до него журнал
+    уже просмотрен, так что и с редким фильтром опрос читает только новые строки.
+    """
+    prefixes = [p for p in types if p]
+    time_sql, time_args = "", []
+    if since:
+        time_sql += " AND created_at >= ?"
+        time_args.append(utc_naive(since).isoformat(sep=" "))
+    if until:
+        time_sql += " AND created_at < ?"
+        time_args.append(utc_naive(until).isoformat(sep=" "))
+    cols = "SELECT id, type, text, severity, created_at FROM event"
+    with read_engine.connect() as conn:
+        head = conn.exec_driver_sql("SELECT MAX(id) FROM event").scalar() or 0
+        if after_id is not None:
+            # новых строк мало — идём по первичному ключу, фильтры проверяем построчно
+            # (NOT INDEXED: иначе планировщик возьмёт ix_event_feed и прочитает весь тип)
+            kind_sql, kind_args = "", []
+            if prefixes:
+                kind_sql += " AND (" + " OR ".join("(type >= ? AND type < ?)" for _ in prefixes) + ")"
+                for p in prefixes:
+                    kind_args += [p, p[:-1] + chr(ord(p[-1]) + 1)]
+            if severity:
+                kind_sql += f" AND severity IN ({', '.join('?' * len(severity))})"
+                kind_args += severity
+            rows = conn.exec_driver_sql(
+                f"{cols} NOT INDEXED WHERE id > ? AND id <= ?{kind_sql}{time_sql} ORDER BY id LIMIT ?",
+                (after_id, head, *kind_args, *time_args, limit + 1)).all()
+            more = len(rows) > limit
+            rows = rows[:limit]
+            cursor = rows[-1][0] if more else max(head, after_id)
+            rows.reverse()
+        else:
+            # по каждой паре (type, severity) — короткий спуск по ix_event_feed от верхней
+            # границы, затем слияние: без сортировки всего журнала на каждый запрос
+            page_sql, page_args = "", []
+            if before_id is not None:
+                at = conn.exec_driver_sql("SELECT created_at FROM event WHERE id = ?", (before_id,)).scalar()
+                if at is None:
+                    page_sql, page_args = " AND id < ?", [before_id]
+                else:
+                    page_sql, page_args = " AND created_at <= ? AND (created_at < ? OR id < ?)", [at, at, before_id]
+            streams = [
+                conn.exec_driver_sql(
+                    f"{cols} WHERE type = ? AND severity = ?{time_sql}{page_sql} "
+                    "ORDER BY created_at DESC, id DESC LIMIT ?",
+                    (typ, sev, *time_args, *page_args, limit + 1)).all()
+                for typ, sev in _event_kinds(conn, prefixes, severity)
+            ]
+            rows = list(heapq.merge(*streams, key=lambda r: (r[4], r[0]), reverse=True))[:limit + 1]
+            more = len(rows) > limit
+            rows = rows[:limit]
+            cursor = head
+    return {
+        "results": [
             {
-                "id": e.id,
-                "type": e.type,
-                "text": e.text,
-                "severity": e.severity,
-                "created_at": e.created_at.isoformat()
+                "id": r[0],
+                "type": r[1],
+                "text": r[2],
+                "severity": r[3],
+                "created_at": datetime.fromisoformat(r[4]).isoformat()
             }
-            for e in ev
-        ]}
+            for r in rows
+        ],
+        "more": more,
+        "cursor": cursor,
+    }
 
 
 @app.get(f"/api/{API_VERSION}/reports/work_orders_by_status")
 def rpt_wo_status(_: int = Depends(current_user_cookie)):
     from collections import Counter
-    with Session(engine) as s:
+    with Session(read_engine) as s:
         rows = s.exec(select(WorkOrder.status)).all()
         c = Counter([r[0] for r in rows])
         return {"results": [{"status": k, "count": v} for k, v in c.items()]}
 
 
+def inventory_low_ok(s: Session) -> Tuple[int, int]:
+    low = s.exec(select(func.count()).select_from(Inventory).where(Inventory.qty_on_hand < Inventory.reorder_point)).one()
+    total = s.exec(select(func.count()).select_from(Inventory)).one()
+    return low, total - low
+
+
 @app.get(f"/api/{API_VERSION}/reports/inventory_breakdown")
 def rpt_inv(_: int = Depends(current_user_cookie)):
-    with Session(engine) as s:
-        inv = s.exec(select(Inventory)).all()
-        low = sum(1 for i in inv if i.qty_on_hand < i.reorder_point)
-        ok = len(inv) - low
+    with Session(read_engine) as s:
+        low, ok = inventory_low_ok(s)
         return {"ok": ok, "low": low}
 
 
 @app.get(f"/api/{API_VERSION}/reports/top_products")
 def rpt_top_products(_: int = Depends(current_user_cookie)):
-    with Session(engine) as s:
+    with Session(read_engine) as s:
         items = s.exec(select(PlanItem)).all()
         items = sorted(items, key=lambda x: x.quantity, reverse=True)[:8]
         return {"results": [{"product_name": i.product_name, "quantity": i.quantity} for i in items]}
@@ -1324,12 +3691,10 @@ def rpt_top_products(_: int = Depends(current_user_cookie)):
 @app.get(f"/api/{API_VERSION}/analytics/dashboard")
 def analytics_dashboard(_: int = Depends(current_user_cookie)):
     from collections import Counter
-    with Session(engine) as s:
+    with Session(read_engine) as s:
         wo = s.exec(select(WorkOrder)).all()
         c = Counter([w.status for w in wo])
-        inv = s.exec(select(Inventory)).all()
-        low = sum(1 for i in inv if i.qty_on_hand < i.reorder_point)
-        ok = len(inv) - low
+        low, ok = inventory_low_ok(s)
         plans = s.exec(select(ProductionPlan)).all()
         items = s.exec(select(PlanItem)).all()
         top = sorted(items, key=lambda x: x.quantity, reverse=True)[:5]
@@ -1345,7 +3710,7 @@ def analytics_dashboard(_: int = Depends(current_user_cookie)):
 @app.get(f"/api/{API_VERSION}/analytics/kpi")
 def analytics_kpi(_: int = Depends(current_user_cookie)):
     from collections import defaultdict
-    with Session(engine) as s:
+    with Session(read_engine) as s:
         sites = s.exec(select(Site)).all()
         wo = s.exec(select(WorkOrder)).all()
         by_site: Dict[int, List[WorkOrder]] = defaultdict(list)
@@ -1366,3 +3731,758 @@ def analytics_kpi(_: int = Depends(current_user_cookie)):
             })
         # KPI сотрудников пока пустой заглушкой
         return {"sites": site_rows, "staff": []}
+
+
+# ---- Reliability (MTBF / MTTR) ----
+_RELIABILITY_CACHE: Dict[Tuple[date, int], Dict[str, np.ndarray]] = {}
+_RELIABILITY_LOCK = threading.Lock()
+RELIABILITY_SORT = {"failures": "failures", "mtbf": "mtbf", "mttr": "mttr",
+                    "downtime": "downtime", "availability": "availability"}
+
+
+def _julian(dt: datetime) -> float:
+    return (dt - datetime(1970, 1, 1)).total_seconds() / 86400.0 + 2440587.5
+
+
+def compute_reliability(conn, days: int) -> Dict[str, np.ndarray]:
+    """Надёжность по каждому станку за последние days дней, все величины — в часах.
+
+    Отказ — корректирующая заявка на станок. Ремонт длится от её создания до первого
+    перехода в done/closed по истории статусов; незакрытые ремонты считаются простоем по текущий момент,
+    но в MTTR не входят. Наработка — время наблюдения (с ввода в эксплуатацию, но не
+    раньше начала окна) минус простой; MTBF = наработка / число отказов.
+    """
+    now = _julian(datetime.utcnow())
+    since_dt = datetime.utcnow() - timedelta(days=days)
+    since = since_dt.isoformat(sep=" ")
+    eq = _fetch_array(conn, "SELECT id, equipment_type_id, site_id, julianday(commissioning_date) "
+                            "FROM equipment ORDER BY id")
+    wo = _fetch_array(conn, """
+        SELECT id, equipment_id, julianday(created_at), status IN ('done', 'closed') FROM workorder
+        WHERE type = 'corrective' AND equipment_id IS NOT NULL AND created_at >= ? ORDER BY id""", (since,))
+    fixed = _fetch_array(conn, """
+        SELECT work_order_id, julianday(MIN(changed_at)) FROM workorderstatushistory
+        WHERE to_status IN ('done', 'closed') AND changed_at >= ?
+        GROUP BY work_order_id ORDER BY work_order_id""", (since,), width=2)
+
+    E = len(eq)
+    ei, ok = _positions(eq[:, 0], wo[:, 1])
+    wo, ei = wo[ok], ei[ok]
+    end = np.full(len(wo), np.nan)
+    fi, found = _positions(fixed[:, 0], wo[:, 0])
+    end[found] = fixed[fi[found], 1]
+    start = wo[:, 2]
+    repaired = np.isfinite(end) & (end >= start)
+    ongoing = ~repaired & (wo[:, 3] == 0)  # закрыта без записи в истории — длительность неизвестна
+    dur = np.where(repaired, end - start, np.where(ongoing, now - start, 0.0)) * 24.0
+
+    failures = np.bincount(ei, minlength=E).astype(np.float64)
+    repaired_n = np.bincount(ei[repaired], minlength=E).astype(np.float64)
+    repair_h = np.bincount(ei[repaired], weights=dur[repaired], minlength=E)
+    downtime_h = np.bincount(ei, weights=dur, minlength=E)
+    observed_h = np.clip(now - np.maximum(eq[:, 3], _julian(since_dt)), 0.0, None) * 24.0
+    downtime_h = np.minimum(downtime_h, observed_h)
+    return {
+        "equipment_id": eq[:, 0], "equipment_type_id": eq[:, 1], "site_id": eq[:, 2],
+        "failures": failures, "repaired": repaired_n, "repair_h": repair_h,
+        "downtime_h": downtime_h, "observed_h": observed_h, "uptime_h": observed_h - downtime_h,
+    }
+
+
+def reliability_metrics(failures, repaired, repair_h, downtime_h, observed_h, uptime_h) -> Dict[str, np.ndarray]:
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return {
+            "mtbf": np.where(failures > 0, uptime_h / failures, np.nan),
+            "mttr": np.where(repaired > 0, repair_h / repaired, np.nan),
+            "availability": np.where(observed_h > 0, uptime_h / observed_h, np.nan),
+            "downtime": downtime_h,
+            "failures": failures,
+        }
+
+
+RELIABILITY_MAX_DAYS = 3650
+
+
+@app.get(f"/api/{API_VERSION}/analytics/reliability")
+def analytics_reliability(
+    days: int = Query(default=365, ge=1, le=RELIABILITY_MAX_DAYS),
+    site_id: Optional[int] = None,
+    equipment_type_id: Optional[int] = None,
+    sort: str = Query(default="failures", pattern="^(failures|mtbf|mttr|downtime|availability)$"),
+    page: int = Query(default=1, ge=1),
+    page_size: int = Query(default=100, ge=1, le=5000),
+    _: int = Depends(current_user_cookie),
+):
+    """MTBF/MTTR/простой по станкам и типам оборудования; расчёт кэшируется на сутки."""
+    key = (datetime.utcnow().date(), days)
+    with _RELIABILITY_LOCK:
+        r = _RELIABILITY_CACHE.get(key)
+        if r is None:
+            with read_engine.connect() as conn:
+                r = compute_reliability(conn, days)
+            for stale in [k for k in _RELIABILITY_CACHE if k[0] != key[0]]:
+                del _RELIABILITY_CACHE[stale]
+            _RELIABILITY_CACHE[key] = r
+    mask = np.ones(len(r["equipment_id"]), dtype=bool)
+    if site_id is not None:
+        mask &= r["site_id"] == site_id
+    if equipment_type_id is not None:
+        mask &= r["equipment_type_id"] == equipment_type_id
+    cols = ("failures", "repaired", "repair_h", "downtime_h", "observed_h", "uptime_h")
+
+    def num(v) -> Optional[float]:
+        return round(float(v), 2) if np.isfinite(v) else None
+
+    # по типам — суммы по выбранным станкам, а не среднее средних
+    type_ids, tinv = np.unique(r["equipment_type_id"][mask], return_inverse=True)
+    sums = {c: np.bincount(tinv, weights=r[c][mask], minlength=len(type_ids)) for c in cols}
+    tm = reliability_metrics(**sums)
+    fleet = reliability_metrics(**{c: np.array([r[c][mask].sum()]) for c in cols})
+    em = reliability_metrics(**{c: r[c][mask] for c in cols})
+    idx = np.flatnonzero(mask)
+    # сначала худшие: больше отказов/простоя/MTTR, меньше MTBF/готовности; nan — в конце
+    key_col = em[RELIABILITY_SORT[sort]]
+    desc = sort in ("failures", "mttr", "downtime")
+    order = np.lexsort(((-key_col if desc else key_col), np.isnan(key_col)))
+    page_pos = order[(page - 1) * page_size: page * page_size]
+
+    with Session(read_engine) as s:
+        type_names = dict(s.exec(select(EquipmentType.id, EquipmentType.name)).all())
+        codes = dict(s.exec(select(Equipment.id, Equipment.code)
+                            .where(Equipment.id.in_([int(r["equipment_id"][idx[i]]) for i in page_pos]))).all())
+    return {
+        "date": key[0].isoformat(),
+        "window_days": days,
+        "fleet": {"equipment": len(idx), "failures": int(fleet["failures"][0]), "mtbf_hours": num(fleet["mtbf"][0]),
+                  "mttr_hours": num(fleet["mttr"][0]), "downtime_hours": num(fleet["downtime"][0]),
+                  "availability": num(fleet["availability"][0])},
+        "types": [
+            {"equipment_type_id": int(t), "name": type_names.get(int(t), ""),
+             "equipment": int(np.count_nonzero(tinv == j)), "failures": int(tm["failures"][j]),
+             "mtbf_hours": num(tm["mtbf"][j]), "mttr_hours": num(tm["mttr"][j]),
+             "downtime_hours": num(tm["downtime"][j]), "availability": num(tm["availability"][j])}
+            for j, t in enumerate(type_ids.tolist())
+        ],
+        "page": page,
+        "page_size": page_size,
+        "total": len(idx),
+        "equipment": [
+            {"equipment_id": int(r["equipment_id"][idx[i]]), "code": codes.get(int(r["equipment_id"][idx[i]]), ""),
+             "site_id": int(r["site_id"][idx[i]]), "equipment_type_id": int(r["equipment_type_id"][idx[i]]),
+             "failures": int(em["failures"][i]), "repaired": int(r["repaired"][idx[i]]),
+             "mtbf_hours": num(em["mtbf"][i]), "mttr_hours": num(em["mttr"][i]),
+             "downtime_hours": num(em["downtime"][i]), "availability": num(em["availability"][i])}
+            for i in page_pos.tolist()
+        ],
+    }
+
+
+# ---- Cycle time ----
+CYCLE_TIME_SQL = """
+WITH finished AS (
+    SELECT work_order_id, MIN(changed_at) AS done_at FROM workorderstatushistory
+    WHERE to_status IN ('done', 'closed') AND changed_at >= :since
+    GROUP BY work_order_id
+), cycle AS (
+    SELECT w.site_id, w.type, w.priority, (julianday(f.done_at) - julianday(w.created_at)) * 24.0 AS hours
+    FROM finished f JOIN workorder w ON w.id = f.work_order_id
+    WHERE (:site_id IS NULL OR w.site_id = :site_id)
+      AND (:type IS NULL OR w.type = :type)
+      AND (:priority IS NULL OR w.priority = :priority)
+), ranked AS (
+    SELECT *, ROW_NUMBER() OVER g AS rn, COUNT(*) OVER g AS n FROM cycle
+    WINDOW g AS (PARTITION BY site_id, type, priority ORDER BY hours
+                 ROWS BETWEEN UNBOUNDED PRECEDING AND UNBOUNDED FOLLOWING)
+)
+SELECT site_id, type, priority, n, AVG(hours),
+       MIN(CASE WHEN rn >= 0.5 * n THEN hours END),
+       MIN(CASE WHEN rn >= 0.9 * n THEN hours END),
+       MIN(CASE WHEN rn >= 0.95 * n THEN hours END),
+       MAX(hours)
+FROM ranked GROUP BY site_id, type, priority ORDER BY site_id, type, priority
+"""
+
+
+@app.get(f"/api/{API_VERSION}/analytics/cycle-time")
+def analytics_cycle_time(
+    days: int = Query(default=90, ge=1, le=3650),
+    site_id: Optional[int] = None,
+    type: Optional[str] = None,
+    priority: Optional[str] = None,
+    _: int = Depends(current_user_cookie),
+):
+    """Время от создания заявки до первого done/closed: перцентили по площадке/типу/приоритету.
+
+    Перцентиль — ближайший ранг: наименьшее значение, до которого (включительно) лежит
+    не меньше p·n заявок группы.
+    """
+    since = (datetime.utcnow() - timedelta(days=days)).isoformat(sep=" ")
+    params = {"since": since, "site_id": site_id, "type": type, "priority": priority}
+    with read_engine.connect() as conn:
+        rows = conn.execute(text(CYCLE_TIME_SQL), params).all()
+
+    def r2(v) -> Optional[float]:
+        return round(v, 2) if v is not None else None
+
+    return {
+        "window_days": days,
+        "groups": [
+            {"site_id": sid, "type": typ, "priority": prio, "count": n, "avg_hours": r2(avg),
+             "p50_hours": r2(p50), "p90_hours": r2(p90), "p95_hours": r2(p95), "max_hours": r2(mx)}
+            for sid, typ, prio, n, avg, p50, p90, p95, mx in rows
+        ],
+    }
+
+
+# ---- Backups ----
+# Копирование и проверка — в app/backup.py (он же CLI для восстановления при остановленном
+# сервере); здесь — расписание, ручной запуск и состояние для API и /metrics.
+backup_log = logging.getLogger("cpvp.backup")
+
+
+class BackupRunner:
+    """Одна операция за раз: копия по расписанию (BACKUP_INTERVAL) или по POST /backups
+    либо проверка копии — обе читают гигабайты и не должны толкаться на диске."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.progress: Optional[Dict[str, Any]] = None  # {file, pages_done, pages_total} пока идёт копия
+        self.last: Optional[Dict[str, Any]] = None
+        self.last_error: Optional[str] = None
+        self.failures = 0
+        self.verified: Dict[str, Dict[str, Any]] = {}  # имя копии -> отчёт последней проверки
+
+    def _acquire(self, progress: Optional[Dict[str, Any]] = None):
+        if not self._lock.acquire(blocking=False):
+            raise HTTPException(status_code=409, detail="Копия уже снимается или проверяется")
+        self.progress = progress or {"file": None, "pages_done": 0, "pages_total": 0}
+
+    def run(self) -> Dict[str, Any]:
+        self._acquire()
+        return self._run_acquired()
+
+    def _run_acquired(self) -> Dict[str, Any]:
+        try:
+            manifest = backup.create_backup(
+                DB_PATH, BACKUP_DIR, SHARD_DIR if SHARD_COUNT else None,
+                step_pages=BACKUP_STEP_PAGES, pause=BACKUP_STEP_PAUSE_MS / 1000, keep=BACKUP_KEEP,
+                on_step=self._on_step)
+        except Exception as exc:
+            self.failures += 1
+            self.last_error = str(exc)
+            raise
+        finally:
+            self.progress = None
+            self._lock.release()
+        self.last, self.last_error = manifest, None
+        backup_log.info("Копия %s: %s байт за %s с", manifest["name"],
+                        sum(f["bytes"] for f in manifest["files"]), manifest["seconds"])
+        return manifest
+
+    def _on_step(self, file: str, done: int, total: int):
+        self.progress = {"file": file, "pages_done": done, "pages_total": total}
+
+    def start(self):
+        """Запустить копию в фоне; 409, если она уже идёт."""
+        self._acquire()
+
+        def target():
+            try:
+                self._run_acquired()
+            except Exception:
+                backup_log.exception("Не удалось снять копию базы")
+
+        threading.Thread(target=target, name="db-backup", daemon=True).start()
+
+    def start_verify(self, name: str):
+        """Проверить копию в фоне; отчёт появится в verified (и в GET /backups)."""
+        self._acquire({"verify": name})
+
+        def target():
+            try:
+                report = backup.verify_backup(BACKUP_DIR / name)
+            except Exception as exc:
+                report = {"name": name, "ok": False, "error": str(exc)}
+                backup_log.exception("Не удалось проверить копию %s", name)
+            finally:
+                self.progress = None
+                self._lock.release()
+            self.verified[name] = dict(report, checked_at=datetime.utcnow().isoformat(sep=" "))
+
+        threading.Thread(target=target, name="db-backup-verify", daemon=True).start()
+
+    def due_in(self) -> float:
+        """Секунд до следующей копии по расписанию (считая от последней готовой, в том числе снятой CLI)."""
+        if self.last is None:
+            done = backup.list_backups(BACKUP_DIR)
+            self.last = done[0] if done else None
+        if self.last is None:
+            return 0.0
+        age = (datetime.utcnow() - datetime.fromisoformat(self.last["finished_at"])).total_seconds()
+        return max(0.0, BACKUP_INTERVAL - age)
+
+
+BACKUPS = BackupRunner()
+
+
+async def backup_loop():
+    while True:
+        await asyncio.sleep(BACKUPS.due_in())
+        try:
+            await anyio.to_thread.run_sync(BACKUPS.run)
+        except HTTPException:
+            pass
+        except Exception:
+            backup_log.exception("Не удалось снять копию базы")
+            await asyncio.sleep(min(BACKUP_INTERVAL, 600))
+
+
+@app.get(f"/api/{API_VERSION}/backups")
+def list_db_backups(_: int = Depends(current_user_cookie)):
+    return {"running": BACKUPS.progress, "last_error": BACKUPS.last_error,
+            "results": [dict(m, verify=BACKUPS.verified.get(m["name"])) for m in backup.list_backups(BACKUP_DIR)]}
+
+
+@app.post(f"/api/{API_VERSION}/backups", status_code=202)
+def post_db_backup(user_id: int = Depends(current_user_cookie)):
+    """Снять копию сейчас. Ход — в GET /backups (running), готовая копия появится в results."""
+    ensure_admin(user_id)
+    BACKUPS.start()
+    return {"running": True}
+
+
+@app.post(f"/api/{API_VERSION}/backups/{{name}}/verify", status_code=202)
+def verify_db_backup(name: str, user_id: int = Depends(current_user_cookie)):
+    """Проверить копию в фоне. Отчёт — в поле verify этой копии в GET /backups."""
+    ensure_admin(user_id)
+    if not re.fullmatch(r"[0-9TZ-]+", name) or not (BACKUP_DIR / name / backup.MANIFEST).exists():
+        raise HTTPException(status_code=404, detail="Копия не найдена")
+    BACKUPS.start_verify(name)
+    return {"verifying": name}
+
+
+# ---- Background jobs ----
+# Тяжёлые отчёты считаются в отдельных процессах (spawn, см. app/jobs.py) и не держат
+# GIL и потоки веб-сервера. Состояние и результат каждой задачи лежат файлами в JOB_DIR;
+# одинаковые задачи (имя + параметры + версии прочитанных таблиц) отдаются из кэша.
+# Параметры задач проверяются моделями до постановки в очередь: обработчики зовутся
+# напрямую, мимо валидации Query, поэтому границы здесь те же, что у эндпоинтов.
+class InventorySnapshotJob(BaseModel):
+    site_id: Optional[int] = None
+
+
+class KpiJob(BaseModel):
+    pass
+
+
+class MrpJob(BaseModel):
+    start: Optional[str] = None
+    periods: int = Field(default=6, ge=1, le=MRP_MAX_PERIODS)
+    site_id: Optional[List[int]] = None
+
+    @field_validator("start")
+    @classmethod
+    def _month(cls, v):
+        if v is not None:
+            try:
+                month_index(v)
+            except HTTPException as exc:
+                raise ValueError(exc.detail)
+        return v
+
+    @field_validator("site_id", mode="before")
+    @classmethod
+    def _site_list(cls, v):
+        return [v] if isinstance(v, int) else v  # как у остальных задач: можно одну площадку числом
+
+
+class ReliabilityJob(BaseModel):
+    days: int = Field(default=365, ge=1, le=RELIABILITY_MAX_DAYS)
+    site_id: Optional[int] = None
+    equipment_type_id: Optional[int] = None
+
+
+class WorkordersExportJob(BaseModel):
+    site_id: Optional[int] = None
+    status: Optional[str] = None
+
+
+def _job_inventory_snapshot(params: dict, out: Path):
+    site_id = params.get("site_id")
+    with read_engine.connect() as conn:
+        rows = conn.execute(text("""
+            SELECT i.site_id, i.material_id, m.name, m.unit, i.qty_on_hand, i.reorder_point
+            FROM inventory i JOIN material m ON m.id = i.material_id
+            WHERE :site_id IS NULL OR i.site_id = :site_id
+            ORDER BY i.site_id, i.material_id"""), {"site_id": site_id}).all()
+    _write_json(out, {"taken_at": datetime.utcnow().isoformat(), "results": [
+        {"site_id": sid, "material_id": mid, "name": name, "unit": unit, "qty_on_hand": q, "reorder_point": rp}
+        for sid, mid, name, unit, q, rp in rows
+    ]})
+
+
+def _job_kpi(params: dict, out: Path):
+    _write_json(out, analytics_kpi(0))
+
+
+def _job_mrp(params: dict, out: Path):
+    _write_json(out, mrp(start=params["start"], periods=params["periods"],
+                         site_id=params["site_id"], page=1, page_size=sys.maxsize, _=0))
+
+
+def _job_reliability(params: dict, out: Path):
+    _write_json(out, analytics_reliability(days=params["days"], site_id=params["site_id"],
+                                           equipment_type_id=params["equipment_type_id"], sort="failures",
+                                           page=1, page_size=sys.maxsize, _=0))
+
+
+def _job_workorders_export(params: dict, out: Path):
+    cols = ("id", "site_id", "type", "status", "priority", "title", "equipment_id",
+            "planned_date", "assigned_team", "created_at")
+    with read_engine.connect() as conn, out.open("w", newline="", encoding="utf-8") as f:
+        w = csv.writer(f)
+        w.writerow(cols)
+        res = conn.execute(text(f"""
+            SELECT {", ".join(cols)} FROM workorder
+            WHERE (:site_id IS NULL OR site_id = :site_id) AND (:status IS NULL OR status = :status)
+            ORDER BY id"""), {"site_id": params.get("site_id"), "status": params.get("status")})
+        for chunk in iter(lambda: res.fetchmany(10_000), []):
+            w.writerows(chunk)
+
+
+MRP_TABLES = ("site", "material", "workorder", "workordermaterial", "productionplan", "planitem",
+              "productmaterial", "inventory", "purchaseorder", "purchaseorderline")
+# имя -> (функция, таблицы, от которых зависит результат, тип результата, модель параметров)
+JOB_TYPES: Dict[str, Tuple[Callable[[dict, Path], None], Tuple[str, ...], str, type]] = {
+    "inventory_snapshot": (_job_inventory_snapshot, ("inventory", "material"), "application/json",
+                           InventorySnapshotJob),
+    "kpi": (_job_kpi, ("site", "workorder"), "application/json", KpiJob),
+    "mrp": (_job_mrp, MRP_TABLES, "application/json", MrpJob),
+    "reliability": (_job_reliability, ("equipment", "equipmenttype", "workorder", "workorderstatushistory"),
+                    "application/json", ReliabilityJob),
+    "workorders_export": (_job_workorders_export, ("workorder",), "text/csv", WorkordersExportJob),
+}
+
+
+def _write_json(path: Path, obj: Any):
+    path.write_text(json.dumps(obj, ensure_ascii=False, default=str), encoding="utf-8")
+
+
+class JobRunner:
+    """Очередь фоновых задач поверх ProcessPoolExecutor с состоянием на диске.
+
+    {id}.json — состояние (queued/running/done/failed), {id}.result — результат.
+    Оба файла пишутся через временный файл и os.replace, так что читатель никогда
+    не видит их наполовину. Версии таблиц DbWriter живут только в памяти процесса,
+    поэтому кэш результатов действует до перезапуска (ключ включает boot_id).
+    """
+
+    def __init__(self, directory: Path, workers: int):
+        self.dir = directory
+        self.workers = workers
+        self.boot_id = secrets.token_hex(4)
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+        self._by_key: Dict[str, str] = {}
+
+    def start(self):
+        self.dir.mkdir(parents=True, exist_ok=True)
+        cutoff = time.time() - JOB_KEEP_DAYS * 86400
+        for p in self.dir.glob("*.json"):
+            if p.stat().st_mtime < cutoff:
+                p.unlink(missing_ok=True)
+                p.with_suffix(".result").unlink(missing_ok=True)
+                continue
+            state = self._read(p)
+            if state and state["status"] in ("queued", "running"):
+                state.update(status="failed", error="Прервана перезапуском сервера",
+                             finished_at=datetime.utcnow().isoformat())
+                self._write(state)
+
+    def stop(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def submit(self, name: str, params: dict, user_id: int) -> Dict[str, Any]:
+        tables = JOB_TYPES[name][1]
+        key = hashlib.sha1(json.dumps(
+            [name, params, DB_WRITER.version(*tables), self.boot_id], sort_keys=True, default=str
+        ).encode()).hexdigest()
+        with self._lock:
+            known = self._by_key.get(key)
+            state = self.get(known) if known else None
+            if state and state["status"] != "failed":
+                return dict(state, cached=True)
+            job_id = secrets.token_hex(8)
+            state = {"id": job_id, "name": name, "params": params, "status": "queued", "user_id": user_id,
+                     "key": key, "created_at": datetime.utcnow().isoformat(),
+                     "started_at": None, "finished_at": None, "size": None, "error": None}
+            self._write(state)
+            args = (jobs_entry.run, job_id, name, params, dict(DB_WRITER.table_versions))
+            try:
+                fut = self._executor().submit(*args)
+            except BrokenProcessPool:  # рабочий процесс упал (OOM и т. п.) — пул пересоздаётся
+                self._pool = None
+                fut = self._executor().submit(*args)
+            self._by_key[key] = job_id
+        fut.add_done_callback(lambda f: self._finish(job_id, f))
+        return dict(state, cached=False)
+
+    def _executor(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+        return self._pool
+
+    def _finish(self, job_id: str, fut: Future):
+        state = self.get(job_id)
+        if state is None:
+            return
+        try:
+            state.update(status="done", size=fut.result())
+        except BaseException as exc:  # отменённые при остановке тоже попадают сюда
+            state.update(status="failed", error=str(exc) or type(exc).__name__)
+            self._by_key.pop(state["key"], None)
+        state["finished_at"] = datetime.utcnow().isoformat()
+        self._write(state)
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        if not re.fullmatch(r"[0-9a-f]{16}", job_id):
+            return None
+        return self._read(self.dir / f"{job_id}.json")
+
+    def result_path(self, job_id: str) -> Path:
+        return self.dir / f"{job_id}.result"
+
+    @staticmethod
+    def _read(path: Path) -> Optional[Dict[str, Any]]:
+        try:
+            return json.loads(path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return None
+
+    def _write(self, state: Dict[str, Any]):
+        tmp = self.dir / f"{state['id']}.json.tmp"
+        _write_json(tmp, state)
+        os.replace(tmp, self.dir / f"{state['id']}.json")
+
+
+JOBS = JobRunner(JOB_DIR, JOB_WORKERS)
+
+
+def run_job(job_id: str, name: str, params: dict, versions: dict) -> int:
+    """Выполняется в процессе пула: считает задачу и возвращает размер результата в байтах."""
+    # кэши массивов сверяются с версиями таблиц основного процесса — своих записей у пула нет
+    DB_WRITER.table_versions.update(versions)
+    state = JOBS.get(job_id) or {}
+    state.update(status="running", started_at=datetime.utcnow().isoformat())
+    JOBS._write(state)
+    fn = JOB_TYPES[name][0]
+    tmp = JOBS.dir / f"{job_id}.result.tmp"
+    try:
+        fn(params, tmp)
+    except HTTPException as exc:  # не переживает pickle по пути в основной процесс
+        raise RuntimeError(exc.detail) from None
+    os.replace(tmp, JOBS.result_path(job_id))
+    return JOBS.result_path(job_id).stat().st_size
+
+
+class JobCreate(BaseModel):
+    name: str
+    params: Dict[str, Any] = {}
+
+
+@app.post(f"/api/{API_VERSION}/jobs", status_code=202)
+def create_job(payload: JobCreate, user_id: int = Depends(current_user_cookie)):
+    if payload.name not in JOB_TYPES:
+        raise HTTPException(status_code=400, detail=f"Неизвестная задача, доступны: {', '.join(JOB_TYPES)}")
+    try:
+        params = JOB_TYPES[payload.name][3].model_validate(payload.params).model_dump()
+    except ValidationError as exc:
+        raise HTTPException(status_code=422, detail=[{"loc": e["loc"], "msg": e["msg"]} for e in exc.errors()])
+    return JOBS.submit(payload.name, params, user_id)
+
+
+@app.get(f"/api/{API_VERSION}/jobs/{{job_id}}")
+def get_job(job_id: str, _: int = Depends(current_user_cookie)):
+    state = JOBS.get(job_id)
+    if not state:
+        raise HTTPException(status_code=404, detail="Задача не найдена")
+    return state
+
+
+@app.get(f"/api/{API_VERSION}/jobs/{{job_id}}/result")
+def get_job_result(job_id: str, _: int = Depends(current_user_cookie)):
+    state = JOBS.get(job_id)
+    if not state:
+        raise HTTPException(status_code=404, detail="Задача не найдена")
+    if state["status"] != "done":
+        raise HTTPException(status_code=409, detail=f"Задача в состоянии {state['status']}")
+    return FileResponse(JOBS.result_path(job_id), media_type=JOB_TYPES[state["name"]][2],
+                        filename=f"{state['name']}-{job_id}.{'csv' if state['name'].endswith('export') else 'json'}")
+
+
+# ---- Batch ----
+BATCH_MAX_OPERATIONS = 200
+BATCH_METHODS = ("POST", "PUT", "PATCH", "DELETE")
+BATCH_EXCLUDED = tuple(f"/api/{API_VERSION}/{p}" for p in ("auth/", "batch", "jobs", "backups"))
+
+
+class BatchOperation(BaseModel):
+    method: str
+    path: str
+    body: Optional[Any] = None
+    query: Dict[str, Any] = {}
+
+
+class BatchPayload(BaseModel):
+    operations: List[BatchOperation]
+    atomic: bool = True
+
+
+class BatchFailed(Exception):
+    def __init__(self, results: List[Dict[str, Any]]):
+        super().__init__("batch failed")
+        self.results = results
+
+
+def _batch_prepare(op: BatchOperation, user_id: int) -> Tuple[Callable[..., Any], Dict[str, Any], int]:
+    """Найти обработчик операции и собрать его аргументы так, как это сделал бы FastAPI."""
+    method, path = op.method.upper(), op.path.split("?", 1)[0]
+    if method not in BATCH_METHODS or path.startswith(BATCH_EXCLUDED):
+        raise HTTPException(status_code=400, detail=f"{method} {path} нельзя выполнить в пакете")
+    for route in app.routes:
+        if isinstance(route, APIRoute):
+            match, child = route.matches({"type": "http", "path": path, "method": method})
+            if match == Match.FULL:
+                break
+    else:
+        raise HTTPException(status_code=404, detail=f"Маршрут {method} {path} не найден")
+    path_params = child["path_params"]
+    kwargs: Dict[str, Any] = {}
+    for name, p in inspect.signature(route.endpoint).parameters.items():
+        spec = p.default if isinstance(p.default, FieldInfo) else None
+        if isinstance(p.default, DependsInfo):
+            kwargs[name] = user_id  # единственная зависимость обработчиков — current_user_cookie
+        elif isinstance(p.annotation, type) and issubclass(p.annotation, BaseModel):
+            kwargs[name] = p.annotation.model_validate(op.body if op.body is not None else {})
+        elif name in path_params or name in op.query:
+            raw = path_params[name] if name in path_params else op.query[name]
+            kwargs[name] = TypeAdapter(Annotated[p.annotation, spec] if spec else p.annotation).validate_python(raw)
+        elif spec is not None and not spec.is_required():
+            kwargs[name] = spec.get_default(call_default_factory=True)
+        elif p.default is not inspect.Parameter.empty and spec is None:
+            kwargs[name] = p.default
+        else:
+            raise HTTPException(status_code=422, detail=f"Не указан параметр {name}")
+    return route.endpoint, kwargs, route.status_code or 200
+
+
+def _batch_result(res: Any, status: int) -> Dict[str, Any]:
+    if isinstance(res, Response):
+        return {"status": res.status_code, "result": json.loads(res.body) if res.body else None}
+    return {"status": status, "result": jsonable_encoder(res)}
+
+
+def _batch_error(exc: Exception) -> Dict[str, Any]:
+    if isinstance(exc, HTTPException):
+        return {"status": exc.status_code, "error": exc.detail}
+    if isinstance(exc, ValidationError):
+        return {"status": 422, "error": [{"loc": e["loc"], "msg": e["msg"]} for e in exc.errors()]}
+    logging.getLogger("cpvp.batch").exception("Ошибка операции пакета")
+    return {"status": 500, "error": "Внутренняя ошибка"}
+
+
+@app.post(f"/api/{API_VERSION}/batch")
+def batch(payload: BatchPayload, user_id: int = Depends(current_user_cookie)):
+    """Несколько изменений одним запросом: одна проверка сессии, одна единица записи, один COMMIT.
+
+    Каждая операция — {method, path, body, query} любого изменяющего маршрута API; она
+    выполняется тем же обработчиком в своём SAVEPOINT. atomic=true (по умолчанию) — при
+    первой ошибке откатывается весь пакет (409), иначе ошибочные операции просто
+    пропускаются. Проверки, читающие через read_engine, не видят записей этого же пакета.
+    """
+    if len(payload.operations) > BATCH_MAX_OPERATIONS:
+        raise HTTPException(status_code=400, detail=f"Не больше {BATCH_MAX_OPERATIONS} операций в пакете")
+    calls: List[Any] = []
+    for i, op in enumerate(payload.operations):
+        try:
+            calls.append(_batch_prepare(op, user_id))
+        except (HTTPException, ValidationError) as exc:
+            if payload.atomic:  # до записи дело не дошло
+                return JSONResponse(status_code=409, content={
+                    "committed": False, "failed_operation": i, "results": [_batch_error(exc)]})
+            calls.append(_batch_error(exc))
+
+    def unit(s: Session):
+        results = []
+        for call in calls:
+            if isinstance(call, dict):
+                results.append(call)
+                continue
+            fn, kwargs, status = call
+            try:
+                results.append(_batch_result(fn(**kwargs), status))
+            except Exception as exc:
+                results.append(_batch_error(exc))
+                if payload.atomic:
+                    raise BatchFailed(results)
+        return results
+
+    try:
+        results = DB_WRITER.run(unit)
+    except BatchFailed as exc:
+        return JSONResponse(status_code=409, content={
+            "committed": False, "failed_operation": len(exc.results) - 1, "results": exc.results})
+    return {"committed": True, "results": results}
+
+
+# ---- Delta sync ----
+CHANGES_MAX_LIMIT = 10_000
+
+
+@app.get(f"/api/{API_VERSION}/changes")
+def changes(
+    since: Optional[str] = None,
+    limit: int = Query(default=2000, ge=1, le=CHANGES_MAX_LIMIT),
+    entity: Optional[List[str]] = Query(default=None),
+    _: int = Depends(current_user_cookie),
+):
+    """Строки, изменённые после токена since, и id удалённых — по всем сущностям сразу.
+
+    Токен — «epoch.ревизия»; без него или с чужим epoch (база пересоздана или
+    восстановлена из копии) отдаётся всё с начала и reset=true — клиент должен
+    сбросить свой кэш. Больше limit строк за раз не отдаётся: тогда more=true, и
+    клиент сразу запрашивает следующую порцию с новым токеном.
+    """
+    names = entity or list(SYNC_ENTITIES)
+    unknown = [n for n in names if n not in SYNC_ENTITIES]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Неизвестные сущности: {', '.join(unknown)}")
+    with read_engine.connect() as conn:
+        epoch, head = conn.exec_driver_sql("SELECT epoch, revision FROM syncstate WHERE id = 1").one()
+        tok_epoch, _sep, tok_rev = (since or "").partition(".")
+        reset = tok_epoch != epoch or not tok_rev.isdigit()
+        after = 0 if reset else min(int(tok_rev), head)
+        fetched: Dict[str, List[Dict[str, Any]]] = {}
+        for name in names:
+            res = conn.exec_driver_sql(
+                f'SELECT * FROM "{SYNC_ENTITIES[name]}" WHERE rev > ? AND rev <= ? ORDER BY rev LIMIT ?',
+                (after, head, limit + 1))
+            keys = list(res.keys())
+            fetched[name] = [dict(zip(keys, row)) for row in res]
+        placeholders = ",".join("?" * len(names))
+        dead = conn.exec_driver_sql(
+            f"SELECT rev, entity, row_id FROM tombstone WHERE rev > ? AND rev <= ? AND entity IN ({placeholders}) "
+            "ORDER BY rev LIMIT ?", (after, head, *names, limit + 1)).all()
+    revs = sorted([r["rev"] for rows in fetched.values() for r in rows] + [d[0] for d in dead])
+    more = len(revs) > limit
+    upto = revs[limit - 1] if more else head
+    return {
+        "token": f"{epoch}.{upto}",
+        "reset": reset,
+        "more": more,
+        "changes": {n: [r for r in rows if r["rev"] <= upto] for n, rows in fetched.items()},
+        "deleted": {n: [row_id for rev, ent, row_id in dead if ent == n and rev <= upto] for n in names},
+    }
@@ -0,0 +1,262 @@
+"""Онлайн-резервные копии SQLite (раздел Backups в app.py), их проверка и восстановление.
+
+Копия снимается backup API SQLite порциями по step_pages страниц с паузой между ними
+из отдельного соединения только на чтение. Всё время копирования в нём открыта одна
+читающая транзакция: в WAL она не мешает писателю, а копия получается согласованной на
+момент начала и не перезапускается из-за чужих записей (без неё backup API начинает
+заново после каждого COMMIT и на нагруженной базе не заканчивается никогда). Цена —
+WAL не сворачивается дальше этой точки, пока копия не готова.
+
+Каждая копия — каталог <BACKUP_DIR>/<время UTC>/ с файлами баз (общая и шарды склада,
+если они включены) и manifest.json с размерами и SHA-256. Копии шардов и общей базы
+согласованы каждая сама по себе, но не друг с другом: снимаются по очереди.
+
+Модуль не импортирует app.app, потому что восстанавливать надо при остановленном сервере:
+
+    python -m app.backup list
+    python -m app.backup create
+    python -m app.backup verify [имя]
+    python -m app.backup restore имя
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+BASE_DIR = Path(__file__).resolve().parent
+MANIFEST = "manifest.json"
+SHARD_MARKER = "shards.json"
+
+
+class BackupError(Exception):
+    pass
+
+
+def file_sha256(path: Path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def copy_db(src: Path, dest: Path, step_pages: int = 256, pause: float = 0.02,
+            on_step: Optional[Callable[[int, int], None]] = None) -> int:
+    """Скопировать базу src в новый файл dest, не блокируя писателей. Возвращает число страниц."""
+    source = sqlite3.connect(f"file:{src}?mode=ro", uri=True, isolation_level=None)
+    target = sqlite3.connect(dest)
+    total = 0
+    try:
+        source.execute("BEGIN")
+        source.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()  # фиксируем снимок чтения
+
+        def progress(_status, remaining, pages):
+            nonlocal total
+            total = pages
+            if on_step:
+                on_step(pages - remaining, pages)
+            if remaining and pause:
+                time.sleep(pause)
+
+        source.backup(target, pages=step_pages, progress=progress)
+        source.execute("COMMIT")
+    finally:
+        target.close()
+        source.close()
+    return total
+
+
+def db_files(db_path: Path, shard_dir: Optional[Path]) -> List[Path]:
+    """Файлы для копии: общая база и шарды склада, если склад разнесён (есть shards.json)."""
+    files = [db_path]
+    if shard_dir and (shard_dir / SHARD_MARKER).exists():
+        count = json.loads((shard_dir / SHARD_MARKER).read_text())["count"]
+        files += [shard_dir / f"shard_{k}.db" for k in range(count)]
+    return files
+
+
+def create_backup(db_path: Path, backup_dir: Path, shard_dir: Optional[Path] = None, *,
+                  step_pages: int = 256, pause: float = 0.02, keep: int = 7,
+                  on_step: Optional[Callable[[str, int, int], None]] = None) -> Dict[str, Any]:
+    """Снять копию во временный каталог и переименовать его, когда всё записано, затем ротация."""
+    backup_dir.mkdir(parents=True, exist_ok=True)
+    started = datetime.utcnow()
+    name = started.strftime("%Y%m%dT%H%M%SZ")
+    n = 1
+    while (backup_dir / name).exists():
+        name = f"{started:%Y%m%dT%H%M%SZ}-{n}"
+        n += 1
+    part = backup_dir / f".{name}.part"
+    part.mkdir()
+    try:
+        entries = []
+        t0 = time.perf_counter()
+        for src in db_files(db_path, shard_dir):
+            dest = part / src.name
+            pages = copy_db(src, dest, step_pages, pause,
+                            (lambda done, total, f=src.name: on_step(f, done, total)) if on_step else None)
+            entries.append({"file": src.name, "role": "shard" if src.parent == shard_dir else "main",
+                            "pages": pages, "bytes": dest.stat().st_size, "sha256": file_sha256(dest)})
+        manifest = {
+            "name": name,
+            "started_at": started.isoformat(sep=" "),
+            "finished_at": datetime.utcnow().isoformat(sep=" "),
+            "seconds": round(time.perf_counter() - t0, 3),
+            "shards": sum(1 for e in entries if e["role"] == "shard"),
+            "files": entries,
+        }
+        (part / MANIFEST).write_text(json.dumps(manifest, ensure_ascii=False, indent=2))
+        part.rename(backup_dir / name)
+    except BaseException:
+        shutil.rmtree(part, ignore_errors=True)
+        raise
+    rotate(backup_dir, keep)
+    return manifest
+
+
+def list_backups(backup_dir: Path) -> List[Dict[str, Any]]:
+    """Готовые копии, новые первыми (незавершённые .part и каталоги без манифеста не в счёт)."""
+    if not backup_dir.exists():
+        return []
+    out = []
+    for d in backup_dir.iterdir():
+        if d.is_dir() and not d.name.startswith(".") and (d / MANIFEST).exists():
+            out.append(json.loads((d / MANIFEST).read_text()))
+    return sorted(out, key=lambda m: m["started_at"], reverse=True)
+
+
+def rotate(backup_dir: Path, keep: int):
+    for m in list_backups(backup_dir)[max(keep, 1):]:
+        shutil.rmtree(backup_dir / m["name"], ignore_errors=True)
+    for d in backup_dir.glob(".*.part"):  # остатки оборванных копий
+        if time.time() - d.stat().st_mtime > 86400:
+            shutil.rmtree(d, ignore_errors=True)
+
+
+def verify_backup(path: Path) -> Dict[str, Any]:
+    """Сверить SHA-256 с манифестом и прогнать PRAGMA integrity_check по каждому файлу копии."""
+    if not (path / MANIFEST).exists():
+        raise BackupError(f"{path}: нет {MANIFEST}, это не копия или она не дописана")
+    manifest = json.loads((path / MANIFEST).read_text())
+    files = []
+    for e in manifest["files"]:
+        f = path / e["file"]
+        row = {"file": e["file"], "sha256_ok": f.exists() and file_sha256(f) == e["sha256"], "integrity": None}
+        if row["sha256_ok"]:
+            # immutable=1: проверка не создаёт -wal/-shm рядом с копией и ничего в ней не меняет
+            conn = sqlite3.connect(f"file:{f}?mode=ro&immutable=1", uri=True)
+            try:
+                row["integrity"] = "; ".join(r[0] for r in conn.execute("PRAGMA integrity_check"))
+            finally:
+                conn.close()
+        files.append(row)
+    ok = all(r["sha256_ok"] and r["integrity"] == "ok" for r in files)
+    return {"name": manifest["name"], "ok": ok, "files": files}
+
+
+def _in_use(db: Path) -> bool:
+    """Открыта ли база другим процессом: монопольный режим WAL не получить, пока есть чужие соединения."""
+    if not db.exists():
+        return False
+    conn = sqlite3.connect(db, timeout=0)
+    try:
+        conn.execute("PRAGMA locking_mode=EXCLUSIVE")
+        conn.execute("BEGIN EXCLUSIVE")
+        conn.execute("ROLLBACK")
+        return False
+    except sqlite3.OperationalError:
+        return True
+    finally:
+        conn.close()
+
+
+def restore_backup(path: Path, db_path: Path, shard_dir: Optional[Path] = None) -> Dict[str, Any]:
+    """Вернуть базу (и шарды) из копии. Сервер должен быть остановлен; копия сначала проверяется."""
+    report = verify_backup(path)
+    if not report["ok"]:
+        raise BackupError(f"Копия {report['name']} не прошла проверку: {report['files']}")
+    manifest = json.loads((path / MANIFEST).read_text())
+    targets = {}
+    for e in manifest["files"]:
+        if e["role"] == "shard":
+            if shard_dir is None:
+                raise BackupError("В копии есть шарды склада — укажите SHARD_DIR")
+            targets[e["file"]] = shard_dir / e["file"]
+        else:
+            targets[e["file"]] = db_path
+    if not manifest["shards"] and shard_dir and (shard_dir / SHARD_MARKER).exists():
+        raise BackupError(f"Копия снята без шардов, а склад разнесён по {shard_dir}: уберите каталог шардов")
+    busy = [str(t) for t in targets.values() if _in_use(t)]
+    if busy:
+        raise BackupError(f"Базы открыты другим процессом, остановите сервер: {', '.join(busy)}")
+    for name, dest in targets.items():
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        tmp = dest.with_name(dest.name + ".restore")
+        shutil.copyfile(path / name, tmp)
+        with open(tmp, "rb") as f:
+            os.fsync(f.fileno())
+        for side in ("-wal", "-shm"):  # журнал старой базы к восстановленной не относится
+            Path(str(dest) + side).unlink(missing_ok=True)
+        os.replace(tmp, dest)
+    if manifest["shards"]:
+        (shard_dir / SHARD_MARKER).write_text(json.dumps({"count": manifest["shards"]}))
+    return {"name": manifest["name"], "restored": [str(t) for t in targets.values()]}
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(prog="python -m app.backup", description=__doc__.splitlines()[0])
+    ap.add_argument("--db", default=os.getenv("SQLITE_PATH") or str(BASE_DIR / "cpvp_ultra.db"))
+    ap.add_argument("--dir", default=os.getenv("BACKUP_DIR") or str(BASE_DIR / "backups"), help="каталог копий")
+    ap.add_argument("--shard-dir", default=os.getenv("SHARD_DIR") or str(BASE_DIR / "shards"))
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    sub.add_parser("list", help="готовые копии")
+    create = sub.add_parser("create", help="снять копию сейчас (сервер может работать)")
+    create.add_argument("--step-pages", type=int, default=int(os.getenv("BACKUP_STEP_PAGES", "256")))
+    create.add_argument("--pause-ms", type=float, default=float(os.getenv("BACKUP_STEP_PAUSE_MS", "20")))
+    create.add_argument("--keep", type=int, default=int(os.getenv("BACKUP_KEEP", "7")))
+    verify = sub.add_parser("verify", help="сверить контрольные суммы и целостность")
+    verify.add_argument("name", nargs="?", help="по умолчанию — все копии")
+    restore = sub.add_parser("restore", help="восстановить базу из копии (сервер остановлен)")
+    restore.add_argument("name")
+    args = ap.parse_args(argv)
+
+    backup_dir, shard_dir = Path(args.dir), Path(args.shard_dir)
+    try:
+        if args.cmd == "list":
+            for m in list_backups(backup_dir):
+                size = sum(f["bytes"] for f in m["files"])
+                print(f"{m['name']:<24}{size:>14} байт  файлов: {len(m['files'])}  {m['seconds']} с")
+        elif args.cmd == "create":
+            m = create_backup(Path(args.db), backup_dir, shard_dir, step_pages=args.step_pages,
+                              pause=args.pause_ms / 1000, keep=args.keep)
+            print(f"{m['name']}: {sum(f['bytes'] for f in m['files'])} байт за {m['seconds']} с")
+        elif args.cmd == "verify":
+            names = [args.name] if args.name else [m["name"] for m in list_backups(backup_dir)]
+            bad = 0
+            for name in names:
+                r = verify_backup(backup_dir / name)
+                bad += not r["ok"]
+                print(f"{name}: {'ok' if r['ok'] else 'ПОВРЕЖДЕНА'}")
+                for f in r["files"]:
+                    if not (f["sha256_ok"] and f["integrity"] == "ok"):
+                        print(f"  {f['file']}: sha256={'ok' if f['sha256_ok'] else 'не совпадает'} "
+                              f"integrity={f['integrity']}")
+            return 1 if bad else 0
+        elif args.cmd == "restore":
+            r = restore_backup(backup_dir / args.name, Path(args.db), shard_dir)
+            print(f"восстановлено из {r['name']}: {', '.join(r['restored'])}")
+    except BackupError as exc:
+        print(exc, file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
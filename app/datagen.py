@@ -0,0 +1,324 @@
+"""Генератор синтетических данных промышленного объёма.
+
+Заполняет базу ЦПВП (по умолчанию SQLITE_PATH или app/cpvp_ultra.db) площадками,
+оборудованием, материалами, остатками, заявками ТОиР с историей статусов,
+комментариями, планами, заказами поставщикам и журналом событий. Вставка идёт
+пачками через executemany в одной транзакции на таблицу; результат полностью
+определяется --seed.
+
+Пример:
+    python -m app.datagen --db /tmp/bench.db --reset --sites 20 --events 2000000
+"""
+import argparse
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import time
+from datetime import datetime, date, timedelta
+from pathlib import Path
+from typing import Iterable, Iterator, List, Sequence, Tuple
+
+CHUNK = 50_000
+
+# распределения, близкие к боевым
+WO_STATUS = (("new", 25), ("in_progress", 15), ("done", 35), ("closed", 25))
+WO_PRIORITY = (("low", 30), ("normal", 55), ("high", 15))
+WO_TYPE = (("corrective", 60), ("preventive", 40))
+PM_INTERVALS = (30, 60, 90, 180, 365)
+# путь заявки по статусам и средние часы до перехода (по приоритету: low, normal, high)
+WO_FLOW = ("new", "in_progress", "done", "closed")
+WO_STEP_HOURS = {"low": (48, 72, 48), "normal": (12, 36, 24), "high": (2, 12, 8)}
+MOVE_KIND = (("consume", 60), ("reserve", 20), ("add", 20))
+PO_STATUS = (("draft", 20), ("in_progress", 30), ("done", 45), ("cancelled", 5))
+EVENT_TYPES = (
+    ("auth_login", "success", 10),
+    ("work_order", "warning", 12),
+    ("work_order_status", "info", 25),
+    ("work_order_assign", "info", 8),
+    ("work_order_comment", "info", 8),
+    ("inventory_consume", "warning", 15),
+    ("inventory_reserve", "info", 8),
+    ("inventory_add", "success", 8),
+    ("po_created", "info", 3),
+    ("po_updated", "info", 2),
+    ("plan_created", "info", 1),
+    ("plan_item", "info", 1),
+)
+REGIONS = ("ЦФО", "ПФО", "СЗФО", "УФО", "СФО", "ЮФО", "ДФО")
+EQUIPMENT_TYPES = ("Дробильная машина", "Конвейер", "Мельница", "Грохот", "Насос", "Компрессор",
+                   "Электродвигатель", "Редуктор", "Вентилятор", "Питатель")
+UNITS = ("pcs", "kg", "m", "l", "set")
+PRODUCTS = ("Редуктор RX", "Вал 40Х", "Шестерня Z32", "Корпус КП", "Муфта МУВП", "Ролик конвейерный",
+            "Футеровка", "Щека дробилки", "Сито", "Подшипниковый узел")
+TEAMS = ("Бригада 1", "Бригада 2", "Бригада 3", "Электрики", "Механики", None)
+
+
+def weighted(rnd: random.Random, table: Sequence[Tuple], k: int) -> List:
+    values = [t[0] for t in table]
+    weights = [t[-1] for t in table]
+    return rnd.choices(values, weights=weights, k=k)
+
+
+def chunks(rows: Iterable[tuple], size: int = CHUNK) -> Iterator[List[tuple]]:
+    buf: List[tuple] = []
+    for r in rows:
+        buf.append(r)
+        if len(buf) >= size:
+            yield buf
+            buf = []
+    if buf:
+        yield buf
+
+
+def next_id(conn: sqlite3.Connection, table: str) -> int:
+    return (conn.execute(f'SELECT COALESCE(MAX(id), 0) FROM "{table}"').fetchone()[0] or 0) + 1
+
+
+def bulk(conn: sqlite3.Connection, table: str, cols: Sequence[str], rows: Iterable[tuple]) -> int:
+    sql = f'INSERT INTO "{table}" ({", ".join(cols)}) VALUES ({", ".join("?" * len(cols))})'
+    n = 0
+    with conn:
+        for part in chunks(rows):
+            conn.executemany(sql, part)
+            n += len(part)
+    return n
+
+
+def ts(dt: datetime) -> str:
+    return dt.isoformat(sep=" ")
+
+
+def generate(conn: sqlite3.Connection, args) -> dict:
+    rnd = random.Random(args.seed)
+    now = datetime(2025, 11, 1) if args.now is None else datetime.fromisoformat(args.now)
+    span = timedelta(days=args.days)
+    start = now - span
+    counts = {}
+
+    def moment() -> datetime:
+        return start + timedelta(seconds=rnd.randrange(int(span.total_seconds())))
+
+    # справочники
+    sid0 = next_id(conn, "site")
+    site_ids = list(range(sid0, sid0 + args.sites))
+    counts["site"] = bulk(conn, "site", ("id", "name", "region"), (
+        (sid, f"Площадка {sid}", rnd.choice(REGIONS)) for sid in site_ids
+    ))
+    et0 = next_id(conn, "equipmenttype")
+    type_ids = list(range(et0, et0 + len(EQUIPMENT_TYPES)))
+    counts["equipmenttype"] = bulk(conn, "equipmenttype", ("id", "name", "pm_interval_days"), (
+        (tid, f"{name} ({tid})", rnd.choice(PM_INTERVALS)) for tid, name in zip(type_ids, EQUIPMENT_TYPES)
+    ))
+    sup0 = next_id(conn, "supplier")
+    supplier_ids = list(range(sup0, sup0 + args.suppliers))
+    counts["supplier"] = bulk(conn, "supplier", ("id", "name", "contact"), (
+        (i, f"Поставщик {i}", f"supplier{i}@sample.local") for i in supplier_ids
+    ))
+    m0 = next_id(conn, "material")
+    material_ids = list(range(m0, m0 + args.materials))
+    counts["material"] = bulk(conn, "material",
+                              ("id", "name", "unit", "description", "reject_percent", "preferred_supplier_id"), (
+        (mid, f"Материал {mid}", rnd.choice(UNITS), None, round(rnd.uniform(0, 5), 2),
+         rnd.choice(supplier_ids) if supplier_ids and rnd.random() < 0.8 else None)
+        for mid in material_ids
+    ))
+
+    # оборудование: id подряд по площадкам, чтобы заявки выбирали станок своей площадки
+    e0 = next_id(conn, "equipment")
+    equipment_by_site = {}
+    eq_rows = []
+    eid = e0
+    for sid in site_ids:
+        equipment_by_site[sid] = (eid, eid + args.equipment_per_site)
+        for _ in range(args.equipment_per_site):
+            status = weighted(rnd, (("active", 85), ("maintenance", 10), ("inactive", 5)), 1)[0]
+            commissioned = date(2005, 1, 1) + timedelta(days=rnd.randrange(7000))
+            eq_rows.append((eid, sid, rnd.choice(type_ids), f"EQ-{eid:07d}", f"Агрегат {eid}", status,
+                            commissioned.isoformat()))
+            eid += 1
+    counts["equipment"] = bulk(conn, "equipment",
+                               ("id", "site_id", "equipment_type_id", "code", "name", "status",
+                                "commissioning_date"), eq_rows)
+    del eq_rows
+
+    # остатки: каждая площадка держит долю номенклатуры, ~10% ниже точки заказа
+    stocked: List[Tuple[int, int]] = []
+
+    def inventory_rows():
+        for sid in site_ids:
+            for mid in material_ids:
+                if rnd.random() >= args.inventory_density:
+                    continue
+                stocked.append((sid, mid))
+                rp = float(rnd.randrange(5, 200))
+                qty = rp * rnd.uniform(0.0, 1.0) if rnd.random() < 0.1 else rp * rnd.uniform(1.0, 6.0)
+                yield sid, mid, round(qty, 2), rp
+    counts["inventory"] = bulk(conn, "inventory", ("site_id", "material_id", "qty_on_hand", "reorder_point"),
+                               inventory_rows())
+
+    # движения запаса: у каждой позиции свой темп расхода, в таблицу — по времени, как в журнале
+    def move_rows():
+        moves = []
+        for kind in weighted(rnd, MOVE_KIND, args.moves if stocked else 0):
+            sid, mid = stocked[min(int(rnd.paretovariate(1.2)) - 1, len(stocked) - 1) if rnd.random() < 0.5
+                               else rnd.randrange(len(stocked))]
+            qty = float(rnd.randrange(1, 20))
+            moves.append((ts(moment()), sid, mid, kind, qty if kind == "add" else -qty))
+        moves.sort()
+        for created, sid, mid, kind, qty in moves:
+            yield sid, mid, kind, qty, created
+    counts["stockmove"] = bulk(conn, "stockmove", ("site_id", "material_id", "kind", "qty", "created_at"),
+                               move_rows())
+
+    # заявки ТОиР + строки материалов + комментарии
+    w0 = next_id(conn, "workorder")
+    wo_ids = range(w0, w0 + args.work_orders)
+    statuses = weighted(rnd, WO_STATUS, args.work_orders)
+    priorities = weighted(rnd, WO_PRIORITY, args.work_orders)
+    types = weighted(rnd, WO_TYPE, args.work_orders)
+    author = conn.execute('SELECT MIN(id) FROM "user"').fetchone()[0] or 1
+    history = []
+
+    def wo_rows():
+        for i, wid in enumerate(wo_ids):
+            sid = rnd.choice(site_ids)
+            lo, hi = equipment_by_site[sid]
+            eq = rnd.randrange(lo, hi) if hi > lo else None
+            created = moment()
+            planned = (created + timedelta(days=rnd.randrange(1, 60))).date() if types[i] == "preventive" else None
+            team = rnd.choice(TEAMS) if statuses[i] != "new" else None
+            at = created
+            for step in range(WO_FLOW.index(statuses[i])):
+                at = min(now, at + timedelta(hours=rnd.expovariate(1 / WO_STEP_HOURS[priorities[i]][step])))
+                history.append((wid, WO_FLOW[step], WO_FLOW[step + 1], ts(at), author))
+            yield (wid, sid, types[i], statuses[i], priorities[i], f"Заявка ТОиР {wid}", None, eq,
+                   planned.isoformat() if planned else None, team, ts(created))
+    counts["workorder"] = bulk(conn, "workorder",
+                               ("id", "site_id", "type", "status", "priority", "title", "description",
+                                "equipment_id", "planned_date", "assigned_team", "created_at"), wo_rows())
+    counts["workorderstatushistory"] = bulk(conn, "workorderstatushistory",
+                                            ("work_order_id", "from_status", "to_status", "changed_at", "user_id"),
+                                            history)
+    history.clear()
+
+    def wom_rows():
+        for wid in wo_ids:
+            for mid in rnd.sample(material_ids, min(len(material_ids), int(rnd.expovariate(1 / args.lines_per_work_order)))):
+                planned = float(rnd.randrange(1, 20))
+                yield wid, mid, planned, planned if rnd.random() < 0.5 else 0.0
+    if material_ids:
+        counts["workordermaterial"] = bulk(conn, "workordermaterial",
+                                           ("work_order_id", "material_id", "qty_planned", "qty_fact"), wom_rows())
+
+    if args.work_orders:
+        counts["workordercomment"] = bulk(conn, "workordercomment",
+                                          ("work_order_id", "author_id", "text", "created_at"), (
+            (rnd.choice(wo_ids), author, f"Комментарий {i}", ts(moment())) for i in range(args.comments)
+        ))
+
+    # планы и позиции
+    p0 = next_id(conn, "productionplan")
+    plan_rows = []
+    pid = p0
+    for sid in site_ids:
+        for k in range(args.plans_per_site):
+            month = (now.replace(day=1) - timedelta(days=31 * k)).strftime("%Y-%m")
+            plan_rows.append((pid, sid, month, "published" if k else "draft"))
+            pid += 1
+    counts["productionplan"] = bulk(conn, "productionplan", ("id", "site_id", "period", "status"), plan_rows)
+    counts["planitem"] = bulk(conn, "planitem", ("plan_id", "product_name", "quantity"), (
+        (row[0], rnd.choice(PRODUCTS), rnd.randrange(10, 500))
+        for row in plan_rows for _ in range(args.plan_items)
+    ))
+    # спецификации: на изделие несколько материалов (повторный прогон добавит ещё строк — как и планы)
+    counts["productmaterial"] = bulk(conn, "productmaterial", ("product_name", "material_id", "qty_per_unit"), (
+        (name, mid, round(rnd.uniform(0.5, 5), 2))
+        for name in PRODUCTS for mid in rnd.sample(material_ids, min(len(material_ids), rnd.randrange(3, 9)))
+    ))
+
+    # заказы поставщикам и их строки
+    po0 = next_id(conn, "purchaseorder")
+    po_ids = list(range(po0, po0 + args.purchase_orders)) if supplier_ids else []
+    counts["purchaseorder"] = bulk(conn, "purchaseorder",
+                                   ("id", "supplier_id", "site_id", "status", "comment", "created_at"), (
+        (po_id, rnd.choice(supplier_ids), rnd.choice(site_ids), st, None, ts(moment()))
+        for po_id, st in zip(po_ids, weighted(rnd, PO_STATUS, len(po_ids)))
+    ))
+
+    def po_line_rows():
+        for po_id in po_ids:
+            for mid in rnd.sample(material_ids, min(len(material_ids), rnd.randrange(1, 6))):
+                qty = float(rnd.randrange(10, 500))
+                yield po_id, mid, qty, qty if rnd.random() < 0.3 else 0.0
+    counts["purchaseorderline"] = bulk(conn, "purchaseorderline",
+                                       ("purchase_order_id", "material_id", "qty", "qty_received"),
+                                       po_line_rows() if material_ids else ())
+
+    # журнал событий: время монотонно растёт, как в настоящем логе
+    step = span.total_seconds() / max(args.events, 1)
+
+    def event_rows():
+        kinds = weighted(rnd, [(t[:2], t[2]) for t in EVENT_TYPES], args.events)
+        for i, (typ, sev) in enumerate(kinds):
+            yield typ, f"{typ} #{i}", sev, ts(start + timedelta(seconds=i * step)), None
+    counts["event"] = bulk(conn, "event", ("type", "text", "severity", "created_at", "meta"), event_rows())
+    return counts
+
+
+def build_parser() -> argparse.ArgumentParser:
+    ap = argparse.ArgumentParser(prog="python -m app.datagen", description=__doc__.splitlines()[0])
+    ap.add_argument("--db", default=os.getenv("SQLITE_PATH") or str(Path(__file__).resolve().parent / "cpvp_ultra.db"),
+                    help="файл SQLite, который нужно заполнить")
+    ap.add_argument("--copy-from", help="сначала скопировать эту базу в --db (рабочая копия)")
+    ap.add_argument("--reset", action="store_true", help="удалить --db перед генерацией")
+    ap.add_argument("--seed", type=int, default=42)
+    ap.add_argument("--now", help="опорная дата ISO (по умолчанию 2025-11-01), чтобы прогоны совпадали")
+    ap.add_argument("--days", type=int, default=365, help="глубина истории в днях")
+    ap.add_argument("--sites", type=int, default=10)
+    ap.add_argument("--equipment-per-site", type=int, default=200)
+    ap.add_argument("--materials", type=int, default=2000)
+    ap.add_argument("--inventory-density", type=float, default=0.5, help="доля номенклатуры на складе площадки")
+    ap.add_argument("--suppliers", type=int, default=50)
+    ap.add_argument("--work-orders", type=int, default=50_000)
+    ap.add_argument("--lines-per-work-order", type=float, default=2.0, help="среднее число строк материалов")
+    ap.add_argument("--comments", type=int, default=50_000)
+    ap.add_argument("--plans-per-site", type=int, default=12)
+    ap.add_argument("--plan-items", type=int, default=20, help="позиций на план")
+    ap.add_argument("--purchase-orders", type=int, default=5_000)
+    ap.add_argument("--moves", type=int, default=200_000, help="движений запаса")
+    ap.add_argument("--events", type=int, default=1_000_000)
+    return ap
+
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    db = Path(args.db).resolve()
+    if args.reset:
+        for suffix in ("", "-wal", "-shm"):
+            Path(f"{db}{suffix}").unlink(missing_ok=True)
+    if args.copy_from:
+        shutil.copyfile(args.copy_from, db)
+
+    # схема и демо-данные создаются самим приложением при импорте
+    os.environ["SQLITE_PATH"] = str(db)
+    from app import app as appmod
+    appmod.engine.dispose()
+
+    t0 = time.perf_counter()
+    conn = sqlite3.connect(db)
+    conn.execute("PRAGMA synchronous=OFF")
+    conn.execute("PRAGMA cache_size=-262144")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    counts = generate(conn, args)
+    conn.execute("ANALYZE")
+    conn.close()
+    for table, n in counts.items():
+        print(f"{table:>20}: {n}")
+    print(f"готово за {time.perf_counter() - t0:.1f} с -> {db}", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
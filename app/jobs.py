@@ -0,0 +1,13 @@
+"""Точка входа рабочих процессов фоновых задач (раздел Background jobs в app.py).
+
+Пул запускает процессы через spawn и передаёт им ссылку на run: импортируется
+только этот модуль, а app.app подгружается уже с CPVP_JOB_WORKER=1 — без
+create_db_and_seed, схему и данные готовит основной процесс.
+"""
+import os
+
+
+def run(job_id: str, name: str, params: dict, versions: dict) -> int:
+    os.environ["CPVP_JOB_WORKER"] = "1"
+    from app import app as appmod
+    return appmod.run_job(job_id, name, params, versions)
@@ -19,6 +19,22 @@ async function API(url, opts={}){
     : r.text();
 }
 
+// несколько изменений одним запросом и одной транзакцией: [{method, path, body, query}]
+async function APIBatch(operations, atomic=true){
+  const r = await fetch('/api/v1/batch', {
+    method:'POST',
+    headers: {'Content-Type':'application/json'},
+    credentials:"include",
+    body: JSON.stringify({operations, atomic})
+  });
+  const j = await r.json();
+  if(!r.ok){
+    const failed = j.results?.[j.results.length-1];
+    throw new Error(failed?.error ? (typeof failed.error === "string" ? failed.error : JSON.stringify(failed.error)) : (j.detail || "Ошибка"));
+  }
+  return j.results;
+}
+
 function showAppShell(){ el("#appShell").classList.remove("hidden"); }
 function hideMarketing(){ el("#marketingHeader")?.classList.add("hidden"); }
 
@@ -48,6 +64,128 @@ document.addEventListener("click", (e)=>{
   rows.forEach(r=>table.tBodies[0].appendChild(r));
 });
 
+// Виртуализированная таблица для больших списков: в DOM только видимые строки
+// (плюс запас), страницы берутся с пагинированного API по мере прокрутки,
+// refresh() перечитывает видимые страницы и трогает только изменившиеся строки.
+//   url(page, pageSize) — адрес страницы; ответ {total, results|items}
+//   row(obj)            — ячейки строки, как в tplTable
+//   key(obj)            — ключ строки для diff (по умолчанию obj.id)
+class VTable{
+  constructor(host, {cols, url, row, key=o=>o.id, pageSize=100, rowHeight=41, height=560, overscan=10}){
+    Object.assign(this, {cols, url, row, key, pageSize, rowHeight, height, overscan});
+    this.total = 0;
+    this.pages = new Map();    // номер страницы -> массив объектов
+    this.loading = new Map();  // номер страницы -> Promise
+    this.shown = new Map();    // ключ -> {tr, sig}
+    host.innerHTML = `<div class="table-wrap vtable" style="max-height:${height}px">
+      <table class="table"><thead><tr>${cols.map(c=>`<th>${c}</th>`).join("")}</tr></thead>
+      <tbody><tr class="vt-pad"><td colspan="${cols.length}"></td></tr><tr class="vt-pad"><td colspan="${cols.length}"></td></tr></tbody></table>
+      <div class="vt-empty hidden">Нет данных</div></div>`;
+    this.wrap = el(".vtable", host);
+    this.body = el("tbody", this.wrap);
+    [this.top, this.bottom] = this.body.rows;
+    let frame = 0;
+    this.wrap.addEventListener("scroll", ()=>{
+      if(frame) return;
+      frame = requestAnimationFrame(()=>{ frame = 0; this.draw(); });
+    }, {passive:true});
+  }
+
+  async load(page, force=false){
+    if(!force && this.pages.has(page)) return;
+    if(this.loading.has(page)) return this.loading.get(page);
+    const p = API(this.url(page, this.pageSize)).then(d=>{
+      this.total = d.total ?? 0;
+      this.pages.set(page, d.results || d.items || []);
+    }).finally(()=> this.loading.delete(page));
+    this.loading.set(page, p);
+    return p;
+  }
+
+  range(){
+    const first = Math.max(0, Math.floor(this.wrap.scrollTop / this.rowHeight) - this.overscan);
+    // пока строк нет, обёртка ещё не растянута до max-height — считаем по нему
+    const count = Math.ceil(Math.max(this.wrap.clientHeight, this.height) / this.rowHeight) + 2*this.overscan;
+    return [first, Math.min(this.total, first + count)];
+  }
+
+  visiblePages(){
+    const [a, b] = this.range();
+    const out = [];
+    for(let p = Math.floor(a / this.pageSize) + 1; p <= Math.floor(Math.max(a, b-1) / this.pageSize) + 1; p++) out.push(p);
+    return out;
+  }
+
+  async start(){
+    await this.load(1);
+    this.draw();
+    // высоту строки берём с отрисованной строки — кнопки в ячейках её меняют
+    const h = this.body.rows[1]?.offsetHeight;
+    if(h && h !== this.rowHeight){ this.rowHeight = h; this.draw(); }
+    return this;
+  }
+
+  // перечитать видимые страницы (остальные в кэше устарели — забываем) и применить diff
+  async refresh(){
+    const need = this.visiblePages();
+    this.pages.clear();
+    await Promise.all(need.map(p=>this.load(p, true)));
+    this.draw();
+  }
+
+  draw(){
+    const [a, b] = this.range();
+    const missing = new Set();
+    const next = [];
+    const used = new Set();
+    for(let i = a; i < b; i++){
+      const page = Math.floor(i / this.pageSize) + 1;
+      const obj = this.pages.get(page)?.[i % this.pageSize];
+      if(obj === undefined) missing.add(page);
+      // пока страница не пришла — строка-заглушка; повтор ключа (данные сдвинулись между страницами) разводим по индексу
+      let k = obj === undefined ? `~${i}` : String(this.key(obj));
+      if(used.has(k)) k = `${k}~${i}`;
+      used.add(k);
+      next.push({i, obj, k});
+    }
+    if(missing.size){
+      Promise.all([...missing].map(p=>this.load(p))).then(()=>this.draw(), e=>toast(e.message||'Ошибка', false));
+    }
+    // строки, ушедшие из окна или из данных, — удаляем; остальные переиспользуем
+    for(const [k, r] of this.shown){
+      if(!used.has(k)){ r.tr.remove(); this.shown.delete(k); }
+    }
+    let cursor = this.top;
+    for(const {i, obj, k} of next){
+      const sig = obj === undefined ? "" : JSON.stringify(obj);
+      let r = this.shown.get(k);
+      if(!r){
+        r = {tr: document.createElement("tr"), sig: null};
+        this.shown.set(k, r);
+      }
+      if(r.sig !== sig){
+        r.tr.innerHTML = obj === undefined
+          ? `<td colspan="${this.cols.length}" class="text-slate-500">…</td>`
+          : this.row(obj).map(c=>`<td>${c ?? ""}</td>`).join("");
+        r.sig = sig;
+      }
+      r.tr.classList.toggle("odd", i % 2 === 1);
+      if(cursor.nextSibling !== r.tr) cursor.after(r.tr);
+      cursor = r.tr;
+    }
+    // высота пропущенных строк держит полосу прокрутки честной
+    this.top.style.height = `${a * this.rowHeight}px`;
+    this.bottom.style.height = `${Math.max(0, this.total - b) * this.rowHeight}px`;
+    el(".vt-empty", this.wrap).classList.toggle("hidden", this.total > 0 || this.loading.size > 0);
+  }
+}
+
+// после изменения: обновить таблицу на месте, если она ещё на экране, иначе перерисовать экран
+function refreshTable(name, fallback){
+  const t = TABLES[name];
+  return t && t.wrap.isConnected ? t.refresh() : fallback();
+}
+
 // Toasts & confirm
 function ensureToastWrap(){
   if(!el(".toast-wrap")){
@@ -84,6 +222,7 @@ function confirmBox(text){
 let USER = null;
 let CURRENT_VIEW = "dashboard";
 let inboxTimer = null;
+let TABLES = {};  // виртуализированные таблицы текущего экрана: имя -> VTable
 
 async function openLogin(){ el("#loginModal").classList.remove("hidden"); }
 
@@ -126,6 +265,7 @@ els("#nav button").forEach(b=> b.onclick = ()=> navigate(b.dataset.view));
 
 async function navigate(view){
   CURRENT_VIEW = view;
+  TABLES = {};
 
   // если уходим с «Уведомлений» — гасим таймер
   if(view !== "inbox" && inboxTimer){
@@ -276,12 +416,9 @@ async function deleteSite(id,name){
 
 // --- Equipment ---
 async function renderEquipment(){
-  const [types, list] = await Promise.all([
-    API('/api/v1/equipment-types'),
-    API('/api/v1/equipment?page=1&page_size=100')
-  ]);
+  const types = await API('/api/v1/equipment-types');
   const typeMap = Object.fromEntries(types.results.map(t=>[t.id, t.name]));
-  const rows = list.results.map(e=>[
+  const row = e=>[
     e.id,
     e.code,
     e.name,
@@ -293,7 +430,7 @@ async function renderEquipment(){
       <button class="btn-ghost" onclick="editEquipment(${e.id}, ${e.site_id}, ${e.equipment_type_id}, '${e.code}', '${e.name}', '${e.status}', '${e.commissioning_date}')">Изм.</button>
       <button class="btn-ghost" onclick="deleteEquipment(${e.id}, '${e.code}')">Удалить</button>
     </div>`
-  ]);
+  ];
   const typeOptions = types.results.map(t=>`<option value="${t.id}">${t.name}</option>`).join("");
   const create = `<div class="card">
     <div class="text-lg font-semibold mb-2">Добавить оборудование</div>
@@ -315,7 +452,12 @@ async function renderEquipment(){
   </div>`;
   el("#view").innerHTML = hero("Оборудование","Реестр технологического оборудования.")
     + create
-    + tplTable(["ID","Код","Название","Статус","Site","Тип","Ввод","Действия"], rows, {sortable:[0,1,2,3,4,6]});
+    + `<div id="eqTable"></div>`;
+  TABLES.equipment = await new VTable(el("#eqTable"), {
+    cols: ["ID","Код","Название","Статус","Site","Тип","Ввод","Действия"],
+    url: (page, size)=>`/api/v1/equipment?page=${page}&page_size=${size}`,
+    row
+  }).start();
 }
 async function createEquipment(){
   const payload={
@@ -329,7 +471,7 @@ async function createEquipment(){
   try{
     await API('/api/v1/equipment', {method:'POST', body: JSON.stringify(payload)});
     toast('Добавлено');
-    renderEquipment();
+    refreshTable('equipment', renderEquipment);
   }catch(e){ toast(e.message||'Ошибка',false); }
 }
 async function editEquipment(id, site_id, type_id, code, name, status, dateStr){
@@ -358,7 +500,8 @@ async function editEquipment(id, site_id, type_id, code, name, status, dateStr){
     try{
       await API(`/api/v1/equipment/${id}`, {method:'PUT', body: JSON.stringify(payload)});
       toast('Сохранено');
-      renderEquipment();
+      box.remove();
+      refreshTable('equipment', renderEquipment);
     }catch(e){ toast(e.message||'Ошибка',false); }
   };
 }
@@ -368,7 +511,7 @@ async function deleteEquipment(id, code){
   try{
     await API(`/api/v1/equipment/${id}`, {method:'DELETE'});
     toast('Удалено');
-    renderEquipment();
+    refreshTable('equipment', renderEquipment);
   }catch(e){ toast(e.message||'Ошибка',false); }
 }
 
@@ -386,11 +529,7 @@ async function renderInventory(siteId){
       + tplTable(["ID","Площадка","Регион",""], rows, {sortable:[0,1,2]});
     return;
   }
-  const [inv, mats] = await Promise.all([
-    API(`/api/v1/sites/${siteId}/inventory`),
-    API('/api/v1/materials?page=1&page_size=200')
-  ]);
-  const rows = inv.items.map(i=>[
+  const invRow = i=>[
     i.material_id,
     i.material_name,
     i.unit,
@@ -399,7 +538,7 @@ async function renderInventory(siteId){
     `<div class="flex gap-2">
       <button class="btn-ghost" onclick="editInv(${siteId}, ${i.material_id}, ${i.qty_on_hand}, ${i.reorder_point}, '${i.material_name}')">Изм. остаток</button>
     </div>`
-  ]);
+  ];
   const createMat = `<div class="card">
     <div class="text-lg font-semibold mb-2">Добавить материал</div>
     <div class="grid md:grid-cols-4 gap-3">
@@ -411,10 +550,14 @@ async function renderInventory(siteId){
   </div>`;
   el("#view").innerHTML = hero("Материалы и склад","Остатки по площадке.")
     + createMat
-    + `<div class="text-lg font-semibold mb-2">Склад площадки #${inv.site_id}</div>`
-    + tplTable(["Материал","Название","Ед.","Остаток","ROP","Действия"], rows, {sortable:[0,1,3,4]});
+    + `<div class="text-lg font-semibold mb-2">Склад площадки #${siteId}</div>`
+    + `<div id="invTable"></div>`
+    + `<div class="mt-4 card">
+         <div class="text-lg font-semibold mb-2">Все материалы</div>
+         <div id="matTable"></div>
+       </div>`;
 
-  const matRows = mats.results.map(m=>[
+  const matRow = m=>[
     m.id,
     m.name,
     m.unit,
@@ -423,14 +566,21 @@ async function renderInventory(siteId){
       <button class="btn-ghost" onclick="editMaterial(${m.id}, '${m.name}', '${m.unit}', ${m.reject_percent||0})">Изм.</button>
       <button class="btn-ghost" onclick="deleteMaterial(${m.id}, '${m.name}')">Удал.</button>
     </div>`
+  ];
+  [TABLES.inventory, TABLES.materials] = await Promise.all([
+    new VTable(el("#invTable"), {
+      cols: ["Материал","Название","Ед.","Остаток","ROP","Действия"],
+      url: (page, size)=>`/api/v1/sites/${siteId}/inventory?page=${page}&page_size=${size}`,
+      row: invRow,
+      key: i=>i.material_id
+    }).start(),
+    new VTable(el("#matTable"), {
+      cols: ["ID","Название","Ед.","% брака","Действия"],
+      url: (page, size)=>`/api/v1/materials?page=${page}&page_size=${size}`,
+      row: matRow,
+      height: 420
+    }).start()
   ]);
-  el("#view").insertAdjacentHTML(
-    'beforeend',
-    `<div class="mt-4 card">
-       <div class="text-lg font-semibold mb-2">Все материалы</div>
-       ${tplTable(["ID","Название","Ед.","% брака","Действия"], matRows, {sortable:[0,1,2,3]})}
-     </div>`
-  );
 }
 async function editInv(site_id, material_id, qty, rop, name){
   const box=document.createElement('div');
@@ -452,7 +602,8 @@ async function editInv(site_id, material_id, qty, rop, name){
         })
       });
       toast('Остаток обновлён');
-      renderInventory(site_id);
+      box.remove();
+      refreshTable('inventory', ()=>renderInventory(site_id));
     }catch(e){ toast(e.message||'Ошибка',false); }
   };
 }
@@ -467,7 +618,7 @@ async function createMaterial(){
       })
     });
     toast('Материал создан');
-    renderInventory(1);
+    refreshTable('materials', ()=>renderInventory(1));
   }catch(e){ toast(e.message||'Ошибка',false); }
 }
 async function editMaterial(id, name, unit, reject){
@@ -492,7 +643,8 @@ async function editMaterial(id, name, unit, reject){
         })
       });
       toast('Сохранено');
-      renderInventory(1);
+      box.remove();
+      refreshTable('materials', ()=>renderInventory(1));
     }catch(e){ toast(e.message||'Ошибка',false); }
   };
 }
@@ -502,7 +654,7 @@ async function deleteMaterial(id, name){
   try{
     await API(`/api/v1/materials/${id}`, {method:'DELETE'});
     toast('Удалено');
-    renderInventory(1);
+    refreshTable('materials', ()=>renderInventory(1));
   }catch(e){ toast(e.message||'Ошибка',false); }
 }
 
@@ -522,14 +674,47 @@ function markRead(id){
 }
 function clearRead(){
   localStorage.removeItem('read_events');
-  drawInbox();
+  els("#inboxList .timeline-item").forEach(n=>n.classList.remove("opacity-60"));
+}
+
+// лента держит курсор сервера: опрос забирает только новые события под текущий фильтр
+const INBOX = {cursor: null, gen: 0};
+const INBOX_KEEP = 500;
+
+function inboxQuery(extra){
+  const q = new URLSearchParams(extra);
+  const t = el("#f_type")?.value, sev = el("#f_sev")?.value;
+  const since = el("#f_since")?.value, until = el("#f_until")?.value;
+  if(t) q.set("type", t);
+  if(sev) q.set("severity", sev);
+  // datetime-local — местное время, сервер хранит UTC
+  if(since) q.set("since", new Date(since).toISOString());
+  if(until) q.set("until", new Date(until).toISOString());
+  return q.toString();
+}
+
+function inboxNode(e){
+  const icon = (t)=> t.includes("plan")?"🗓️":t.includes("work_order")?"🛠️":t.includes("po_")?"🧾":t.includes("auth")?"🔑":"ℹ️";
+  const sev  = (s)=> s==="success"?"ok":(s==="warning"?"warn":(s==="danger"?"err":""));
+  const node = document.createElement("div");
+  node.className = `timeline-item ${isRead(e.id)?'opacity-60':''}`;
+  node.dataset.id = e.id;
+  node.onclick = ()=>{ markRead(e.id); node.classList.add("opacity-60"); };
+  node.innerHTML = `<div class="timeline-dot"></div>
+    <div class="ev">
+      <span>${icon(e.type)}</span>
+      <span class="badge ${sev(e.severity)}">${e.severity}</span>
+      <span class="text-slate-300">${e.text}</span>
+      <span class="text-slate-500 text-sm">• ${new Date(e.created_at).toLocaleString()}</span>
+    </div>`;
+  return node;
 }
 
 async function renderInbox(){
   el("#view").innerHTML = hero("Лента событий", "Планы, заявки ТОиР, закупки, авторизации — обновляется автоматически.");
 
   const controls = `<div class="card mb-2">
-    <div class="grid md:grid-cols-4 gap-3">
+    <div class="grid md:grid-cols-6 gap-3">
       <label class="field"><span>Тип</span>
         <select id="f_type" class="input">
           <option value="">Все</option>
@@ -548,49 +733,67 @@ async function renderInbox(){
           <option value="info">info</option>
         </select>
       </label>
-      <div class="flex items-end"><button class="btn-ghost" onclick="drawInbox()">Применить</button></div>
+      <label class="field"><span>С</span><input id="f_since" type="datetime-local" class="input"></label>
+      <label class="field"><span>По</span><input id="f_until" type="datetime-local" class="input"></label>
+      <div class="flex items-end"><button class="btn-ghost" onclick="drawInbox(true)">Применить</button></div>
       <div class="flex items-end"><button class="btn-ghost" onclick="clearRead()">Сброс отметок</button></div>
     </div>
   </div>`;
 
   el("#view").insertAdjacentHTML('beforeend', controls + `<div id="inboxList"></div>`);
 
-  await drawInbox();
+  await drawInbox(true);
 
   if(inboxTimer) clearInterval(inboxTimer);
   inboxTimer = setInterval(drawInbox, 5000);
 }
 
-async function drawInbox(){
+async function drawInbox(reset=false){
   // не рисуем, если пользователь уже ушёл с вкладки
   if(CURRENT_VIEW !== "inbox") return;
 
   const container = el("#inboxList");
   if(!container) return;
 
-  const data = await API('/api/v1/events?limit=60');
-  const t    = el("#f_type")?.value || "";
-  const sevF = el("#f_sev")?.value  || "";
-  const icon = (t)=> t.includes("plan")?"🗓️":t.includes("work_order")?"🛠️":t.includes("po_")?"🧾":t.includes("auth")?"🔑":"ℹ️";
-  const sev  = (s)=> s==="success"?"ok":(s==="warning"?"warn":(s==="danger"?"err":""));
+  if(reset === true || INBOX.cursor === null || !el(".timeline", container)){
+    const gen = ++INBOX.gen;
+    const data = await API(`/api/v1/events?${inboxQuery({limit: 60})}`);
+    if(gen !== INBOX.gen) return;
+    container.innerHTML = `<div class="card"><div class="timeline"></div>
+      <div class="mt-2"><button id="inboxMore" class="btn-ghost hidden" onclick="inboxOlder()">Показать ещё</button></div></div>`;
+    el(".timeline", container).append(...data.results.map(inboxNode));
+    el("#inboxMore").classList.toggle("hidden", !data.more);
+    INBOX.cursor = data.cursor;
+    return;
+  }
 
-  const html = data.results
-    .filter(e=>!t || e.type.includes(t))
-    .filter(e=>!sevF || e.severity===sevF)
-    .map(e=>{
-      const read = isRead(e.id);
-      return `<div class="timeline-item ${read?'opacity-60':''}" onclick="markRead(${e.id})">
-        <div class="timeline-dot"></div>
-        <div class="ev">
-          <span>${icon(e.type)}</span>
-          <span class="badge ${sev(e.severity)}">${e.severity}</span>
-          <span class="text-slate-300">${e.text}</span>
-          <span class="text-slate-500 text-sm">• ${new Date(e.created_at).toLocaleString()}</span>
-        </div>
-      </div>`;
-    }).join("");
-
-  container.innerHTML = `<div class="card"><div class="timeline">${html}</div></div>`;
+  // опрос: только события после курсора; уже показанные узлы не трогаем
+  const gen = INBOX.gen;
+  let data;
+  do{
+    data = await API(`/api/v1/events?${inboxQuery({limit: 60, after_id: INBOX.cursor})}`);
+    if(gen !== INBOX.gen) return;  // фильтр сменили, пока шёл запрос
+    el("#inboxList .timeline")?.prepend(...data.results.map(inboxNode));
+    INBOX.cursor = data.cursor;
+  }while(data.more && CURRENT_VIEW === "inbox");
+
+  // лента не растёт бесконечно: отрезанный хвост снова доступен по «Показать ещё»
+  const list = el("#inboxList .timeline");
+  if(list && list.children.length > INBOX_KEEP){
+    while(list.children.length > INBOX_KEEP) list.lastElementChild.remove();
+    el("#inboxMore")?.classList.remove("hidden");
+  }
+}
+
+async function inboxOlder(){
+  const list = el("#inboxList .timeline");
+  const last = list?.lastElementChild;
+  if(!last) return;
+  const gen = INBOX.gen;
+  const data = await API(`/api/v1/events?${inboxQuery({limit: 60, before_id: last.dataset.id})}`);
+  if(gen !== INBOX.gen) return;
+  list.append(...data.results.map(inboxNode));
+  el("#inboxMore").classList.toggle("hidden", !data.more);
 }
 
 // --- Reports ---
@@ -636,12 +839,9 @@ async function renderReports(){
 
 // --- Work Orders (ТОиР) ---
 async function renderWorkOrders(){
-  const [sites, data] = await Promise.all([
-    API('/api/v1/sites?page=1&page_size=100'),
-    API('/api/v1/workorders')
-  ]);
+  const sites = await API('/api/v1/sites?page=1&page_size=100');
   const siteMap = Object.fromEntries((sites.results||[]).map(s=>[s.id, s.name]));
-  const rows = data.results.map(w=>[
+  const row = w=>[
     w.id,
     siteMap[w.site_id] || w.site_id,
     w.title,
@@ -653,7 +853,7 @@ async function renderWorkOrders(){
       <button class="btn-ghost" onclick="woChangeStatus(${w.id}, 'in_progress')">В работу</button>
       <button class="btn-ghost" onclick="woChangeStatus(${w.id}, 'done')">Закрыть</button>
     </div>`
-  ]);
+  ];
   const create = `<div class="card">
     <div class="text-lg font-semibold mb-2">Новая заявка ТОиР</div>
     <div class="grid md:grid-cols-6 gap-3">
@@ -682,11 +882,12 @@ async function renderWorkOrders(){
   </div>`;
   el("#view").innerHTML = hero("Заявки ТОиР","Создание, статусы и назначение бригад.")
     + create
-    + tplTable(
-        ["ID","Площадка","Заголовок","Статус","Приоритет","Бригада","Плановая дата","Действия"],
-        rows,
-        {sortable:[0,1,2,3,4,6]}
-      );
+    + `<div id="woTable"></div>`;
+  TABLES.workorders = await new VTable(el("#woTable"), {
+    cols: ["ID","Площадка","Заголовок","Статус","Приоритет","Бригада","Плановая дата","Действия"],
+    url: (page, size)=>`/api/v1/workorders?page=${page}&page_size=${size}`,
+    row
+  }).start();
 }
 async function createWorkOrder(){
   const payload = {
@@ -702,14 +903,14 @@ async function createWorkOrder(){
   try{
     await API('/api/v1/workorders', {method:'POST', body: JSON.stringify(payload)});
     toast("Заявка создана");
-    renderWorkOrders();
+    refreshTable('workorders', renderWorkOrders);
   }catch(e){ toast(e.message||"Ошибка", false); }
 }
 async function woChangeStatus(id, status){
   try{
     await API(`/api/v1/workorders/${id}/status`, {method:'POST', body: JSON.stringify({status})});
     toast("Статус обновлён");
-    renderWorkOrders();
+    refreshTable('workorders', renderWorkOrders);
   }catch(e){ toast(e.message||"Ошибка", false); }
 }
 
@@ -0,0 +1,455 @@
+"""Нагрузочный стенд для /api/v1.
+
+Поднимает приложение в этом же процессе (uvicorn в отдельном потоке) поверх
+сгенерированного набора данных (app.datagen), входит один раз под admin и гоняет
+смеси запросов несколькими клиентскими потоками. Для каждого сценария и маршрута
+считает пропускную способность и p50/p95/p99, пишет JSON и сравнивает с базовым
+прогоном.
+
+Примеры:
+    python -m bench.http_load --dataset small --duration 10 --out bench/results/latest.json
+    python -m bench.http_load --dataset medium --baseline bench/results/baseline.json
+    python -m bench.http_load --scenario endpoint:list_inventory --concurrency 4
+"""
+import argparse
+import http.client
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+ROOT = Path(__file__).resolve().parent.parent
+DATA_DIR = Path(__file__).resolve().parent / ".data"
+API = "/api/v1"
+
+# параметры app.datagen для типовых объёмов
+DATASETS: Dict[str, List[str]] = {
+    "small": ["--sites", "3", "--equipment-per-site", "50", "--materials", "300", "--work-orders", "3000",
+              "--comments", "3000", "--purchase-orders", "300", "--events", "50000"],
+    "medium": [],  # значения по умолчанию генератора
+    "large": ["--sites", "50", "--equipment-per-site", "2000", "--materials", "10000",
+              "--work-orders", "500000", "--comments", "500000", "--purchase-orders", "50000",
+              "--events", "5000000"],
+}
+
+# Запрос: (метод, путь, тело, метка маршрута)
+Request = Tuple[str, str, Optional[dict], str]
+
+
+@dataclass
+class Fixture:
+    """Идентификаторы из набора данных, из которых строятся запросы."""
+    site_ids: List[int]
+    inventory: List[Tuple[int, int]]
+    work_order_ids: List[int]
+    plan_ids: List[int]
+    supplier_ids: List[int]
+
+
+def load_fixture(db: Path) -> Fixture:
+    import sqlite3
+    conn = sqlite3.connect(db)
+    q = lambda sql: [r[0] for r in conn.execute(sql)]
+    fx = Fixture(
+        site_ids=q("SELECT id FROM site"),
+        inventory=[tuple(r) for r in conn.execute("SELECT site_id, material_id FROM inventory ORDER BY RANDOM() LIMIT 5000")],
+        work_order_ids=q("SELECT id FROM workorder ORDER BY RANDOM() LIMIT 5000"),
+        plan_ids=q("SELECT id FROM productionplan LIMIT 1000"),
+        supplier_ids=q("SELECT id FROM supplier"),
+    )
+    conn.close()
+    return fx
+
+
+# ---- Отдельные запросы ----
+def r_events(rnd, fx):
+    return "GET", f"{API}/events?limit=60", None, "GET /events"
+
+
+def r_workorders(rnd, fx):
+    return "GET", f"{API}/workorders?site_id={rnd.choice(fx.site_ids)}", None, "GET /workorders"
+
+
+def r_workorder(rnd, fx):
+    return "GET", f"{API}/workorders/{rnd.choice(fx.work_order_ids)}", None, "GET /workorders/{wid}"
+
+
+def r_dashboard(rnd, fx):
+    return "GET", f"{API}/analytics/dashboard", None, "GET /analytics/dashboard"
+
+
+def r_kpi(rnd, fx):
+    return "GET", f"{API}/analytics/kpi", None, "GET /analytics/kpi"
+
+
+def r_rpt_status(rnd, fx):
+    return "GET", f"{API}/reports/work_orders_by_status", None, "GET /reports/work_orders_by_status"
+
+
+def r_rpt_inv(rnd, fx):
+    return "GET", f"{API}/reports/inventory_breakdown", None, "GET /reports/inventory_breakdown"
+
+
+def r_inventory(rnd, fx):
+    return "GET", f"{API}/inventory", None, "GET /inventory"
+
+
+def r_site_inventory(rnd, fx):
+    return "GET", f"{API}/sites/{rnd.choice(fx.site_ids)}/inventory", None, "GET /sites/{site_id}/inventory"
+
+
+def r_sites(rnd, fx):
+    return "GET", f"{API}/sites", None, "GET /sites"
+
+
+def r_equipment(rnd, fx):
+    return "GET", f"{API}/equipment?site_id={rnd.choice(fx.site_ids)}", None, "GET /equipment"
+
+
+def r_materials(rnd, fx):
+    return "GET", f"{API}/materials", None, "GET /materials"
+
+
+def r_purchase_orders(rnd, fx):
+    return "GET", f"{API}/purchase_orders", None, "GET /purchase_orders"
+
+
+def r_plans(rnd, fx):
+    return "GET", f"{API}/plans?site_id={rnd.choice(fx.site_ids)}", None, "GET /plans"
+
+
+def r_plan(rnd, fx):
+    return "GET", f"{API}/plans/{rnd.choice(fx.plan_ids)}", None, "GET /plans/{pid}"
+
+
+def r_me(rnd, fx):
+    return "GET", f"{API}/auth/me", None, "GET /auth/me"
+
+
+def _move(kind: str):
+    def build(rnd, fx):
+        sid, mid = rnd.choice(fx.inventory)
+        return "POST", f"{API}/inventory/{kind}", {"site_id": sid, "material_id": mid, "qty": 1.0}, f"POST /inventory/{kind}"
+    return build
+
+
+def r_create_wo(rnd, fx):
+    body = {"site_id": rnd.choice(fx.site_ids), "type": rnd.choice(("corrective", "preventive")),
+            "priority": rnd.choice(("low", "normal", "high")), "title": "Нагрузочный тест"}
+    return "POST", f"{API}/workorders", body, "POST /workorders"
+
+
+def r_wo_status(rnd, fx):
+    return ("POST", f"{API}/workorders/{rnd.choice(fx.work_order_ids)}/status",
+            {"status": rnd.choice(("in_progress", "done"))}, "POST /workorders/{wid}/status")
+
+
+def r_wo_comment(rnd, fx):
+    return ("POST", f"{API}/workorders/{rnd.choice(fx.work_order_ids)}/comment",
+            {"text": "нагрузочный комментарий"}, "POST /workorders/{wid}/comment")
+
+
+Builder = Callable[[random.Random, Fixture], Request]
+
+# ---- Смеси ----
+SCENARIOS: Dict[str, Sequence[Tuple[int, Builder]]] = {
+    # оператор держит открытым «Уведомления» и заглядывает в заявки
+    "inbox_operator": ((6, r_events), (2, r_workorders), (2, r_workorder), (1, r_me)),
+    # руководитель смотрит сводку и отчёты
+    "dashboard_viewer": ((3, r_dashboard), (2, r_kpi), (1, r_rpt_status), (1, r_rpt_inv), (1, r_events)),
+    # кладовщик двигает остатки и смотрит склад площадки
+    "inventory_moves": ((3, _move("consume")), (2, _move("reserve")), (1, _move("add")), (2, r_site_inventory)),
+    # диспетчер создаёт и ведёт заявки
+    "workorder_create": ((3, r_create_wo), (2, r_wo_status), (1, r_wo_comment), (2, r_workorders)),
+}
+SCENARIOS["mixed"] = (
+    tuple((w * 4, b) for w, b in SCENARIOS["inbox_operator"])
+    + tuple((w * 2, b) for w, b in SCENARIOS["dashboard_viewer"])
+    + tuple((w * 2, b) for w, b in SCENARIOS["inventory_moves"])
+    + tuple((w, b) for w, b in SCENARIOS["workorder_create"])
+)
+for _name, _builder in (
+    ("list_sites", r_sites), ("list_equipment", r_equipment), ("list_materials", r_materials),
+    ("list_inventory", r_inventory), ("site_inventory", r_site_inventory), ("list_workorders", r_workorders),
+    ("get_workorder", r_workorder), ("list_purchase_orders", r_purchase_orders), ("list_plans", r_plans),
+    ("get_plan", r_plan), ("get_events", r_events), ("analytics_dashboard", r_dashboard),
+    ("analytics_kpi", r_kpi), ("inventory_consume", _move("consume")), ("create_workorder", r_create_wo),
+):
+    SCENARIOS[f"endpoint:{_name}"] = ((1, _builder),)
+
+
+# ---- Сервер в процессе ----
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class InProcessServer:
+    def __init__(self, db: Path):
+        os.environ["SQLITE_PATH"] = str(db)
+        import uvicorn
+        from app import app as appmod
+        self.appmod = appmod
+        self.port = free_port()
+        self.server = uvicorn.Server(uvicorn.Config(appmod.app, host="127.0.0.1", port=self.port,
+                                                    log_level="warning", access_log=False))
+        self.thread = threading.Thread(target=self.server.run, name="uvicorn", daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        deadline = time.time() + 30
+        while not self.server.started:
+            if time.time() > deadline or not self.thread.is_alive():
+                raise RuntimeError("uvicorn не запустился")
+            time.sleep(0.05)
+        return self
+
+    def __exit__(self, *exc):
+        self.server.should_exit = True
+        self.thread.join(10)
+
+
+def login(port: int) -> str:
+    conn = http.client.HTTPConnection("127.0.0.1", port)
+    conn.request("POST", f"{API}/auth/login", body=json.dumps({"login": "admin", "password": "admin"}),
+                 headers={"Content-Type": "application/json"})
+    resp = conn.getresponse()
+    resp.read()
+    if resp.status != 200:
+        raise RuntimeError(f"вход не удался: HTTP {resp.status}")
+    cookie = resp.getheader("set-cookie", "")
+    conn.close()
+    return cookie.split(";", 1)[0]
+
+
+# ---- Прогон ----
+@dataclass
+class RouteStats:
+    latencies: List[float] = field(default_factory=list)
+    statuses: Dict[int, int] = field(default_factory=dict)
+    bytes: int = 0
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    if not sorted_values:
+        return 0.0
+    k = max(0, min(len(sorted_values) - 1, int(round(p / 100.0 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[k]
+
+
+def run_scenario(port: int, cookie: str, fx: Fixture, mix: Sequence[Tuple[int, Builder]], *,
+                 concurrency: int, duration: float, warmup: float, seed: int,
+                 sampler: Optional[Callable[[], None]] = None) -> Tuple[Dict[str, RouteStats], float]:
+    weights = [w for w, _ in mix]
+    builders = [b for _, b in mix]
+    per_worker: List[Dict[str, RouteStats]] = [dict() for _ in range(concurrency)]
+    start_at = time.perf_counter() + warmup
+    stop_at = start_at + duration
+    headers = {"Content-Type": "application/json", "Cookie": cookie}
+
+    def worker(idx: int):
+        rnd = random.Random(seed * 1000 + idx)
+        stats = per_worker[idx]
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=120)
+        while True:
+            now = time.perf_counter()
+            if now >= stop_at:
+                break
+            method, path, body, label = rnd.choices(builders, weights)[0](rnd, fx)
+            t0 = time.perf_counter()
+            try:
+                conn.request(method, path, body=json.dumps(body) if body is not None else None, headers=headers)
+                resp = conn.getresponse()
+                payload = resp.read()
+                status = resp.status
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                conn = http.client.HTTPConnection("127.0.0.1", port, timeout=120)
+                payload, status = b"", 0
+            t1 = time.perf_counter()
+            if t0 < start_at:
+                continue  # прогрев не учитываем
+            st = stats.setdefault(label, RouteStats())
+            st.latencies.append(t1 - t0)
+            st.statuses[status] = st.statuses.get(status, 0) + 1
+            st.bytes += len(payload)
+        conn.close()
+
+    threads = [threading.Thread(target=worker, args=(i,), daemon=True) for i in range(concurrency)]
+    for th in threads:
+        th.start()
+    while any(th.is_alive() for th in threads):
+        if sampler:
+            sampler()
+        time.sleep(0.1)
+    elapsed = max(time.perf_counter() - start_at, 1e-9)
+
+    merged: Dict[str, RouteStats] = {}
+    for stats in per_worker:
+        for label, st in stats.items():
+            m = merged.setdefault(label, RouteStats())
+            m.latencies.extend(st.latencies)
+            m.bytes += st.bytes
+            for code, n in st.statuses.items():
+                m.statuses[code] = m.statuses.get(code, 0) + n
+    return merged, elapsed
+
+
+def summarize(merged: Dict[str, RouteStats], elapsed: float) -> dict:
+    routes = {}
+    total = errors = 0
+    for label, st in sorted(merged.items()):
+        lat = sorted(st.latencies)
+        n = len(lat)
+        err = sum(c for code, c in st.statuses.items() if code == 0 or code >= 500)
+        total += n
+        errors += err
+        routes[label] = {
+            "count": n,
+            "rps": round(n / elapsed, 2),
+            "errors": err,
+            "statuses": {str(k): v for k, v in sorted(st.statuses.items())},
+            "mean_ms": round(sum(lat) / n * 1000, 3) if n else 0.0,
+            "p50_ms": round(percentile(lat, 50) * 1000, 3),
+            "p95_ms": round(percentile(lat, 95) * 1000, 3),
+            "p99_ms": round(percentile(lat, 99) * 1000, 3),
+            "max_ms": round(lat[-1] * 1000, 3) if n else 0.0,
+            "bytes_per_req": round(st.bytes / n) if n else 0,
+        }
+    return {"requests": total, "errors": errors, "elapsed_s": round(elapsed, 3),
+            "rps": round(total / elapsed, 2), "routes": routes}
+
+
+def compare(current: dict, baseline: dict, tolerance: float) -> List[str]:
+    """Регрессии: p95 выросла или пропускная способность упала больше чем на tolerance."""
+    problems = []
+    for name, sc in current["scenarios"].items():
+        base_sc = baseline.get("scenarios", {}).get(name)
+        if not base_sc:
+            continue
+        if base_sc["rps"] and sc["rps"] < base_sc["rps"] * (1 - tolerance):
+            problems.append(f"{name}: rps {sc['rps']} < {base_sc['rps']} (базовый)")
+        for label, r in sc["routes"].items():
+            b = base_sc["routes"].get(label)
+            if not b or not b["count"]:
+                continue
+            if r["p95_ms"] > b["p95_ms"] * (1 + tolerance):
+                problems.append(f"{name} / {label}: p95 {r['p95_ms']} мс > {b['p95_ms']} мс (базовый)")
+    return problems
+
+
+def ensure_dataset(name: str, seed: int) -> Path:
+    path = DATA_DIR / f"{name}-{seed}.db"
+    if not path.exists():
+        DATA_DIR.mkdir(parents=True, exist_ok=True)
+        cmd = [sys.executable, "-m", "app.datagen", "--db", str(path), "--reset", "--seed", str(seed)] + DATASETS[name]
+        subprocess.run(cmd, cwd=ROOT, check=True, stdout=subprocess.DEVNULL)
+    return path
+
+
+def git_rev() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True).stdout.strip()
+    except OSError:
+        return ""
+
+
+def print_report(report: dict):
+    for name, sc in report["scenarios"].items():
+        print(f"\n== {name}: {sc['rps']} req/s, {sc['requests']} запросов, ошибок {sc['errors']}")
+        print(f"   {'маршрут':<42}{'rps':>9}{'p50':>10}{'p95':>10}{'p99':>10}")
+        for label, r in sc["routes"].items():
+            print(f"   {label:<42}{r['rps']:>9}{r['p50_ms']:>10}{r['p95_ms']:>10}{r['p99_ms']:>10}")
+        if sc.get("pools"):
+            print("   пулы (пик выданных соединений): " +
+                  ", ".join(f"{k}={v}" for k, v in sc["pools"].items()))
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(prog="python -m bench.http_load", description=__doc__.splitlines()[0])
+    src = ap.add_mutually_exclusive_group()
+    src.add_argument("--dataset", choices=sorted(DATASETS), default="small",
+                     help="сгенерировать (один раз, с кэшем в bench/.data) набор данных такого объёма")
+    src.add_argument("--db", help="готовая база; для прогона делается рабочая копия")
+    ap.add_argument("--seed", type=int, default=42)
+    ap.add_argument("--scenario", action="append", help="имя сценария (можно несколько); по умолчанию все смеси")
+    ap.add_argument("--list", action="store_true", help="показать сценарии и выйти")
+    ap.add_argument("--concurrency", type=int, default=8)
+    ap.add_argument("--duration", type=float, default=15.0, help="секунд на сценарий")
+    ap.add_argument("--warmup", type=float, default=2.0)
+    ap.add_argument("--out", default=str(Path(__file__).resolve().parent / "results" / "latest.json"))
+    ap.add_argument("--baseline", help="JSON прошлого прогона для сравнения")
+    ap.add_argument("--tolerance", type=float, default=0.2, help="допустимое ухудшение (доля)")
+    args = ap.parse_args(argv)
+
+    if args.list:
+        print("\n".join(SCENARIOS))
+        return 0
+    names = args.scenario or [n for n in SCENARIOS if not n.startswith("endpoint:")]
+    unknown = [n for n in names if n not in SCENARIOS]
+    if unknown:
+        ap.error(f"неизвестные сценарии: {', '.join(unknown)}")
+
+    source = Path(args.db) if args.db else ensure_dataset(args.dataset, args.seed)
+    workdir = Path(tempfile.mkdtemp(prefix="cpvp-bench-"))
+    db = workdir / "bench.db"
+    shutil.copyfile(source, db)
+    fx = load_fixture(db)
+
+    report = {
+        "meta": {
+            "dataset": args.db or args.dataset, "seed": args.seed, "concurrency": args.concurrency,
+            "duration_s": args.duration, "git": git_rev(), "python": platform.python_version(),
+            "platform": platform.platform(), "started_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "scenarios": {},
+    }
+    try:
+        with InProcessServer(db) as srv:
+            cookie = login(srv.port)
+            for name in names:
+                peaks: Dict[str, int] = {}
+
+                def sample_pools():
+                    for pool, st in srv.appmod.db_pool_stats().items():
+                        peaks[pool] = max(peaks.get(pool, 0), st["checked_out"])
+
+                merged, elapsed = run_scenario(srv.port, cookie, fx, SCENARIOS[name], concurrency=args.concurrency,
+                                               duration=args.duration, warmup=args.warmup, seed=args.seed,
+                                               sampler=sample_pools)
+                report["scenarios"][name] = summarize(merged, elapsed)
+                report["scenarios"][name]["pools"] = peaks
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print_report(report)
+    out = Path(args.out)
+    out.parent.mkdir(parents=True, exist_ok=True)
+    out.write_text(json.dumps(report, ensure_ascii=False, indent=2))
+    print(f"\nрезультаты: {out}")
+
+    if args.baseline:
+        problems = compare(report, json.loads(Path(args.baseline).read_text()), args.tolerance)
+        if problems:
+            print("\nРЕГРЕССИИ относительно базового прогона:")
+            for p in problems:
+                print("  - " + p)
+            return 1
+        print("\nрегрессий относительно базового прогона нет")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,98 @@
+"""Накладные расходы MetricsMiddleware.
+
+Гоняет один и тот же минимальный FastAPI-маршрут напрямую через ASGI (без сети)
+без middleware и с ним и печатает стоимость запроса в микросекундах. Так видно
+цену метрик на самом дешёвом возможном запросе; на реальных обработчиках доля
+ещё меньше.
+
+    python -m bench.metrics_overhead --requests 20000
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+
+async def null_app(scope, receive, send):
+    await send({"type": "http.response.start", "status": 200, "headers": []})
+    await send({"type": "http.response.body", "body": b""})
+
+
+def make_app(with_metrics: bool):
+    from fastapi import FastAPI
+    from app.app import MetricsMiddleware
+
+    bench_app = FastAPI()
+
+    @bench_app.get("/api/v1/ping/{item_id}")
+    async def ping(item_id: int):
+        return {"ok": True, "id": item_id}
+
+    if with_metrics:
+        bench_app.add_middleware(MetricsMiddleware)
+    return bench_app
+
+
+async def drive(asgi_app, n: int) -> float:
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        pass
+
+    def scope(i: int):
+        return {
+            "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET",
+            "scheme": "http", "path": f"/api/v1/ping/{i % 100}", "raw_path": b"", "query_string": b"",
+            "root_path": "", "headers": [(b"host", b"bench")], "client": ("127.0.0.1", 1),
+            "server": ("127.0.0.1", 80),
+        }
+
+    for i in range(min(n, 1000)):  # прогрев
+        await asgi_app(scope(i), receive, send)
+    t0 = time.perf_counter()
+    for i in range(n):
+        await asgi_app(scope(i), receive, send)
+    return (time.perf_counter() - t0) / n
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(prog="python -m bench.metrics_overhead", description=__doc__.splitlines()[0])
+    ap.add_argument("--requests", type=int, default=20000)
+    ap.add_argument("--rounds", type=int, default=5, help="берётся лучший из раундов")
+    ap.add_argument("--out", help="записать результат в JSON")
+    args = ap.parse_args(argv)
+
+    # импорт app.app создаёт и наполняет базу — уводим его во временный файл
+    os.environ.setdefault("SQLITE_PATH", str(Path(tempfile.mkdtemp(prefix="cpvp-bench-")) / "bench.db"))
+
+    from app.app import MetricsMiddleware
+
+    def best_of(asgi_app) -> float:
+        return min(asyncio.run(drive(asgi_app, args.requests)) for _ in range(args.rounds))
+
+    # чистая стоимость middleware: пустое ASGI-приложение с обёрткой и без
+    null_cost = best_of(MetricsMiddleware(null_app)) - best_of(null_app)
+    bare, wrapped = best_of(make_app(False)), best_of(make_app(True))
+    result = {
+        "requests": args.requests,
+        "middleware_us": round(null_cost * 1e6, 3),
+        "fastapi_bare_us": round(bare * 1e6, 2),
+        "fastapi_with_metrics_us": round(wrapped * 1e6, 2),
+        "overhead_pct_of_cheapest_route": round(null_cost / bare * 100, 2),
+    }
+    print(f"middleware сам по себе:        {result['middleware_us']} мкс/запрос")
+    print(f"FastAPI-маршрут без метрик:    {result['fastapi_bare_us']} мкс/запрос")
+    print(f"FastAPI-маршрут с метриками:   {result['fastapi_with_metrics_us']} мкс/запрос")
+    print(f"доля от самого дешёвого запроса: {result['overhead_pct_of_cheapest_route']}%")
+    if args.out:
+        Path(args.out).write_text(json.dumps(result, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,72 @@
+"""Цена построения запросов горячих путей: select(...) на каждый вызов против lambda_stmt.
+
+Для запросов входа и проверки ролей меряет отдельно сборку конструкции вместе
+с ключом кэша компиляции (ровно то, что SQLAlchemy делает на каждый execute до
+поиска в кэше) и полный вызов через Session на базе только для чтения.
+Печатает микросекунды на вызов «как было» и «сейчас» (q_* из app.app).
+
+    python -m bench.stmt_cache --calls 20000
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+
+def best_of(fn, calls: int, rounds: int) -> float:
+    for _ in range(min(calls, 1000)):  # прогрев, заодно заполняет кэш компиляции
+        fn()
+    best = float("inf")
+    for _ in range(rounds):
+        t0 = time.perf_counter()
+        for _ in range(calls):
+            fn()
+        best = min(best, (time.perf_counter() - t0) / calls)
+    return best
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(prog="python -m bench.stmt_cache", description=__doc__.splitlines()[0])
+    ap.add_argument("--calls", type=int, default=20000)
+    ap.add_argument("--rounds", type=int, default=5, help="берётся лучший из раундов")
+    ap.add_argument("--out", help="записать результат в JSON")
+    args = ap.parse_args(argv)
+
+    # импорт app.app создаёт и наполняет базу — уводим его во временный файл
+    os.environ.setdefault("SQLITE_PATH", str(Path(tempfile.mkdtemp(prefix="cpvp-bench-")) / "bench.db"))
+
+    from sqlmodel import Session, select
+    from app.app import Role, User, UserRole, read_engine, q_user_by_login, q_user_roles
+
+    # как запросы строились в обработчиках до lambda_stmt
+    queries = {
+        "login": (lambda: select(User).where(User.login == "admin"),
+                  lambda: q_user_by_login("admin")),
+        "user_roles": (lambda: select(Role.name).join(UserRole, Role.id == UserRole.role_id)
+                       .where(UserRole.user_id == 1),
+                       lambda: q_user_roles(1)),
+    }
+    result = {"calls": args.calls}
+    print(f"{'запрос':<16}{'сборка, было':>14}{'сейчас':>10}{'вызов, было':>14}{'сейчас':>10}   мкс")
+    with Session(read_engine) as s:
+        for name, (old, new) in queries.items():
+            row = {
+                "build_old_us": best_of(lambda: old()._generate_cache_key(), args.calls, args.rounds),
+                "build_new_us": best_of(lambda: new()._generate_cache_key(), args.calls, args.rounds),
+                "exec_old_us": best_of(lambda: s.exec(old()).all(), args.calls, args.rounds),
+                "exec_new_us": best_of(lambda: s.scalars(new()).all(), args.calls, args.rounds),
+            }
+            row = {k: round(v * 1e6, 2) for k, v in row.items()}
+            result[name] = row
+            print(f"{name:<16}{row['build_old_us']:>14}{row['build_new_us']:>10}"
+                  f"{row['exec_old_us']:>14}{row['exec_new_us']:>10}")
+    if args.out:
+        Path(args.out).write_text(json.dumps(result, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
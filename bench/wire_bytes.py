@@ -0,0 +1,82 @@
+"""Байты «на проводе» для статики и крупных JSON-ответов.
+
+Запрашивает главную страницу, статику и тяжёлые списки с разными Accept-Encoding
+и печатает размер тела: identity — как отдавалось до сжатия, gzip/br — сейчас.
+Отдельно проверяет, что повторный запрос статики по хэшированному имени
+обслуживается из кэша браузера (immutable), а по обычному — отвечает 304.
+
+    python -m bench.wire_bytes --dataset small
+"""
+import argparse
+import http.client
+import json
+import re
+import shutil
+import sys
+import tempfile
+from pathlib import Path
+
+from bench.http_load import DATASETS, InProcessServer, ensure_dataset, login
+
+ENCODINGS = ("identity", "gzip", "br")
+
+
+def fetch(port: int, path: str, headers: dict):
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=120)
+    conn.request("GET", path, headers=headers)
+    resp = conn.getresponse()
+    body = resp.read()
+    conn.close()
+    return resp, body
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(prog="python -m bench.wire_bytes", description=__doc__.splitlines()[0])
+    src = ap.add_mutually_exclusive_group()
+    src.add_argument("--dataset", choices=sorted(DATASETS), default="small")
+    src.add_argument("--db")
+    ap.add_argument("--seed", type=int, default=42)
+    ap.add_argument("--out", help="записать результат в JSON")
+    args = ap.parse_args(argv)
+
+    source = Path(args.db) if args.db else ensure_dataset(args.dataset, args.seed)
+    workdir = Path(tempfile.mkdtemp(prefix="cpvp-bench-"))
+    db = workdir / "bench.db"
+    shutil.copyfile(source, db)
+    rows = {}
+    try:
+        with InProcessServer(db) as srv:
+            cookie = login(srv.port)
+            _, index_html = fetch(srv.port, "/", {})
+            assets = re.findall(r'"(/static/[^"]+)"', index_html.decode("utf-8"))
+            paths = ["/"] + assets + ["/api/v1/workorders", "/api/v1/inventory", "/api/v1/events?limit=60"]
+            for path in paths:
+                sizes = {}
+                for enc in ENCODINGS:
+                    resp, body = fetch(srv.port, path, {"Cookie": cookie, "Accept-Encoding": enc})
+                    got = resp.getheader("content-encoding") or "identity"
+                    sizes[enc] = len(body) if got == enc else None
+                resp, _ = fetch(srv.port, path, {"Cookie": cookie})
+                rows[path] = {"bytes": sizes, "cache_control": resp.getheader("cache-control")}
+                etag = resp.getheader("etag")
+                if etag:
+                    again, _ = fetch(srv.port, path, {"Cookie": cookie, "If-None-Match": etag})
+                    rows[path]["revalidate_status"] = again.status
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"{'путь':<40}{'identity':>12}{'gzip':>12}{'br':>12}   cache-control")
+    for path, r in rows.items():
+        b = r["bytes"]
+        cells = "".join(f"{(str(b[e]) if b[e] is not None else '—'):>12}" for e in ENCODINGS)
+        print(f"{path[:39]:<40}{cells}   {r['cache_control'] or ''}")
+    total_before = sum(r["bytes"]["identity"] or 0 for r in rows.values())
+    total_after = sum(min(v for v in r["bytes"].values() if v is not None) for r in rows.values())
+    print(f"\nвсего: {total_before} -> {total_after} байт ({total_after / max(total_before, 1):.1%})")
+    if args.out:
+        Path(args.out).write_text(json.dumps(rows, ensure_ascii=False, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())